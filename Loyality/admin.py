@@ -1,15 +1,138 @@
 # backend/loyalty/admin.py
+#
+# Таблицы кодов и штампов — миллионы строк, поэтому в списках:
+# - связанные пользователи подтягиваются JOIN'ом (list_select_related), без N+1;
+# - число строк не считается точным COUNT(*) (EstimatedCountPaginator,
+#   show_full_result_count = False);
+# - поиск только по началу значения и только по индексированным колонкам
+#   (PrefixSearchMixin), без icontains по всей таблице;
+# - фильтры без SELECT DISTINCT по таблице, иерархия дат — по индексу created_at.
+from django.conf import settings
 from django.contrib import admin
-from .models import  LoyaltyCode, LoyaltyStamp
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .models import LoyaltyCode, LoyaltyProfile, LoyaltyStamp, normalize_username
+from .search import prefix_filter
+from .signals import notify_profile_changed
+
+# Источники штампов, которые пишет код (LoyaltyStamp.source)
+STAMP_SOURCES = ("code", "code_redeem", "manual", "manual_add")
+
+
+class EstimatedCountPaginator(Paginator):
+    """Без фильтров — оценка планировщика PostgreSQL (pg_class.reltuples),
+    иначе COUNT не дальше LOYALTY_ADMIN_COUNT_LIMIT строк: страницы за пределом
+    всё равно никто не листает, а точный COUNT(*) по таблице — секунды."""
+
+    @cached_property
+    def count(self):
+        limit = getattr(settings, "LOYALTY_ADMIN_COUNT_LIMIT", 10_000)
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] > limit:
+                return row[0]
+        return queryset.order_by()[:limit].count()
+
+
+def code_prefix(term):
+    """Коды LoyaltyCode — только цифры; всё остальное ищется по логину."""
+    return term if term.isdigit() else ""
+
+
+class PrefixSearchMixin:
+    """Поиск по началу значения: prefix_search_fields — пары (поле, нормализатор),
+    условие — диапазон по индексу поля (Loyality/search.py), а не LIKE '%...%'.
+
+    Ищется по первому полю, чей нормализатор вернул непустой префикс: OR двух
+    диапазонов по разным таблицам индекс не использует и читает всю таблицу.
+    Поле связанной модели ("user__username_key") — подзапрос user_id IN (...)
+    по индексу этой модели, а не JOIN.
+    """
+
+    prefix_search_fields = ()
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        for field, normalize in self.prefix_search_fields:
+            prefix = normalize(search_term)
+            if not prefix:
+                continue
+            relation, _, column = field.partition("__")
+            if not column:
+                return queryset.filter(prefix_filter(field, prefix)), False
+            related = queryset.model._meta.get_field(relation).related_model
+            matches = related._default_manager.filter(prefix_filter(column, prefix)).values("pk")
+            return queryset.filter(**{f"{relation}__in": matches}), False
+        return queryset.none(), False
+
+
+class StampSourceFilter(admin.SimpleListFilter):
+    """Фиксированный список вместо SELECT DISTINCT source по всей таблице."""
+
+    title = "источник"
+    parameter_name = "source"
+
+    def lookups(self, request, model_admin):
+        return [(source, source) for source in STAMP_SOURCES]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(source=self.value())
+        return queryset
+
+
+class LargeTableAdmin(PrefixSearchMixin, admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ("-id",)
+
 
 @admin.register(LoyaltyCode)
-class LoyaltyCodeAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "code", "created_at", "expires_at", "redeemed")
+class LoyaltyCodeAdmin(LargeTableAdmin):
+    list_display = ("id", "user", "code", "created_at", "expires_at", "redeemed", "redeemed_by")
     list_filter = ("redeemed",)
-    search_fields = ("code", "user__username")
+    list_select_related = ("user", "redeemed_by")
+    raw_id_fields = ("user", "redeemed_by")
+    date_hierarchy = "created_at"
+    search_fields = ("code", "user__username_key")
+    search_help_text = "Начало кода (только цифры) или логина клиента"
+    prefix_search_fields = (("code", code_prefix), ("user__username_key", normalize_username))
+
 
 @admin.register(LoyaltyStamp)
-class LoyaltyStampAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "source", "created_at")
-    list_filter = ("source",)
-    search_fields = ("user__username", "source")
+class LoyaltyStampAdmin(LargeTableAdmin):
+    list_display = ("id", "user", "source", "quantity", "created_at", "created_by")
+    list_filter = (StampSourceFilter,)
+    list_select_related = ("user", "created_by")
+    raw_id_fields = ("user", "created_by")
+    date_hierarchy = "created_at"
+    search_fields = ("user__username_key",)
+    search_help_text = "Начало логина клиента"
+    prefix_search_fields = (("user__username_key", normalize_username),)
+
+
+@admin.register(LoyaltyProfile)
+class LoyaltyProfileAdmin(LargeTableAdmin):
+    list_display = ("id", "user", "stamps", "updated_at")
+    list_select_related = ("user",)
+    raw_id_fields = ("user",)
+    readonly_fields = ("updated_at",)
+    search_fields = ("user__username_key",)
+    search_help_text = "Начало логина клиента"
+    prefix_search_fields = (("user__username_key", normalize_username),)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Правка из админки — тоже изменение штампов: сбросить кэш статуса, SSE
+        notify_profile_changed(LoyaltyProfile, obj.user_id)
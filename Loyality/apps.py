@@ -1,6 +1,13 @@
+from importlib import import_module
+
 from django.apps import AppConfig
 
 
 class LoyalityConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Loyality'
+
+    def ready(self):
+        # Подписка на profile_changed; status_cache первым — остальные читают уже сброшенный кэш
+        for module in ("status_cache", "events", "routers"):
+            import_module(f"{self.name}.{module}")
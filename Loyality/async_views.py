@@ -0,0 +1,251 @@
+# Loyality/async_views.py — асинхронные вьюхи (работают под ASGI: sixcoffee/asgi.py)
+#
+# Горячие эндпоинты лояльности в async-варианте: под uvicorn запрос не занимает
+# поток, пока ждёт БД/кэш. Синхронные вьюхи DRF под ASGI выполняются в одном
+# общем потоке (thread_sensitive), поэтому на наплыве запросов упираются в него.
+# Какие маршруты отдавать async-версиям — LOYALTY_ASYNC_ROUTES (Loyality/urls.py).
+
+import asyncio
+import functools
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from . import idempotency, status_cache
+from .authentication import ClaimsUser, check_status, has_user_claims
+from .codes import CodeSpaceExhausted, LiveCodeLimitReached, aget_or_issue_code
+from .conditional import not_modified, status_etag, with_etag
+from .events import get_broker, status_payload
+from .routers import replica_reads
+from .signed_codes import sign_code
+from .throttling import CODE_THROTTLES, athrottle
+from .views import redeem_code
+
+User = get_user_model()
+
+
+def _validated_token(request):
+    """JWT из заголовка Authorization или ?token= (EventSource не умеет заголовки).
+
+    Проверка только подписи и срока — без запросов к БД. None, если токена нет
+    или он невалиден.
+    """
+    auth = JWTAuthentication()
+    header = auth.get_header(request)
+    raw = auth.get_raw_token(header) if header else request.GET.get("token")
+    if not raw:
+        return None
+    try:
+        return auth.get_validated_token(raw)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+async def _authenticate(request):
+    """Пользователь по JWT или None.
+
+    Токен с claims — ClaimsUser, существование и is_active — по кэшу статуса
+    (async-вьюхи читают только поля из claims); старый токен — как
+    JWTAuthentication, но через async ORM.
+    """
+    token = _validated_token(request)
+    if token is None or api_settings.USER_ID_CLAIM not in token:
+        return None
+    if has_user_claims(token):
+        user = ClaimsUser(token)
+        if check_status(await status_cache.aget_status(user.id)) is not None:
+            return None
+        return user
+    user = await User.objects.filter(**{api_settings.USER_ID_FIELD: token[api_settings.USER_ID_CLAIM]}).afirst()
+    if user is None or (api_settings.CHECK_USER_IS_ACTIVE and not user.is_active):
+        return None
+    return user
+
+
+def _login_required(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await _authenticate(request)
+        if user is None:
+            return _json({"detail": "Требуется авторизация"}, status=401)
+        request.user = user
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def _json(body, status=200):
+    return JsonResponse(body, status=status, json_dumps_params={"ensure_ascii": False})
+
+
+def _request_data(request):
+    """Тело запроса; JSON, который не объект (массив, число), — как пустое тело."""
+    if request.content_type == "application/json":
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    return request.POST
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@_login_required
+@replica_reads
+async def me(request):
+    u = request.user
+    status = await status_cache.aget_status(u.id)
+    if status is None:
+        return _json({"detail": "Требуется авторизация"}, status=401)
+    is_staff, is_barista = bool(u.is_staff), bool(getattr(u, "is_barista", False))
+
+    etag = status_etag("me", status, is_staff, is_barista)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+
+    return with_etag(_json({
+        "id": u.id,
+        "username": u.username,
+        "is_staff": is_staff,
+        "is_barista": is_barista,
+        "stamps": status["stamps"],
+        "max_stamps": getattr(settings, "LOYALTY_MAX_STAMPS", 6),
+    }), etag)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@_login_required
+@replica_reads
+async def get_loyalty_status(request):
+    username = request.GET.get("username")
+    if not username:
+        return _json({"detail": "username обязателен"}, status=400)
+
+    if not request.user.is_staff:
+        if request.user.username.lower() != username.lower():
+            return _json({"detail": "Доступ только к своему профилю"}, status=403)
+
+    target = await status_cache.aget_status_by_username(username)
+    if target is None:
+        return _json({"detail": "Пользователь не найден"}, status=404)
+
+    etag = status_etag("status", target)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+
+    return with_etag(_json({
+        "username": target["username"],
+        "stamps": target["stamps"],
+        "max_stamps": getattr(settings, "LOYALTY_MAX_STAMPS", 6),
+    }), etag)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@_login_required
+async def generate_loyalty_code(request):
+    if getattr(settings, "LOYALTY_CODE_MODE", "db") == "signed":
+        code, expires_at = sign_code(request.user.id)
+        return _json({"code": code, "expires_at": expires_at.isoformat()})
+
+    try:
+        lc = await aget_or_issue_code(request.user.id)
+    except LiveCodeLimitReached as e:
+        return _json({"detail": str(e)}, status=429)
+    except CodeSpaceExhausted:
+        response = _json({"detail": "Не удалось выдать код, повторите позже"}, status=503)
+        response["Retry-After"] = "1"
+        return response
+    return _json({"code": lc.code, "expires_at": lc.expires_at.isoformat()})
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@_login_required
+async def redeem_loyalty_code(request):
+    wait = await athrottle(request, CODE_THROTTLES)
+    if wait is not None:
+        response = _json({"detail": "Слишком много попыток, повторите позже"}, status=429)
+        response["Retry-After"] = str(int(wait) + 1)
+        return response
+
+    data = _request_data(request)
+    code = str(data.get("code", "")).strip()
+    if not code:
+        return _json({"detail": "Код обязателен"}, status=400)
+
+    try:
+        raw_key = idempotency.request_key(request)
+        if raw_key is None:
+            # Транзакция с select_for_update — синхронная, явно уходит в поток
+            body, status = await sync_to_async(redeem_code)(code, request.user)
+            return _json(body, status=status)
+        body, status, replayed = await idempotency.acall(
+            request.user.id, "redeem-code", raw_key, data, lambda: redeem_code(code, request.user)
+        )
+    except idempotency.IdempotencyError as e:
+        return _json({"detail": str(e)}, status=e.status)
+    response = _json(body, status=status)
+    if replayed:
+        response[idempotency.REPLAYED_HEADER] = "true"
+    return response
+
+
+def _sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+# ПОТОК ИЗМЕНЕНИЙ ШТАМПОВ (Server-Sent Events) — вместо опроса /api/me/
+async def loyalty_events(request):
+    if not isinstance(request, ASGIRequest):
+        # Под WSGI бесконечный поток читается синхронно и навсегда занимает воркер
+        return _json({"detail": "Поток событий доступен только под ASGI"}, status=501)
+    token = _validated_token(request)
+    if token is None or api_settings.USER_ID_CLAIM not in token:
+        return _json({"detail": "Требуется авторизация"}, status=401)
+    user_id = token[api_settings.USER_ID_CLAIM]
+    if check_status(await status_cache.aget_status(user_id)) is not None:
+        return _json({"detail": "Требуется авторизация"}, status=401)
+    expires_at = token["exp"]
+    heartbeat = getattr(settings, "LOYALTY_EVENTS_HEARTBEAT_SECONDS", 25)
+
+    async def stream():
+        broker = get_broker()
+        queue = broker.subscribe(user_id)
+        try:
+            # Сначала текущее состояние, дальше — только изменения
+            yield _sse(status_payload(await status_cache.aget_status(user_id)))
+            while True:
+                remaining = expires_at - time.time()
+                if remaining <= 0:
+                    # Подключение не переживает токен: клиент обновит его и переподключится
+                    yield "event: token-expired\ndata: {}\n\n"
+                    return
+                try:
+                    await asyncio.wait_for(queue.get(), timeout=min(heartbeat, remaining))
+                except asyncio.TimeoutError:
+                    if heartbeat < remaining:
+                        yield ": ping\n\n"
+                    continue
+                yield _sse(status_payload(await status_cache.aget_status(user_id)))
+        finally:
+            broker.unsubscribe(user_id, queue)
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # nginx: не буферизовать поток
+    return response
@@ -0,0 +1,128 @@
+# Loyality/authentication.py — JWT-аутентификация по claims, без SELECT пользователя
+#
+# Стандартный JWTAuthentication на каждый запрос читает строку User, хотя
+# горячим вьюхам нужны только id, username, is_staff и is_barista. Эти поля
+# кладутся в токен при выдаче (LoyaltyRefreshToken), а ClaimsJWTAuthentication
+# собирает из них ClaimsUser. Строка из БД читается, только если вьюха
+# обратилась к какому-то другому атрибуту.
+#
+# Claims берутся из строки User при входе и заново при каждом обновлении
+# токена (LoyaltyTokenRefreshSerializer), поэтому снятые is_staff/is_barista
+# перестают действовать, когда истекает текущий access-токен. Существование и
+# is_active пользователя проверяются на каждом запросе по кэшу статуса
+# (Loyality/status_cache.py): удалённый или отключённый пользователь получает
+# 401 сразу, обычно без запроса к БД.
+
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import status_cache
+
+USER_CLAIMS = ("username", "is_staff", "is_barista")
+
+
+class LoyaltyRefreshToken(RefreshToken):
+    """Refresh-токен с claims пользователя; access-токен копирует их из refresh."""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token.set_user_claims(user)
+        return token
+
+    def set_user_claims(self, user):
+        self["username"] = user.username
+        self["is_staff"] = bool(user.is_staff)
+        self["is_barista"] = bool(getattr(user, "is_barista", False))
+
+
+def has_user_claims(token):
+    return all(claim in token for claim in USER_CLAIMS)
+
+
+def check_status(status):
+    """Статус из кэша (или None) → сообщение и код ошибки аутентификации; None — всё в порядке."""
+    if status is None:
+        return "Пользователь не найден", "user_not_found"
+    if api_settings.CHECK_USER_IS_ACTIVE and not status.get("is_active", True):
+        return "Пользователь отключён", "user_inactive"
+    return None
+
+
+class ClaimsUser(TokenUser):
+    """Пользователь из claims токена; остальные атрибуты лениво берутся из БД."""
+
+    @cached_property
+    def id(self):
+        return get_user_model()._meta.pk.to_python(self.token[api_settings.USER_ID_CLAIM])
+
+    @cached_property
+    def pk(self):
+        return self.id
+
+    @cached_property
+    def is_barista(self):
+        return bool(self.token.get("is_barista", False))
+
+    def __str__(self):
+        return self.username
+
+    def __eq__(self, other):
+        if isinstance(other, get_user_model()):
+            return self.id == other.pk
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def load(self):
+        """Модель User из БД — один SELECT при первом обращении."""
+        if "_user" not in self.__dict__:
+            User = get_user_model()
+            user = User.objects.filter(**{api_settings.USER_ID_FIELD: self.id}).first()
+            if user is None:
+                raise AuthenticationFailed("Пользователь не найден", code="user_not_found")
+            self.__dict__["_user"] = user
+        return self.__dict__["_user"]
+
+    def __getattr__(self, attr):
+        # Сюда попадают только атрибуты, которых нет в claims
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    # Записи и проверки пароля — на настоящей модели
+    def save(self, *args, **kwargs):
+        return self.load().save(*args, **kwargs)
+
+    def set_password(self, raw_password):
+        return self.load().set_password(raw_password)
+
+    def check_password(self, raw_password):
+        return self.load().check_password(raw_password)
+
+
+def resolve_user(user):
+    """Модель User для кода, которому нужен настоящий экземпляр (ORM, сериализаторы)."""
+    return user.load() if isinstance(user, ClaimsUser) else user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication без запроса к БД для токенов с claims пользователя.
+
+    Токены, выданные до появления claims, по-прежнему проверяются через БД.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM in validated_token and has_user_claims(validated_token):
+            user = ClaimsUser(validated_token)
+            error = check_status(status_cache.get_status(user.id))
+            if error is not None:
+                raise AuthenticationFailed(*error)
+            return user
+        return super().get_user(validated_token)
@@ -0,0 +1,210 @@
+# Loyality/codes.py — выдача кодов лояльности без перебора и exists()-запросов
+
+import hashlib
+import threading
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import LoyaltyCode, LoyaltyCodeSequence
+
+
+class CodeSpaceExhausted(Exception):
+    """Не удалось выдать свободный код (все попытки упёрлись в живые коды).
+    Вьюхи отвечают 503 с Retry-After: следующие номера последовательности свободны."""
+
+
+class LiveCodeLimitReached(Exception):
+    """У пользователя уже максимум непогашенных кодов (LOYALTY_MAX_LIVE_CODES)."""
+
+
+class CodePermutation:
+    """Ключевая перестановка чисел [0, 10**length) — сеть Фейстеля.
+
+    Номер из последовательности превращается в код, который выглядит случайным,
+    но два разных номера в пределах одного цикла никогда не дают один и тот же код.
+    """
+
+    rounds = 4
+
+    def __init__(self, length=6, key=""):
+        self.length = length
+        self.size = 10 ** length
+        # Для нечётной длины домен сети шире (10**(length+1)), лишнее отсекаем cycle-walking'ом
+        self.half = 10 ** ((length + 1) // 2)
+        self.key = hashlib.blake2b(key.encode(), digest_size=32).digest()
+
+    def _round(self, i, value):
+        digest = hashlib.blake2b(f"{i}:{value}".encode(), key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.half
+
+    def _encrypt(self, x):
+        left, right = divmod(x, self.half)
+        for i in range(self.rounds):
+            left, right = right, (left + self._round(i, right)) % self.half
+        return left * self.half + right
+
+    def __call__(self, index):
+        x = self._encrypt(index % self.size)
+        while x >= self.size:
+            x = self._encrypt(x)
+        return str(x).zfill(self.length)
+
+
+class CodeAllocator:
+    """Выдаёт коды за O(1): номер из общей последовательности → перестановка.
+
+    Каждый процесс резервирует в LoyaltyCodeSequence блок из `block_size` номеров
+    одним UPDATE и дальше раздаёт их из памяти, поэтому процессы никогда не
+    получают одинаковые номера. Коды повторяются только после полного оборота
+    последовательности (10**length выдач), когда старые коды давно истекли.
+    """
+
+    def __init__(self, length=None, block_size=None, key=None):
+        self.length = length or getattr(settings, "LOYALTY_CODE_LENGTH", 6)
+        self.block_size = block_size or getattr(settings, "LOYALTY_CODE_BLOCK_SIZE", 64)
+        self.permutation = CodePermutation(self.length, key if key is not None else settings.SECRET_KEY)
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+
+    def _reserve_block(self):
+        with transaction.atomic():
+            updated = LoyaltyCodeSequence.objects.filter(pk=1).update(value=F("value") + self.block_size)
+            if not updated:
+                LoyaltyCodeSequence.objects.get_or_create(pk=1)
+                LoyaltyCodeSequence.objects.filter(pk=1).update(value=F("value") + self.block_size)
+            end = LoyaltyCodeSequence.objects.values_list("value", flat=True).get(pk=1)
+        return end - self.block_size, end
+
+    def next_index(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve_block()
+            index = self._next
+            self._next += 1
+            return index
+
+    def allocate(self):
+        return self.permutation(self.next_index())
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_allocator():
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                _allocator = CodeAllocator()
+    return _allocator
+
+
+def _default_ttl():
+    return timedelta(minutes=getattr(settings, "LOYALTY_CODE_TTL_MINUTES", 15))
+
+
+def offline_sync_window():
+    """Насколько задним числом планшет может прислать сканирование (LOYALTY_OFFLINE_SYNC_HOURS).
+
+    Столько после истечения код ещё может прийти в пакетном погашении, поэтому
+    раньше этого срока его строку (и отметку подписанного кода) удалять нельзя.
+    """
+    return timedelta(hours=getattr(settings, "LOYALTY_OFFLINE_SYNC_HOURS", 24))
+
+
+def live_codes(user_id):
+    """Непогашенные и неистёкшие коды пользователя (индекс loyaltycode_user_live_idx)."""
+    return LoyaltyCode.objects.filter(user_id=user_id, redeemed=False, expires_at__gt=timezone.now())
+
+
+def get_or_issue_code(user_id, ttl=None):
+    """Вернуть действующий код пользователя или выдать новый.
+
+    При LOYALTY_CODE_REUSE повторное нажатие "показать код" отдаёт тот же код;
+    с LOYALTY_CODE_REUSE_EXTEND его срок продлевается, когда осталось меньше
+    половины TTL (так продление не пишет в БД на каждое нажатие). Новый код
+    выдаётся, только если живых кодов меньше LOYALTY_MAX_LIVE_CODES.
+    """
+    ttl = ttl or _default_ttl()
+    live = live_codes(user_id)
+
+    if getattr(settings, "LOYALTY_CODE_REUSE", True):
+        lc = live.only("id", "code", "expires_at").order_by("-expires_at").first()
+        if lc is not None:
+            now = timezone.now()
+            if getattr(settings, "LOYALTY_CODE_REUSE_EXTEND", True) and lc.expires_at - now < ttl / 2:
+                lc.expires_at = now + ttl
+                LoyaltyCode.objects.filter(pk=lc.pk).update(expires_at=lc.expires_at)
+            return lc
+
+    max_live = getattr(settings, "LOYALTY_MAX_LIVE_CODES", None)
+    if max_live is not None and live.count() >= max_live:
+        raise LiveCodeLimitReached(f"Не больше {max_live} активных кодов")
+
+    return issue_code(user_id, ttl=ttl)
+
+
+async def aget_or_issue_code(user_id, ttl=None):
+    """Асинхронный get_or_issue_code: поиск и продление живого кода — async ORM.
+
+    Выдача нового кода (резерв блока и INSERT с обработкой IntegrityError
+    в транзакции) остаётся синхронной и явно уходит в поток.
+    """
+    ttl = ttl or _default_ttl()
+    live = live_codes(user_id)
+
+    if getattr(settings, "LOYALTY_CODE_REUSE", True):
+        lc = await live.only("id", "code", "expires_at").order_by("-expires_at").afirst()
+        if lc is not None:
+            now = timezone.now()
+            if getattr(settings, "LOYALTY_CODE_REUSE_EXTEND", True) and lc.expires_at - now < ttl / 2:
+                lc.expires_at = now + ttl
+                await LoyaltyCode.objects.filter(pk=lc.pk).aupdate(expires_at=lc.expires_at)
+            return lc
+
+    max_live = getattr(settings, "LOYALTY_MAX_LIVE_CODES", None)
+    if max_live is not None and await live.acount() >= max_live:
+        raise LiveCodeLimitReached(f"Не больше {max_live} активных кодов")
+
+    return await sync_to_async(issue_code)(user_id, ttl=ttl)
+
+
+def issue_code(user_id, ttl=None, max_attempts=8, allocator=None):
+    """Создать LoyaltyCode для пользователя с гарантированно свободным кодом.
+
+    В обычном случае это один INSERT. Если код ещё занят записью старше окна
+    офлайн-синхронизации (после оборота последовательности или от старого
+    генератора), номер освобождается: непогашенная строка удаляется, у
+    погашенной обнуляется code — сама строка остаётся для статистики баристы
+    и выгрузки. Номер, занятый живым или недавно погашенным кодом, пропускается.
+    """
+    ttl = ttl or _default_ttl()
+    allocator = allocator or get_allocator()
+
+    for _ in range(max_attempts):
+        code = allocator.allocate()
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                return LoyaltyCode.objects.create(user_id=user_id, code=code, expires_at=now + ttl)
+        except IntegrityError:
+            pass
+
+        cutoff = now - offline_sync_window()
+        freed = LoyaltyCode.objects.filter(code=code, redeemed=False, expires_at__lte=cutoff).delete()[0]
+        if not freed:
+            freed = LoyaltyCode.objects.filter(code=code, redeemed=True, redeemed_at__lte=cutoff).update(code=None)
+        if freed:
+            try:
+                with transaction.atomic():
+                    return LoyaltyCode.objects.create(user_id=user_id, code=code, expires_at=now + ttl)
+            except IntegrityError:
+                pass
+
+    raise CodeSpaceExhausted(f"Не удалось выдать код за {max_attempts} попыток")
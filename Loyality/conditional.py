@@ -0,0 +1,36 @@
+# Loyality/conditional.py — ETag для GET-эндпоинтов статуса
+#
+# ETag считается из записи status_cache (версия профиля updated_at + поля,
+# попадающие в ответ), поэтому проверка If-None-Match обходится без БД и без
+# сериализатора: совпало — сразу 304.
+
+import hashlib
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+
+def status_etag(kind, status, *extra):
+    """Сильный ETag ответа `kind`, построенного из записи status_cache."""
+    updated_at = status.get("updated_at")
+    parts = [
+        kind,
+        status["id"],
+        status["username"],
+        status["stamps"],
+        updated_at.isoformat() if updated_at else "",
+        getattr(settings, "LOYALTY_MAX_STAMPS", 6),
+        *extra,
+    ]
+    return quote_etag(hashlib.md5(":".join(map(str, parts)).encode()).hexdigest())
+
+
+def not_modified(request, etag):
+    """Ответ 304, если If-None-Match совпал с etag; иначе None."""
+    return get_conditional_response(request, etag=etag)
+
+
+def with_etag(response, etag):
+    response["ETag"] = etag
+    return response
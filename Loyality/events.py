@@ -0,0 +1,106 @@
+# Loyality/events.py — pub/sub изменений профиля для потоковых подключений (SSE)
+#
+# Каждое открытое подключение — asyncio.Queue на один элемент: событие —
+# только "у пользователя что-то изменилось", статус подписчик читает сам, уже
+# в своей корутине. Поэтому изменение штампов без открытых подключений ничего
+# не стоит, а несколько изменений подряд сливаются в одно чтение. Тысячи
+# простаивающих подписчиков стоят по несколько сотен байт. Публикация
+# безопасна из любого потока (синхронные вьюхи работают в пуле потоков
+# ASGI-сервера).
+#
+# Доставка между процессами — через бэкенд LOYALTY_EVENTS_BACKEND. Бэкенд
+# получает callback `deliver(user_id)`; его `publish(user_id)` должен донести
+# событие до всех процессов и в каждом вызвать `deliver`. LocalBackend делает
+# это в пределах одного процесса; для нескольких воркеров подключите бэкенд
+# поверх общей шины (например, Redis pub/sub) с тем же интерфейсом.
+
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .signals import profile_changed
+
+CHANGED = True  # элемент очереди подписчика: статус пора перечитать
+
+
+class LocalBackend:
+    """Доставка только внутри текущего процесса."""
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, user_id):
+        self.deliver(user_id)
+
+
+class Broker:
+    def __init__(self, backend_path=None):
+        # str(user_id) -> {queue: loop}; в JWT user_id приходит строкой
+        self._subscribers = defaultdict(dict)
+        self._lock = threading.Lock()
+        backend_path = backend_path or getattr(settings, "LOYALTY_EVENTS_BACKEND", "Loyality.events.LocalBackend")
+        self.backend = import_string(backend_path)(self.deliver)
+
+    def subscribe(self, user_id):
+        """Подписаться из корутины; вернёт очередь, из которой читать события."""
+        queue = asyncio.Queue(maxsize=1)
+        with self._lock:
+            self._subscribers[str(user_id)][queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(str(user_id))
+            if queues is not None:
+                queues.pop(queue, None)
+                if not queues:
+                    del self._subscribers[str(user_id)]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+    def publish(self, user_id):
+        self.backend.publish(user_id)
+
+    def deliver(self, user_id):
+        with self._lock:
+            targets = list(self._subscribers.get(str(user_id), {}).items())
+        for queue, loop in targets:
+            loop.call_soon_threadsafe(_offer, queue)
+
+
+def _offer(queue):
+    # Непрочитанное событие уже означает "перечитать статус" — второе не нужно
+    if not queue.full():
+        queue.put_nowait(CHANGED)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = Broker()
+    return _broker
+
+
+def status_payload(status):
+    return {
+        "stamps": status["stamps"] if status else 0,
+        "max_stamps": getattr(settings, "LOYALTY_MAX_STAMPS", 6),
+    }
+
+
+@receiver(profile_changed)
+def _on_profile_changed(sender, user_id, **kwargs):
+    # Без запроса к БД: статус читает подписчик, если он есть
+    get_broker().publish(user_id)
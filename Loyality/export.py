@@ -0,0 +1,163 @@
+# Loyality/export.py — потоковая выгрузка штампов и погашенных кодов для бухгалтерии
+#
+# Строки читаются пачками по первичному ключу (id > последний, ORDER BY id,
+# LIMIT chunk_size — без OFFSET) через values_list().iterator(), кодируются в
+# CSV или NDJSON и отдаются генератором — в StreamingHttpResponse
+# (/api/loyalty/export/) или в файл (manage.py export_loyalty). В памяти
+# держится одна пачка, поэтому память не зависит от объёма выгрузки.
+# gzip — потоково, через zlib.compressobj.
+
+import csv
+import json
+import zlib
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import LoyaltyCode, LoyaltyStamp, RedeemedSignedCode
+
+# вид выгрузки → модель, условие, поле времени, поле баристы, колонки (заголовок, lookup)
+EXPORTS = {
+    "stamps": {
+        "model": LoyaltyStamp,
+        "filter": {},
+        "time_field": "created_at",
+        "barista_field": "created_by",
+        "columns": (
+            ("id", "id"),
+            ("created_at", "created_at"),
+            ("user_id", "user_id"),
+            ("username", "user__username"),
+            ("quantity", "quantity"),
+            ("source", "source"),
+            ("barista_id", "created_by_id"),
+            ("barista_username", "created_by__username"),
+        ),
+    },
+    "codes": {
+        "model": LoyaltyCode,
+        "filter": {"redeemed": True},
+        "time_field": "redeemed_at",
+        "barista_field": "redeemed_by",
+        "columns": (
+            ("id", "id"),
+            ("code", "code"),
+            ("created_at", "created_at"),
+            ("redeemed_at", "redeemed_at"),
+            ("user_id", "user_id"),
+            ("username", "user__username"),
+            ("barista_id", "redeemed_by_id"),
+            ("barista_username", "redeemed_by__username"),
+        ),
+    },
+    "signed_codes": {
+        "model": RedeemedSignedCode,
+        "filter": {},
+        "time_field": "redeemed_at",
+        "barista_field": "redeemed_by",
+        "columns": (
+            ("id", "id"),
+            ("window", "window"),
+            ("redeemed_at", "redeemed_at"),
+            ("user_id", "user_id"),
+            ("username", "user__username"),
+            ("barista_id", "redeemed_by_id"),
+            ("barista_username", "redeemed_by__username"),
+        ),
+    },
+}
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+BUFFER_SIZE = 64 * 1024  # отдаём кусками, а не по строке
+
+
+def date_range(date_from=None, date_to=None):
+    """Даты (включительно, по местному времени) → [since, until) для фильтра."""
+    since = until = None
+    if date_from is not None:
+        since = timezone.make_aware(datetime.combine(date_from, time.min))
+    if date_to is not None:
+        until = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))
+    return since, until
+
+
+def headers(kind):
+    return [header for header, _ in EXPORTS[kind]["columns"]]
+
+
+def export_rows(kind, since=None, until=None, barista_id=None, chunk_size=None):
+    """Кортежи колонок EXPORTS[kind] по возрастанию id, пачками по chunk_size."""
+    spec = EXPORTS[kind]
+    chunk_size = chunk_size or getattr(settings, "LOYALTY_EXPORT_CHUNK_SIZE", 2000)
+    time_field = spec["time_field"]
+
+    queryset = spec["model"].objects.filter(**spec["filter"])
+    if since is not None:
+        queryset = queryset.filter(**{f"{time_field}__gte": since})
+    if until is not None:
+        queryset = queryset.filter(**{f"{time_field}__lt": until})
+    if barista_id is not None:
+        queryset = queryset.filter(**{f"{spec['barista_field']}_id": barista_id})
+    queryset = queryset.order_by("pk").values_list(*(lookup for _, lookup in spec["columns"]))
+
+    last_id = 0
+    while True:
+        fetched = 0
+        for row in queryset.filter(pk__gt=last_id)[:chunk_size].iterator(chunk_size=chunk_size):
+            fetched += 1
+            yield row
+        if fetched < chunk_size:
+            return
+        last_id = row[0]
+
+
+class _Echo:
+    """Псевдофайл для csv.writer: writerow() возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+def _csv_lines(kind, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(headers(kind))
+    for row in rows:
+        yield writer.writerow([value.isoformat() if isinstance(value, datetime) else value for value in row])
+
+
+def _ndjson_lines(kind, rows):
+    names = headers(kind)
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + "\n"
+
+
+def _buffered(lines):
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # 16 + — с заголовком gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(kind, fmt, rows, gzip=False):
+    """Байтовые куски файла выгрузки из строк export_rows()."""
+    lines = _csv_lines(kind, rows) if fmt == "csv" else _ndjson_lines(kind, rows)
+    chunks = _buffered(lines)
+    return _gzipped(chunks) if gzip else chunks
@@ -0,0 +1,185 @@
+# Loyality/idempotency.py — заголовок Idempotency-Key для погашения кода,
+# начисления и сброса штампов
+#
+# Касса на кафешном Wi-Fi повторяет POST вслепую. Первый запрос с ключом
+# вставляет строку IdempotencyKey "в работе" и выполняется; его ответ
+# записывается в ту же строку в одной транзакции с самим начислением —
+# либо есть и штамп, и сохранённый ответ, либо ничего. Повтор с тем же
+# ключом стоит одного SELECT по уникальному индексу: готовый ответ отдаётся
+# как есть (заголовок Idempotent-Replayed), а пока первый запрос ещё
+# выполняется, повтор ждёт его, опрашивая строку, вместо второй транзакции.
+# Ключ действует LOYALTY_IDEMPOTENCY_TTL_SECONDS; тот же ключ с другим телом
+# запроса — 422. Ответы 5xx не сохраняются: такой запрос можно повторить.
+# Если запрос выполнялся дольше LOYALTY_IDEMPOTENCY_PENDING_TIMEOUT_SECONDS и
+# ключ успел занять повтор, результат первого откатывается (409), чтобы
+# начисление не прошло дважды.
+
+import asyncio
+import hashlib
+import json
+import time
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+PENDING = object()
+
+
+class IdempotencyError(Exception):
+    def __init__(self, detail, status):
+        super().__init__(detail)
+        self.status = status
+
+
+def _digest(value):
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+def fingerprint(data):
+    """Хеш тела запроса: тот же ключ с другим телом — ошибка клиента."""
+    return _digest(json.dumps(data, sort_keys=True, default=str))
+
+
+def request_key(request):
+    """Значение заголовка или None; слишком длинное — IdempotencyError."""
+    key = request.headers.get(HEADER, "").strip()
+    if len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f"{HEADER} длиннее {MAX_KEY_LENGTH} символов", 400)
+    return key or None
+
+
+def _lookup(user_id, scope, key, body_fingerprint):
+    """Один SELECT: None — ключа нет (или он устарел), PENDING — первый запрос
+    ещё выполняется, иначе (тело, статус) сохранённого ответа."""
+    row = (
+        IdempotencyKey.objects.filter(user_id=user_id, scope=scope, key=key)
+        .values_list("pk", "fingerprint", "status_code", "response_body", "created_at", "expires_at")
+        .first()
+    )
+    if row is None:
+        return None
+    pk, stored_fingerprint, status, body, created_at, expires_at = row
+    now = timezone.now()
+    pending_timeout = timedelta(seconds=getattr(settings, "LOYALTY_IDEMPOTENCY_PENDING_TIMEOUT_SECONDS", 60))
+    if expires_at <= now or (status is None and created_at + pending_timeout <= now):
+        # Истёк или первый запрос умер, не освободив ключ, — начинаем заново
+        IdempotencyKey.objects.filter(pk=pk, created_at=created_at).delete()
+        return None
+    if stored_fingerprint != body_fingerprint:
+        raise IdempotencyError(f"{HEADER} уже использован с другим запросом", 422)
+    if status is None:
+        return PENDING
+    return body, status
+
+
+def _claim(user_id, scope, key, body_fingerprint):
+    """Занять ключ; None — его только что занял параллельный запрос."""
+    ttl = getattr(settings, "LOYALTY_IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60)
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                user_id=user_id, scope=scope, key=key, fingerprint=body_fingerprint,
+                expires_at=timezone.now() + timedelta(seconds=ttl),
+            ).pk
+    except IntegrityError:
+        return None
+
+
+def _run(record_id, handler):
+    """Выполнить handler() -> (тело, статус) и сохранить ответ в той же транзакции.
+    Строки ключа уже нет (её перехватил повтор после таймаута) — откат и 409."""
+    try:
+        with transaction.atomic():
+            body, status = handler()
+            if status < 500:
+                if not IdempotencyKey.objects.filter(pk=record_id).update(status_code=status, response_body=body):
+                    raise IdempotencyError("Запрос с этим ключом выполнен повторно, результат отменён", 409)
+                return body, status
+    except BaseException:
+        IdempotencyKey.objects.filter(pk=record_id).delete()
+        raise
+    IdempotencyKey.objects.filter(pk=record_id).delete()
+    return body, status
+
+
+def _deadline():
+    return time.monotonic() + getattr(settings, "LOYALTY_IDEMPOTENCY_WAIT_SECONDS", 10)
+
+
+def _still_running():
+    return IdempotencyError("Запрос с этим ключом ещё выполняется, повторите позже", 409)
+
+
+def call(user_id, scope, raw_key, data, handler):
+    """Выполнить handler() не больше одного раза на ключ. Возвращает
+    (тело, статус, повтор ли это); ошибки ключа — IdempotencyError."""
+    key, body_fingerprint = _digest(raw_key), fingerprint(data)
+    deadline, delay = _deadline(), 0.02
+    while True:
+        state = _lookup(user_id, scope, key, body_fingerprint)
+        if state is None:
+            record_id = _claim(user_id, scope, key, body_fingerprint)
+            if record_id is not None:
+                return (*_run(record_id, handler), False)
+            continue  # ключ занял параллельный запрос — смотрим его состояние
+        if state is not PENDING:
+            return (*state, True)
+        if time.monotonic() >= deadline:
+            raise _still_running()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+async def acall(user_id, scope, raw_key, data, handler):
+    """call() для async-вьюх: ожидание — asyncio.sleep, не занимая поток."""
+    key, body_fingerprint = _digest(raw_key), fingerprint(data)
+    deadline, delay = _deadline(), 0.02
+    while True:
+        state = await sync_to_async(_lookup)(user_id, scope, key, body_fingerprint)
+        if state is None:
+            record_id = await sync_to_async(_claim)(user_id, scope, key, body_fingerprint)
+            if record_id is not None:
+                return (*await sync_to_async(_run)(record_id, handler), False)
+            continue
+        if state is not PENDING:
+            return (*state, True)
+        if time.monotonic() >= deadline:
+            raise _still_running()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def idempotent(scope):
+    """Декоратор post() у APIView: с заголовком Idempotency-Key ответ
+    запоминается и повторяется; без заголовка — обычный вызов."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            try:
+                raw_key = request_key(request)
+                if raw_key is None:
+                    return method(view, request, *args, **kwargs)
+
+                def handler():
+                    response = method(view, request, *args, **kwargs)
+                    return response.data, response.status_code
+
+                body, status, replayed = call(request.user.id, scope, raw_key, request.data, handler)
+            except IdempotencyError as e:
+                return Response({"detail": str(e)}, status=e.status)
+            response = Response(body, status=status)
+            if replayed:
+                response[REPLAYED_HEADER] = "true"
+            return response
+        return wrapper
+    return decorator
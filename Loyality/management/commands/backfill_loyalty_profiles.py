@@ -0,0 +1,33 @@
+# Loyality/management/commands/backfill_loyalty_profiles.py
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from Loyality.models import LoyaltyProfile
+
+
+class Command(BaseCommand):
+    help = "Создать LoyaltyProfile всем пользователям, у которых его ещё нет (разовая миграция данных)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        batch_size = options["batch_size"]
+        created = 0
+        last_id = 0
+        while True:
+            ids = list(
+                User.objects.filter(id__gt=last_id, loyalty_profile__isnull=True)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            LoyaltyProfile.objects.bulk_create(
+                [LoyaltyProfile(user_id=user_id) for user_id in ids],
+                ignore_conflicts=True,
+            )
+            created += len(ids)
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS(f"Создано профилей: {created}"))
@@ -0,0 +1,40 @@
+# Loyality/management/commands/backfill_user_keys.py
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from Loyality.models import normalize_name, normalize_phone, normalize_username
+
+KEY_FIELDS = ["username_key", "name_key", "phone_key", "phone_key_reversed"]
+
+
+class Command(BaseCommand):
+    help = "Заполнить ключи поиска (username_key, name_key, phone_key, phone_key_reversed) у существующих пользователей (разовая миграция данных)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        batch_size = options["batch_size"]
+        updated = 0
+        last_id = 0
+        while True:
+            users = list(
+                User.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .only("id", "username", "name", "phone", *KEY_FIELDS)[:batch_size]
+            )
+            if not users:
+                break
+            stale = []
+            for user in users:
+                phone_key = normalize_phone(user.phone)
+                keys = (normalize_username(user.username), normalize_name(user.name), phone_key, phone_key[::-1])
+                if tuple(getattr(user, field) for field in KEY_FIELDS) != keys:
+                    for field, value in zip(KEY_FIELDS, keys):
+                        setattr(user, field, value)
+                    stale.append(user)
+            User.objects.bulk_update(stale, KEY_FIELDS)
+            updated += len(stale)
+            last_id = users[-1].id
+        self.stdout.write(self.style.SUCCESS(f"Обновлено пользователей: {updated}"))
@@ -0,0 +1,117 @@
+# Loyality/management/commands/benchmark_async_views.py
+import asyncio
+import itertools
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncRequestFactory, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from Loyality import async_views, views
+from Loyality.authentication import LoyaltyRefreshToken
+from Loyality.models import LoyaltyCode, LoyaltyProfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнить пропускную способность sync- и async-вариантов горячих эндпоинтов "
+        "(me, статус, выдача и погашение кода) в модели исполнения ASGI. Работает "
+        "на временной тестовой БД, троттлинг на время замера выключен."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        # Замеряем вьюхи, а не троттлы: погашение тысяч кодов одним баристой упёрлось бы в лимит
+        no_throttling = override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {}})
+        no_throttling.enable()
+        try:
+            User = get_user_model()
+            customer = User.objects.create_user(username="bench_customer", password="bench-password")
+            barista = User.objects.create_user(username="bench_barista", password="bench-password", is_staff=True)
+            LoyaltyProfile.objects.create(user=customer)
+            as_barista = {"Authorization": f"Bearer {LoyaltyRefreshToken.for_user(barista).access_token}"}
+            as_customer = {"Authorization": f"Bearer {LoyaltyRefreshToken.for_user(customer).access_token}"}
+            factory = AsyncRequestFactory()
+            self._clients = itertools.count()
+
+            def constant(make_request):
+                return lambda total: make_request
+
+            def fresh_codes(total):
+                # Каждому запросу — свой непогашенный код своего клиента
+                codes = iter(self._issue_codes(total))
+                return lambda: factory.post(
+                    "/api/loyalty/redeem-code/", {"code": next(codes)},
+                    content_type="application/json", headers=as_barista,
+                )
+
+            endpoints = [
+                ("me", constant(lambda: factory.get("/api/me/", headers=as_barista)),
+                 views.me, async_views.me),
+                ("loyalty-status",
+                 constant(lambda: factory.get("/api/loyalty/status/", {"username": customer.username},
+                                              headers=as_barista)),
+                 views.get_loyalty_status, async_views.get_loyalty_status),
+                ("generate-code",
+                 constant(lambda: factory.post("/api/loyalty/generate-code/", headers=as_customer)),
+                 views.GenerateLoyaltyCodeView.as_view(), async_views.generate_loyalty_code),
+                ("redeem-code", fresh_codes,
+                 views.RedeemLoyaltyCodeView.as_view(), async_views.redeem_loyalty_code),
+            ]
+            self.stdout.write(f"{'эндпоинт':<16} {'параллельно':>11} {'sync rps':>10} {'async rps':>10}")
+            total = options["requests"]
+            for name, prepare, sync_view, async_view in endpoints:
+                for concurrency in options["concurrency"]:
+                    sync_rps = asyncio.run(self._run(self._call_sync(sync_view), prepare(total), total, concurrency))
+                    async_rps = asyncio.run(self._run(async_view, prepare(total), total, concurrency))
+                    self.stdout.write(f"{name:<16} {concurrency:>11} {sync_rps:>10.0f} {async_rps:>10.0f}")
+        finally:
+            no_throttling.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _issue_codes(self, count):
+        User = get_user_model()
+        numbers = [next(self._clients) for _ in range(count)]
+        users = User.objects.bulk_create([User(username=f"bench_client_{n}", password="!") for n in numbers])
+        if users and users[0].pk is None:
+            users = User.objects.filter(username__in=[user.username for user in users]).only("id")
+        LoyaltyProfile.objects.bulk_create([LoyaltyProfile(user_id=user.pk) for user in users])
+        expires_at = timezone.now() + timedelta(hours=1)
+        LoyaltyCode.objects.bulk_create([
+            LoyaltyCode(user_id=user.pk, code=f"{n:08d}", expires_at=expires_at) for n, user in zip(numbers, users)
+        ])
+        return [f"{n:08d}" for n in numbers]
+
+    @staticmethod
+    def _call_sync(view):
+        # Так Django вызывает синхронную вьюху под ASGI: в общем потоке (thread_sensitive)
+        def render(request):
+            response = view(request)
+            return response.render() if hasattr(response, "render") else response
+        return sync_to_async(render)
+
+    @staticmethod
+    async def _run(view, make_request, total, concurrency):
+        remaining = iter(range(total))
+
+        async def worker():
+            for _ in remaining:
+                response = await view(make_request())
+                if response.status_code != 200:
+                    raise RuntimeError(f"Неожиданный ответ {response.status_code}: {response.content[:200]!r}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return total / (time.perf_counter() - started)
@@ -0,0 +1,117 @@
+# Loyality/management/commands/benchmark_codes.py
+import secrets
+import statistics
+import string
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from Loyality.codes import CodeAllocator, issue_code, offline_sync_window
+from Loyality.models import LoyaltyCode, LoyaltyCodeSequence
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнить задержку выдачи кода при разной занятости пространства кодов: "
+        "старый перебор с exists() против issue_code() с CodeAllocator (резерв "
+        "блоков, INSERT, освобождение истёкших и давно погашенных кодов после "
+        "оборота). Работает на временной тестовой БД."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--length", type=int, default=5, help="Длина кода (пространство 10**length)")
+        parser.add_argument("--samples", type=int, default=2000)
+        parser.add_argument("--occupancy", type=float, nargs="+", default=[0.1, 0.5, 0.9])
+
+    def handle(self, *args, **options):
+        length, samples = options["length"], options["samples"]
+        size = 10 ** length
+        block_size = getattr(settings, "LOYALTY_CODE_BLOCK_SIZE", 64)
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = get_user_model().objects.create_user(username="benchmark", password=None)
+            self.stdout.write(f"Пространство кодов: {size}, блок: {block_size}")
+            self.stdout.write(f"{'занятость':>9}  {'стратегия':<20} {'запросов/код':>12} "
+                              f"{'p50 мкс':>9} {'p90 мкс':>9} {'p99 мкс':>9}")
+
+            for occupancy in options["occupancy"]:
+                live_count = int(size * occupancy)
+                if live_count + samples > size:
+                    self.stderr.write(f"Пропуск {occupancy:.0%}: занятые + samples больше пространства кодов")
+                    continue
+                allocator = CodeAllocator(length=length, block_size=block_size)
+
+                # Занятые коды — последние live_count выдач аллокатора, ещё живые
+                self._occupy(user, allocator, live_count, expired=False)
+                self._row(occupancy, "перебор", *self._measure(lambda: self._legacy_issue(user, length), samples))
+                self._occupy(user, allocator, live_count, expired=False)
+                self._row(occupancy, "issue_code", *self._measure(
+                    lambda: issue_code(user.id, allocator=allocator), samples))
+
+                # После оборота последовательности: номера снова идут по тем же
+                # кодам, но прошлые коды давно истекли — непогашенный освобождается
+                # DELETE, у погашенного обнуляется code
+                for name, redeemed_share in (("после оборота", 0), ("оборот, 50% погаш.", 0.5)):
+                    self._occupy(user, allocator, live_count, expired=True, redeemed_share=redeemed_share)
+                    LoyaltyCodeSequence.objects.filter(pk=1).update(value=0)
+                    allocator = CodeAllocator(length=length, block_size=block_size)
+                    self._row(occupancy, name, *self._measure(
+                        lambda: issue_code(user.id, allocator=allocator), samples))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    @staticmethod
+    def _occupy(user, allocator, count, expired, redeemed_share=0, batch_size=5000):
+        LoyaltyCode.objects.all().delete()
+        now = timezone.now()
+        expires_at = now - offline_sync_window() - timedelta(minutes=1) if expired else now + timedelta(days=1)
+        redeemed_every = round(1 / redeemed_share) if redeemed_share else 0
+        for start in range(0, count, batch_size):
+            rows = []
+            for i in range(start, min(start + batch_size, count)):
+                redeemed = bool(redeemed_every) and i % redeemed_every == 0
+                rows.append(LoyaltyCode(user=user, code=allocator.permutation(i), expires_at=expires_at,
+                                        redeemed=redeemed, redeemed_at=expires_at if redeemed else None))
+            LoyaltyCode.objects.bulk_create(rows)
+        LoyaltyCodeSequence.objects.update_or_create(pk=1, defaults={"value": count})
+
+    @staticmethod
+    def _legacy_issue(user, length):
+        # Генерация до перехода на CodeAllocator: случайный код + exists() до свободного
+        while True:
+            code = "".join(secrets.choice(string.digits) for _ in range(length))
+            if not LoyaltyCode.objects.filter(code=code).exists():
+                return LoyaltyCode.objects.create(user=user, code=code, expires_at=timezone.now() + timedelta(days=1))
+
+    @staticmethod
+    def _measure(issue, samples):
+        timings, queries = [], 0
+
+        def count_query(execute, *args):
+            nonlocal queries
+            queries += 1
+            return execute(*args)
+
+        with connection.execute_wrapper(count_query):
+            for _ in range(samples):
+                started = time.perf_counter()
+                issue()
+                timings.append(time.perf_counter() - started)
+        return queries / samples, timings
+
+    def _row(self, occupancy, name, queries, timings):
+        q = statistics.quantiles(timings, n=100)
+        self.stdout.write(
+            f"{occupancy:>9.0%}  {name:<20} {queries:>12.2f} "
+            f"{q[49] * 1e6:>9.1f} {q[89] * 1e6:>9.1f} {q[98] * 1e6:>9.1f}"
+        )
+
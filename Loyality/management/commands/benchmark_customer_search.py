@@ -0,0 +1,107 @@
+# Loyality/management/commands/benchmark_customer_search.py
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from Loyality.models import LoyaltyProfile
+from Loyality.search import search_customers
+
+FIRST_NAMES = ["Анна", "Мария", "Елена", "Ольга", "Иван", "Пётр", "Алексей", "Дмитрий", "Сергей", "Наталья",
+               "Артём", "Юлия", "Ксения", "Михаил", "Андрей", "Татьяна", "Егор", "Софья", "Никита", "Алёна"]
+LAST_NAMES = ["Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов",
+              "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Замерить поиск клиента (/api/loyalty/search/) на синтетической базе: "
+        "префиксные запросы по индексированным ключам против __icontains по "
+        "исходным полям. Работает на временной тестовой БД."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customers", type=int, default=500_000)
+        parser.add_argument("--queries", type=int, default=200, help="Запросов на каждый вид поиска")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            started = time.perf_counter()
+            customers = self._populate(options["customers"], rng)
+            self.stdout.write(f"Создано клиентов: {options['customers']} за {time.perf_counter() - started:.1f} с")
+
+            samples = [rng.choice(customers) for _ in range(options["queries"])]
+            kinds = {
+                "логин (3 симв.)": [username[:3] for username, _, _ in samples],
+                "логин (6 симв.)": [username[:6] for username, _, _ in samples],
+                "имя (4 симв.)": [name[:4] for _, name, _ in samples],
+                "телефон (начало)": [phone[:7] for _, _, phone in samples],
+                "последние 4 цифры": [phone[-4:] for _, _, phone in samples],
+            }
+            self.stdout.write(f"{'запрос':<20} {'p50, мс':>9} {'p95, мс':>9} {'max, мс':>9} {'icontains p50':>14}")
+            for label, queries in kinds.items():
+                indexed = self._timings(search_customers, queries)
+                naive = self._timings(self._naive_search, queries[:10])
+                self.stdout.write(
+                    f"{label:<20} {indexed['p50']:>9.2f} {indexed['p95']:>9.2f} "
+                    f"{indexed['max']:>9.2f} {naive['p50']:>14.2f}"
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    @staticmethod
+    def _populate(count, rng, batch_size=5000):
+        # bulk_create обходит User.save(), поэтому ключи поиска заполняем сами
+        User = get_user_model()
+        customers = []
+        for start in range(0, count, batch_size):
+            users = []
+            for i in range(start, min(start + batch_size, count)):
+                username = f"{rng.choice(LAST_NAMES).lower()}{i}"
+                name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+                phone = f"+7 9{rng.randrange(10**9):09d}"
+                user = User(username=username, name=name, phone=phone, password="!")
+                user.set_lookup_keys()
+                users.append(user)
+                customers.append((username, name, user.phone_key))
+            with transaction.atomic():
+                created = User.objects.bulk_create(users)
+                if created[0].pk is None:
+                    created = User.objects.filter(username__in=[user.username for user in users]).only("id")
+                LoyaltyProfile.objects.bulk_create(
+                    [LoyaltyProfile(user_id=user.pk, stamps=rng.randrange(7)) for user in created]
+                )
+        return customers
+
+    @staticmethod
+    def _naive_search(query, limit=10):
+        # Как искали бы без ключей: регистронезависимый LIKE '%q%' по трём полям
+        return list(
+            get_user_model().objects
+            .filter(Q(username__icontains=query) | Q(name__icontains=query) | Q(phone__icontains=query))
+            .values("id", "username", "name", "phone", "loyalty_profile__stamps")[:limit]
+        )
+
+    @staticmethod
+    def _timings(search, queries):
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            search(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return {
+            "p50": statistics.median(timings),
+            "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            "max": timings[-1],
+        }
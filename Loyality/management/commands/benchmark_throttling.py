@@ -0,0 +1,85 @@
+# Loyality/management/commands/benchmark_throttling.py
+import itertools
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.test import APIRequestFactory
+
+from Loyality.views import barista_login_with_code
+
+
+class Command(BaseCommand):
+    help = (
+        "Смоделировать подбор пароля на /api/barista/login-with-code/ и показать, "
+        "сколько времени воркера остаётся обычным входам без троттлинга и с ним. "
+        "Работает на временной тестовой БД с настоящим хешером паролей."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--logins", type=int, default=10, help="Обычных входов")
+        parser.add_argument("--attack-ratio", type=int, default=20, help="Попыток атакующего на один обычный вход")
+        parser.add_argument("--attacker-ips", type=int, default=50, help="Сколько адресов у атакующего")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            User = get_user_model()
+            User.objects.create_user(username="bench_victim", password="victim-password", is_staff=True)
+            User.objects.create_user(username="bench_barista", password="bench-password", is_staff=True)
+            code = (getattr(settings, "BARISTA_MASTER_CODES", []) or [getattr(settings, "BARISTA_MASTER_CODE", "555")])[0]
+
+            off = {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {}}
+            self.stdout.write(f"{'троттлинг':<10} {'входов/с':>9} {'доля CPU входам':>16} {'отклонено атак':>15} {'429 у своих':>12}")
+            for label, rest_framework in (("выкл", off), ("вкл", settings.REST_FRAMEWORK)):
+                with override_settings(REST_FRAMEWORK=rest_framework):
+                    caches[getattr(settings, "LOYALTY_THROTTLE_CACHE_ALIAS", "default")].clear()
+                    result = self._simulate(code, **options)
+                self.stdout.write(
+                    f"{label:<10} {result['rps']:>9.2f} {result['share']:>15.0%} "
+                    f"{result['rejected']:>15} {result['legit_throttled']:>12}"
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    @staticmethod
+    def _simulate(code, logins, attack_ratio, attacker_ips, **options):
+        # Один воркер обслуживает запросы по очереди: время атакующего — это
+        # время, которое не досталось обычным входам
+        factory = APIRequestFactory()
+        ips = itertools.cycle(f"10.1.{i // 256}.{i % 256}" for i in range(attacker_ips))
+        legit_time = attack_time = 0.0
+        rejected = legit_throttled = 0
+
+        for i in range(logins):
+            for j in range(attack_ratio):
+                request = factory.post("/api/barista/login-with-code/", {
+                    "username": "bench_victim", "password": f"guess-{i}-{j}", "employee_code": code,
+                }, format="json", REMOTE_ADDR=next(ips))
+                started = time.perf_counter()
+                response = barista_login_with_code(request)
+                attack_time += time.perf_counter() - started
+                rejected += response.status_code == 429
+
+            request = factory.post("/api/barista/login-with-code/", {
+                "username": "bench_barista", "password": "bench-password", "employee_code": code,
+            }, format="json", REMOTE_ADDR="192.168.0.10")
+            started = time.perf_counter()
+            response = barista_login_with_code(request)
+            legit_time += time.perf_counter() - started
+            legit_throttled += response.status_code == 429
+
+        total = legit_time + attack_time
+        return {
+            "rps": logins / total,
+            "share": legit_time / total,
+            "rejected": rejected,
+            "legit_throttled": legit_throttled,
+        }
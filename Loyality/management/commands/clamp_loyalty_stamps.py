@@ -0,0 +1,41 @@
+# Loyality/management/commands/clamp_loyalty_stamps.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from Loyality.models import LoyaltyProfile
+from Loyality.signals import notify_profile_changed
+
+
+class Command(BaseCommand):
+    help = (
+        "Урезать штампы выше LOYALTY_MAX_STAMPS до лимита (разовая миграция данных: "
+        "старое погашение кода лимит не проверяло, а без этого ограничение "
+        "loyaltyprofile_stamps_max не применится). Запускать перед migrate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+        batch_size = options["batch_size"]
+        clamped = 0
+        last_id = 0
+        while True:
+            rows = list(
+                LoyaltyProfile.objects.filter(id__gt=last_id, stamps__gt=max_stamps)
+                .order_by("id")
+                .values_list("id", "user_id")[:batch_size]
+            )
+            if not rows:
+                break
+            with transaction.atomic():
+                clamped += LoyaltyProfile.objects.filter(
+                    id__in=[pk for pk, _ in rows], stamps__gt=max_stamps,
+                ).update(stamps=max_stamps, updated_at=timezone.now())
+                for _, user_id in rows:
+                    notify_profile_changed(LoyaltyProfile, user_id)
+            last_id = rows[-1][0]
+        self.stdout.write(self.style.SUCCESS(f"Урезано профилей: {clamped}"))
@@ -0,0 +1,70 @@
+# Loyality/management/commands/compact_loyalty_stamps.py
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Loyality.models import LoyaltyStamp
+
+
+class Command(BaseCommand):
+    help = (
+        "Свернуть старые записи \"один штамп = одна строка\" в строки с quantity: "
+        "подряд идущие (по id) записи одного клиента, баристы и источника, созданные "
+        "в пределах --window секунд, объединяются в первую. Суммы штампов не меняются."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--window", type=float, default=1.0, help="Окно одного начисления, сек")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true", help="Только посчитать")
+
+    def handle(self, *args, **options):
+        window = timedelta(seconds=options["window"])
+        batch_size = options["batch_size"]
+        dry_run = options["dry_run"]
+
+        last_id = 0
+        group = None
+        groups = rows_removed = 0
+        while True:
+            rows = list(
+                LoyaltyStamp.objects.filter(id__gt=last_id).order_by("id")
+                .values_list("id", "user_id", "created_by_id", "source", "quantity", "created_at")[:batch_size]
+            )
+            if not rows:
+                break
+
+            closed = []
+            for pk, user_id, created_by_id, source, quantity, created_at in rows:
+                key = (user_id, created_by_id, source)
+                if group is not None and group["key"] == key and created_at - group["start"] <= window:
+                    group["quantity"] += quantity
+                    group["merged"].append(pk)
+                    continue
+                if group is not None and group["merged"]:
+                    closed.append(group)
+                group = {"key": key, "start": created_at, "id": pk, "quantity": quantity, "merged": []}
+            last_id = rows[-1][0]
+
+            groups += len(closed)
+            rows_removed += self._apply(closed, dry_run)
+
+        if group is not None and group["merged"]:
+            groups += 1
+            rows_removed += self._apply([group], dry_run)
+
+        verb = "Будет удалено" if dry_run else "Удалено"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {rows_removed} строк, свёрнуто начислений: {groups}"))
+
+    @staticmethod
+    def _apply(groups, dry_run):
+        removed = sum(len(group["merged"]) for group in groups)
+        if dry_run or not groups:
+            return removed
+        # Каждая пачка — своя короткая транзакция, как в Loyality/sweeper.py
+        with transaction.atomic():
+            for group in groups:
+                LoyaltyStamp.objects.filter(pk=group["id"]).update(quantity=group["quantity"])
+            LoyaltyStamp.objects.filter(pk__in=[pk for group in groups for pk in group["merged"]]).delete()
+        return removed
@@ -0,0 +1,58 @@
+# Loyality/management/commands/export_loyalty.py
+import sys
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Loyality.export import EXPORTS, FORMATS, date_range, export_rows, stream_export
+
+
+class Command(BaseCommand):
+    help = (
+        "Выгрузить штампы или погашенные коды для бухгалтерии в CSV/NDJSON "
+        "(то же, что /api/loyalty/export/). Строки читаются пачками, память не "
+        "растёт с объёмом выгрузки."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kind", choices=list(EXPORTS), default="stamps")
+        parser.add_argument("--format", choices=list(FORMATS), default="csv")
+        parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="ГГГГ-ММ-ДД, включительно")
+        parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="ГГГГ-ММ-ДД, включительно")
+        parser.add_argument("--barista", type=int, help="id баристы")
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("--chunk-size", type=int, default=None)
+        parser.add_argument("--output", "-o", default="-", help="Файл; по умолчанию stdout")
+
+    def handle(self, *args, **options):
+        since, until = date_range(options["date_from"], options["date_to"])
+        counted = [0]
+
+        def rows():
+            for row in export_rows(options["kind"], since=since, until=until,
+                                   barista_id=options["barista"], chunk_size=options["chunk_size"]):
+                counted[0] += 1
+                yield row
+
+        started = time.perf_counter()
+        chunks = stream_export(options["kind"], options["format"], rows(), gzip=options["gzip"])
+        if options["output"] == "-":
+            self._write(sys.stdout.buffer, chunks)
+        else:
+            try:
+                with open(options["output"], "wb") as output:
+                    self._write(output, chunks)
+            except OSError as exc:
+                raise CommandError(exc)
+
+        elapsed = time.perf_counter() - started
+        self.stderr.write(self.style.SUCCESS(
+            f"Выгружено строк: {counted[0]} за {elapsed:.1f} с ({counted[0] / max(elapsed, 1e-9):.0f} строк/с)"
+        ))
+
+    @staticmethod
+    def _write(output, chunks):
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
@@ -0,0 +1,217 @@
+# Loyality/management/commands/import_customers.py
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from Loyality.models import LoyaltyProfile, normalize_username
+
+READ_SIZE = 64 * 1024
+
+
+def _init_worker():
+    # При запуске процессов через spawn (macOS, Windows) Django нужно поднять заново
+    django.setup()
+
+
+def _hash_password(password):
+    return make_password(password)
+
+
+def _iter_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _iter_json(stream):
+    """Массив объектов или JSON Lines — без чтения файла целиком."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig")
+    decoder = json.JSONDecoder()
+    buffer, pos, number = "", 0, 0
+    in_array = None
+    while True:
+        chunk = text.read(READ_SIZE)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","
+                                         or (in_array and buffer[pos] == "]")):
+                pos += 1
+            if pos < len(buffer) and in_array is None:
+                in_array = buffer[pos] == "["
+                pos += in_array
+                continue
+            if pos >= len(buffer):
+                break
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise CommandError(f"Неверный JSON после записи {number}")
+                break  # объект не дочитан — нужен следующий кусок
+            pos = end
+            number += 1
+            yield number, value
+        if not chunk:
+            return
+
+
+class Command(BaseCommand):
+    help = (
+        "Импортировать клиентов из CSV или JSON (массив или JSON Lines) потоком. "
+        "Колонки: username (обязательно), password, name, phone, stamps. Пароли "
+        "хешируются в пуле процессов, пользователи и профили вставляются пачками "
+        "bulk_create. Ошибочные строки пропускаются и выводятся в конце."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Файл или - для stdin")
+        parser.add_argument("--format", choices=["csv", "json"], help="По умолчанию — по расширению файла")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Процессов для хеширования")
+        parser.add_argument("--dry-run", action="store_true", help="Только проверить строки")
+
+    def handle(self, *args, **options):
+        fmt = options["format"] or ("json" if options["path"].endswith((".json", ".jsonl", ".ndjson")) else "csv")
+        self.max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+        self.errors = []
+        self.imported = 0
+        self.seen = set()
+
+        if options["path"] == "-":
+            stream = sys.stdin.buffer
+        else:
+            try:
+                stream = open(options["path"], "rb")
+            except OSError as exc:
+                raise CommandError(exc)
+
+        started = time.perf_counter()
+        with stream, ProcessPoolExecutor(max_workers=options["workers"], initializer=_init_worker) as pool:
+            rows = _iter_json(stream) if fmt == "json" else _iter_csv(stream)
+            pending = None
+            for batch in self._batches(rows, options["batch_size"]):
+                if options["dry_run"]:
+                    self.imported += len(batch)
+                    continue
+                # Пока пул хеширует эту пачку, вставляем предыдущую
+                passwords = [row["password"] for row in batch if row["password"]]
+                chunksize = max(1, len(passwords) // (options["workers"] * 4))
+                hashes = pool.map(_hash_password, passwords, chunksize=chunksize)
+                if pending is not None:
+                    self._insert(*pending)
+                pending = (batch, hashes)
+            if pending is not None:
+                self._insert(*pending)
+        elapsed = time.perf_counter() - started
+
+        for number, message in sorted(self.errors):
+            self.stderr.write(f"запись {number}: {message}")
+        verb = "Проверено" if options["dry_run"] else "Импортировано"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb}: {self.imported}, ошибок: {len(self.errors)}, "
+            f"{(self.imported + len(self.errors)) / max(elapsed, 1e-9):.0f} строк/с"
+        ))
+
+    def _batches(self, rows, batch_size):
+        """Пачки проверенных строк; логины, уже занятые в БД, отсеиваются здесь."""
+        User = get_user_model()
+        batch = []
+        for number, raw in rows:
+            row = self._clean(number, raw)
+            if row is not None:
+                batch.append(row)
+            if len(batch) >= batch_size:
+                yield self._drop_existing(User, batch)
+                batch = []
+        if batch:
+            yield self._drop_existing(User, batch)
+
+    def _clean(self, number, raw):
+        if not isinstance(raw, dict):
+            self.errors.append((number, "ожидался объект"))
+            return None
+        username = str(raw.get("username") or "").strip()
+        try:
+            if not username:
+                raise ValidationError("нет username")
+            get_user_model().username_validator(username)
+            if len(username) > 150:
+                raise ValidationError("username длиннее 150 символов")
+            stamps = int(raw.get("stamps") or 0)
+            if not 0 <= stamps <= self.max_stamps:
+                raise ValidationError(f"stamps вне 0..{self.max_stamps}")
+        except (ValidationError, TypeError, ValueError) as exc:
+            message = "; ".join(exc.messages) if isinstance(exc, ValidationError) else "stamps — целое число"
+            self.errors.append((number, message))
+            return None
+
+        key = normalize_username(username)
+        if key in self.seen:
+            self.errors.append((number, f"{username}: повтор в файле"))
+            return None
+        self.seen.add(key)
+        return {
+            "number": number,
+            "username": username,
+            "password": str(raw.get("password") or ""),
+            "name": str(raw.get("name") or "").strip()[:255],
+            "phone": str(raw.get("phone") or "").strip()[:32],
+            "stamps": stamps,
+            "key": key,
+        }
+
+    def _drop_existing(self, User, batch):
+        taken = set(User.objects.filter(username_key__in=[row["key"] for row in batch])
+                    .values_list("username_key", flat=True))
+        for row in batch:
+            if row["key"] in taken:
+                self.errors.append((row["number"], f"{row['username']}: пользователь уже есть"))
+        return [row for row in batch if row["key"] not in taken]
+
+    def _insert(self, batch, hashes):
+        User = get_user_model()
+        hashes = iter(hashes)
+        users = []
+        for row in batch:
+            # Без пароля — непригодный: войти можно будет после сброса
+            password = next(hashes) if row["password"] else make_password(None)
+            user = User(username=row["username"], password=password, name=row["name"], phone=row["phone"])
+            user.set_lookup_keys()  # bulk_create не вызывает save()
+            users.append(user)
+        try:
+            with transaction.atomic():
+                self._create(User, users, batch)
+        except IntegrityError:
+            # Логин заняли параллельно — вставляем по одной, чтобы найти виноватых
+            for user, row in zip(users, batch):
+                user.pk = None
+                try:
+                    with transaction.atomic():
+                        self._create(User, [user], [row])
+                except IntegrityError:
+                    self.errors.append((row["number"], f"{row['username']}: пользователь уже есть"))
+
+    def _create(self, User, users, batch):
+        created = User.objects.bulk_create(users)
+        if created and created[0].pk is None:  # бэкенд без RETURNING
+            ids = dict(User.objects.filter(username__in=[user.username for user in users])
+                       .values_list("username", "id"))
+            for user in created:
+                user.pk = ids[user.username]
+        LoyaltyProfile.objects.bulk_create(
+            [LoyaltyProfile(user_id=user.pk, stamps=row["stamps"]) for user, row in zip(created, batch)]
+        )
+        self.imported += len(created)
@@ -0,0 +1,90 @@
+# Loyality/management/commands/rebuild_barista_stats.py
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from Loyality import signed_codes
+from Loyality.models import BaristaDailyStats, LoyaltyCode, LoyaltyStamp, RedeemedSignedCode
+
+
+def _codes_rebuildable_since():
+    """С какого дня codes_activated можно пересчитать из исходных строк.
+
+    Подписанные коды принимаются в любом LOYALTY_CODE_MODE, а их отметки
+    очистка удаляет через signed_codes.max_lifetime() после погашения — день,
+    на который пришлась эта граница, и более ранние уже неполные. Погашенные
+    LoyaltyCode удаляются по LOYALTY_REDEEMED_CODE_RETENTION_DAYS — дни до
+    этого срока тоже.
+    """
+    since = timezone.localdate(timezone.now() - signed_codes.max_lifetime()) + timedelta(days=1)
+    retention_days = getattr(settings, "LOYALTY_REDEEMED_CODE_RETENTION_DAYS", None)
+    if retention_days is not None:
+        since = max(since, timezone.localdate() - timedelta(days=retention_days - 1))
+    return since
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересобрать дневные итоги барист (BaristaDailyStats) из LoyaltyCode, "
+        "RedeemedSignedCode и LoyaltyStamp. stamps_given пересчитывается всегда; "
+        "codes_activated — только за дни, чьи строки очистка кодов ещё не удаляла "
+        "(за остальные дни прежние значения сохраняются)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="Только последние N дней (по умолчанию — все)")
+
+    def handle(self, *args, **options):
+        since = None
+        if options["days"] is not None:
+            since = timezone.localdate() - timedelta(days=options["days"] - 1)
+        codes_since = _codes_rebuildable_since()
+
+        totals = defaultdict(lambda: {"codes_activated": 0, "stamps_given": 0})
+        sources = (
+            (LoyaltyCode.objects.filter(redeemed=True), "redeemed_by", "redeemed_at", Count("pk"), "codes_activated"),
+            (RedeemedSignedCode.objects.all(), "redeemed_by", "redeemed_at", Count("pk"), "codes_activated"),
+            (LoyaltyStamp.objects.all(), "created_by", "created_at", Sum("quantity"), "stamps_given"),
+        )
+        tz = timezone.get_current_timezone()
+        for queryset, barista_field, time_field, total, counter in sources:
+            queryset = queryset.filter(**{f"{barista_field}__isnull": False})
+            rows = (
+                queryset.annotate(day=TruncDate(time_field, tzinfo=tz))
+                .values_list(f"{barista_field}_id", "day")
+                .annotate(n=total)
+            )
+            start = since
+            if counter == "codes_activated":
+                start = codes_since if since is None else max(since, codes_since)
+            if start is not None:
+                rows = rows.filter(day__gte=start)
+            for barista_id, day, n in rows:
+                totals[barista_id, day][counter] += n
+
+        with transaction.atomic():
+            stale = BaristaDailyStats.objects.all()
+            if since is not None:
+                stale = stale.filter(day__gte=since)
+            kept = 0
+            # Коды за эти дни пересчитать не из чего — оставляем то, что насчитали вьюхи
+            for barista_id, day, codes in (stale.filter(day__lt=codes_since, codes_activated__gt=0)
+                                           .values_list("barista_id", "day", "codes_activated")):
+                totals[barista_id, day]["codes_activated"] = codes
+                kept += 1
+            deleted = stale.delete()[0]
+            BaristaDailyStats.objects.bulk_create(
+                [BaristaDailyStats(barista_id=barista_id, day=day, **counters)
+                 for (barista_id, day), counters in totals.items()],
+                batch_size=1000,
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Удалено {deleted} строк, записано {len(totals)}, codes_activated сохранено без пересчёта: {kept}"
+        ))
@@ -0,0 +1,45 @@
+# Loyality/management/commands/sweep_loyalty_codes.py
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from Loyality.sweeper import sweep_codes
+
+
+class Command(BaseCommand):
+    help = (
+        "Удалить истёкшие (и, по сроку хранения, погашенные) коды лояльности "
+        "и истёкшие записи об отозванных токенах и ключах идемпотентности пачками"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=getattr(settings, "LOYALTY_SWEEPER_BATCH_SIZE", 1000))
+        parser.add_argument("--pause", type=float, default=0.05, help="Пауза между пачками, сек")
+        parser.add_argument(
+            "--redeemed-older-than-days", type=int, default=None,
+            help="Удалять и погашенные коды старше N дней (по умолчанию LOYALTY_REDEEMED_CODE_RETENTION_DAYS)",
+        )
+        parser.add_argument("--archive", default=None, help="Дописать удалённые строки в файл (JSON Lines; восстановить — manage.py loaddata)")
+
+    def handle(self, *args, **options):
+        archive = open(options["archive"], "a", encoding="utf-8") if options["archive"] else None
+        started = time.perf_counter()
+        try:
+            removed = sweep_codes(
+                batch_size=options["batch_size"],
+                pause=options["pause"],
+                redeemed_retention_days=options["redeemed_older_than_days"],
+                archive=archive,
+            )
+        finally:
+            if archive is not None:
+                archive.close()
+        elapsed = time.perf_counter() - started
+
+        total = sum(removed.values())
+        for kind, count in removed.items():
+            self.stdout.write(f"{kind}: {count}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Удалено {total} строк за {elapsed:.2f} с ({total / elapsed if elapsed else 0:.0f} строк/с)"
+        ))
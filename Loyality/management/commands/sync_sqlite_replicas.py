@@ -0,0 +1,39 @@
+# Loyality/management/commands/sync_sqlite_replicas.py
+import sqlite3
+import time
+from contextlib import closing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+
+class Command(BaseCommand):
+    help = (
+        "Скопировать основную SQLite-БД в реплики из LOYALTY_REPLICA_DATABASES "
+        "(DJANGO_DB_REPLICAS) — локальная замена репликации. С --interval "
+        "копирует по кругу, и реплика отстаёт, как настоящая."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=None, help="Повторять каждые N секунд")
+
+    def handle(self, *args, **options):
+        aliases = getattr(settings, "LOYALTY_REPLICA_DATABASES", [])
+        if not aliases:
+            raise CommandError("Реплики не настроены: задайте DJANGO_DB_REPLICAS")
+        databases = [settings.DATABASES[alias] for alias in [DEFAULT_DB_ALIAS, *aliases]]
+        if any(database["ENGINE"] != "django.db.backends.sqlite3" for database in databases):
+            raise CommandError("Команда только для SQLite; настоящие реплики обновляет СУБД")
+
+        primary, replicas = str(databases[0]["NAME"]), [str(database["NAME"]) for database in databases[1:]]
+        while True:
+            started = time.perf_counter()
+            with closing(sqlite3.connect(primary)) as source:
+                for path in replicas:
+                    with closing(sqlite3.connect(path)) as target:
+                        source.backup(target)
+            self.stdout.write(f"Реплики обновлены за {(time.perf_counter() - started) * 1000:.0f} мс")
+            if options["interval"] is None:
+                return
+            time.sleep(options["interval"])
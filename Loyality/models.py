@@ -1,8 +1,135 @@
 # backend/loyalty/models.py
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.db.models.functions import Least
 from django.utils import timezone
+from datetime import timedelta
+
+from .signals import notify_profile_changed
+
+
+def _supports_update_returning(connection):
+    return connection.vendor == "postgresql" or (
+        connection.vendor == "sqlite" and connection.features.can_return_columns_from_insert
+    )
+
+
+class LoyaltyProfileQuerySet(models.QuerySet):
+    """Изменение штампов одним условным UPDATE — без get_or_create и refresh_from_db."""
+
+    def _increment(self, user_id, count, max_stamps):
+        # Точное +count, только если влезает в лимит; возвращает новое значение или None
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        stamps = qn(opts.get_field("stamps").column)
+        sql = (
+            f"UPDATE {qn(opts.db_table)} SET {stamps} = {stamps} + %s, {qn(opts.get_field('updated_at').column)} = %s "
+            f"WHERE {qn(opts.get_field('user').column)} = %s AND {stamps} + %s <= %s"
+        )
+        params = [count, connection.ops.adapt_datetimefield_value(timezone.now()), user_id, count, max_stamps]
+
+        if _supports_update_returning(connection):
+            with connection.cursor() as cursor:
+                cursor.execute(sql + f" RETURNING {stamps}", params)
+                row = cursor.fetchone()
+            return row[0] if row else None
+
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if not cursor.rowcount:
+                return None
+            return self.filter(user_id=user_id).values_list("stamps", flat=True).get()
+
+    def add_stamps(self, user_id, count=1, max_stamps=None):
+        """Начислить пользователю до `count` штампов, не выходя за LOYALTY_MAX_STAMPS.
+
+        Обычно это один запрос UPDATE ... WHERE stamps + n <= max RETURNING stamps.
+        Если штампы не влезают целиком, дочитывается текущее значение и
+        начисляется остаток — тем же условным UPDATE, так что лимит соблюдается
+        и при параллельных начислениях. Профиль создаётся, если его ещё нет.
+
+        Возвращает (stamps, added); added == 0 — лимит уже достигнут.
+        """
+        if max_stamps is None:
+            max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+        if count <= 0:
+            return self.filter(user_id=user_id).values_list("stamps", flat=True).first() or 0, 0
+
+        while True:
+            stamps = self._increment(user_id, count, max_stamps)
+            if stamps is not None:
+                notify_profile_changed(self.model, user_id, using=self.db)
+                return stamps, count
+
+            current = self.filter(user_id=user_id).values_list("stamps", flat=True).first()
+            if current is None:
+                added = min(count, max_stamps)
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.create(user_id=user_id, stamps=added)
+                except IntegrityError:
+                    continue  # профиль создал параллельный запрос
+                notify_profile_changed(self.model, user_id, using=self.db)
+                return added, added
+
+            if current >= max_stamps:
+                return current, 0
+            count = min(count, max_stamps - current)
+
+    def add_stamps_many(self, amounts, max_stamps=None):
+        """Начислить штампы нескольким пользователям за раз: {user_id: сколько}.
+
+        Недостающие профили создаются одним INSERT, текущие значения читаются
+        одним SELECT ... FOR UPDATE, начисление — один UPDATE с CASE по user_id
+        (с LEAST до лимита на случай гонки там, где FOR UPDATE не блокирует).
+        Возвращает {user_id: (stamps, added)}.
+        """
+        if max_stamps is None:
+            max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+        amounts = {user_id: count for user_id, count in amounts.items() if count > 0}
+        if not amounts:
+            return {}
+
+        with transaction.atomic(using=self.db):
+            self.bulk_create([self.model(user_id=user_id) for user_id in amounts], ignore_conflicts=True)
+            current = dict(self.select_for_update().filter(user_id__in=amounts).values_list("user_id", "stamps"))
+
+            result, whens = {}, []
+            for user_id, count in amounts.items():
+                added = max(0, min(count, max_stamps - current[user_id]))
+                result[user_id] = (current[user_id] + added, added)
+                if added:
+                    whens.append(models.When(user_id=user_id, then=models.F("stamps") + added))
+
+            if whens:
+                changed = [user_id for user_id, (_, added) in result.items() if added]
+                self.filter(user_id__in=changed).update(
+                    stamps=Least(
+                        models.Case(*whens, default=models.F("stamps"), output_field=models.PositiveIntegerField()),
+                        models.Value(max_stamps),
+                    ),
+                    updated_at=timezone.now(),
+                )
+                for user_id in changed:
+                    notify_profile_changed(self.model, user_id, using=self.db)
+        return result
+
+    def stamps_for(self, user_id):
+        """Штампы пользователя одним SELECT; 0, если профиля нет (ничего не создаёт)."""
+        return self.filter(user_id=user_id).values_list("stamps", flat=True).first() or 0
+
+    def reset_stamps(self, user_id):
+        """Обнулить штампы; возвращает, сколько их было."""
+        while True:
+            current = self.filter(user_id=user_id).values_list("stamps", flat=True).first()
+            if not current:
+                return 0
+            if self.filter(user_id=user_id, stamps=current).update(stamps=0, updated_at=timezone.now()):
+                notify_profile_changed(self.model, user_id, using=self.db)
+                return current
+
 
 class LoyaltyProfile(models.Model):
     user = models.OneToOneField(
@@ -13,25 +140,61 @@ class LoyaltyProfile(models.Model):
     stamps = models.PositiveIntegerField(default=0)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = LoyaltyProfileQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(stamps__lte=getattr(settings, "LOYALTY_MAX_STAMPS", 6)),
+                name="loyaltyprofile_stamps_max",
+            ),
+        ]
+
     def __str__(self):
         return f"{self.user.username} — {self.stamps} штампов"
 
     def add_stamp(self, count=1):
-        max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
-        if self.stamps >= max_stamps:
-            return False
-        self.stamps = min(self.stamps + count, max_stamps)
-        self.save(update_fields=["stamps", "updated_at"])
-        return True
+        self.stamps, added = LoyaltyProfile.objects.add_stamps(self.user_id, count)
+        return added > 0
 
     def reset_stamps(self):
+        before = LoyaltyProfile.objects.reset_stamps(self.user_id)
         self.stamps = 0
-        self.save(update_fields=["stamps", "updated_at"])
+        return before
+
+
+def normalize_username(username):
+    """Ключ логина для поиска без учёта регистра (User.username_key)."""
+    return (username or "").strip().lower()
+
+
+def normalize_name(name):
+    """Ключ имени: нижний регистр, ё → е, одиночные пробелы (User.name_key)."""
+    return " ".join((name or "").lower().replace("ё", "е").split())
+
+
+def normalize_phone(phone):
+    """Ключ телефона: только цифры, российская 8 в начале → 7 (User.phone_key)."""
+    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    return digits
+
+
 class User(AbstractUser):
     name  = models.CharField(max_length=255, blank=True, default="")
     phone = models.CharField(max_length=32, blank=True, default="")
     is_barista = models.BooleanField(default=False)
 
+    # Нормализованные копии для индексного поиска (username__iexact индекс не использует);
+    # заполняются в save(), для старых строк — manage.py backfill_user_keys.
+    # phone_key_reversed — цифры телефона задом наперёд: поиск по последним
+    # цифрам становится поиском по префиксу (см. Loyality/search.py)
+    username_key       = models.CharField(max_length=150, db_index=True, editable=False, default="")
+    name_key           = models.CharField(max_length=255, db_index=True, editable=False, default="")
+    phone_key          = models.CharField(max_length=32, db_index=True, editable=False, default="")
+    phone_key_reversed = models.CharField(max_length=32, db_index=True, editable=False, default="")
+
     employee_code = models.CharField(
         max_length=20, unique=True,
         null=True, blank=True, default=None
@@ -40,10 +203,41 @@ class User(AbstractUser):
     # переопределяем related_name, чтобы не конфликтовать
     groups = models.ManyToManyField('auth.Group', related_name='custom_user_groups', blank=True)
     user_permissions = models.ManyToManyField('auth.Permission', related_name='custom_user_permissions', blank=True)
+
+    def set_lookup_keys(self):
+        """Пересчитать ключи поиска; save() делает это сам, bulk_create — нет."""
+        self.username_key = normalize_username(self.username)
+        self.name_key = normalize_name(self.name)
+        self.phone_key = normalize_phone(self.phone)
+        self.phone_key_reversed = self.phone_key[::-1]
+
+    # Поля, которые хранит кэш статуса (Loyality/status_cache.py); is_active
+    # по нему проверяет аутентификация по claims
+    STATUS_FIELDS = {"username", "name", "phone", "is_staff", "is_barista", "is_active"}
+
+    def save(self, *args, **kwargs):
+        self.set_lookup_keys()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if "username" in update_fields:
+                update_fields.add("username_key")
+            if "name" in update_fields:
+                update_fields.add("name_key")
+            if "phone" in update_fields:
+                update_fields.update({"phone_key", "phone_key_reversed"})
+            kwargs["update_fields"] = update_fields
+        super().save(*args, **kwargs)
+        if update_fields is None or update_fields & self.STATUS_FIELDS:
+            notify_profile_changed(type(self), self.pk, using=self._state.db)
+
+
 class LoyaltyCode(models.Model):
     """Код на штамп(ы) лояльности (одноразовый, с TTL)."""
     user       = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    code       = models.CharField(max_length=10, unique=True)
+    # NULL — код освобождён: погашен раньше окна офлайн-синхронизации, строка
+    # осталась для истории, а номер снова выдаётся (codes.issue_code)
+    code       = models.CharField(max_length=10, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
     redeemed   = models.BooleanField(default=False)
@@ -56,6 +250,36 @@ class LoyaltyCode(models.Model):
         related_name="activated_codes"
     )
 
+    class Meta:
+        indexes = [
+            # Поиск живого кода пользователя: частичный индекс по непогашенным;
+            # code и redeemed в ключе — запрос обслуживается индексом без чтения таблицы
+            models.Index(
+                fields=["user", "expires_at", "code", "redeemed"],
+                condition=models.Q(redeemed=False),
+                name="loyaltycode_user_live_idx",
+            ),
+            # Очистка истёкших непогашенных кодов (sweep_loyalty_codes)
+            models.Index(
+                fields=["expires_at"],
+                condition=models.Q(redeemed=False),
+                name="loyaltycode_expiry_idx",
+            ),
+            # Иерархия дат в админке
+            models.Index(fields=["created_at"], name="loyaltycode_created_at_idx"),
+            # Статистика баристы ("активировано кодов") и очистка старых погашенных
+            models.Index(
+                fields=["redeemed_by", "redeemed_at"],
+                condition=models.Q(redeemed=True),
+                name="loyaltycode_redeemed_by_idx",
+            ),
+            models.Index(
+                fields=["redeemed_at"],
+                condition=models.Q(redeemed=True),
+                name="loyaltycode_redeemed_at_idx",
+            ),
+        ]
+
     def is_valid(self) -> bool:
         return timezone.now() < self.expires_at
 
@@ -66,14 +290,55 @@ class LoyaltyCode(models.Model):
         return f"{self.code} for {self.user}"
 
 
+class RedeemedSignedCode(models.Model):
+    """Погашенный подписанный код (см. Loyality/signed_codes.py).
+
+    Сам код нигде не хранится — только пара (user, window), чтобы не дать
+    погасить его второй раз.
+    """
+    user        = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    window      = models.PositiveBigIntegerField()
+    redeemed_at = models.DateTimeField(auto_now_add=True)
+    redeemed_by = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="activated_signed_codes"
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "window"], name="unique_signed_code_redeem"),
+        ]
+        indexes = [
+            models.Index(fields=["redeemed_at"], name="signedcode_redeemed_at_idx"),
+        ]
+
+    def __str__(self):
+        return f"signed code {self.user_id}/{self.window}"
+
+
+class LoyaltyCodeSequence(models.Model):
+    """Общий счётчик выданных номеров кодов (одна строка, pk=1).
+
+    Процессы резервируют из него блоки номерами подряд, см. Loyality/codes.py.
+    """
+    value = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"code sequence @ {self.value}"
+
+
 class LoyaltyStamp(models.Model):
-    """Один штамп = одна запись (удобно считать)."""
+    """Одна запись = одно начисление; штампов в нём — quantity (считать через Sum)."""
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name="loyalty_stamps",
         on_delete=models.CASCADE
     )
     source     = models.CharField(max_length=32, blank=True, default="code")  # откуда штамп
+    quantity   = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(  # ← новое поле: кто начислил
         User,
@@ -83,5 +348,111 @@ class LoyaltyStamp(models.Model):
         related_name="given_stamps"
     )
 
+    class Meta:
+        indexes = [
+            # Статистика баристы: штампы за день / неделю
+            models.Index(fields=["created_by", "created_at"], name="loyaltystamp_created_by_idx"),
+            # История клиента: keyset-пагинация по (created_at, id), см. get_user_stamp_history
+            models.Index(fields=["user", "-created_at", "-id"], name="loyaltystamp_user_history_idx"),
+            # Иерархия дат в админке
+            models.Index(fields=["created_at"], name="loyaltystamp_created_at_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} stamp(s) for {self.user} at {self.created_at:%Y-%m-%d %H:%M}"
+
+
+class RevokedToken(models.Model):
+    """Отозванный refresh-токен (jti), см. Loyality/revocation.py.
+
+    Журнал для фильтра в памяти: процессы догружают новые строки по id.
+    Строка не нужна после expires_at — токен к тому времени истёк сам.
+    """
+    jti        = models.CharField(max_length=64, unique=True)
+    expires_at = models.DateTimeField()
+    revoked_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["expires_at"], name="revokedtoken_expires_at_idx"),
+        ]
+
+    def __str__(self):
+        return f"revoked {self.jti}"
+
+
+class IdempotencyKey(models.Model):
+    """Ответ на запрос с заголовком Idempotency-Key, см. Loyality/idempotency.py.
+
+    Ключ и тело запроса хранятся хешами (blake2b), ответ — как JSON.
+    status_code NULL — первый запрос с этим ключом ещё выполняется.
+    Строка не нужна после expires_at — её удаляет очистка кодов.
+    """
+    user          = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    scope         = models.CharField(max_length=32)
+    key           = models.CharField(max_length=32)
+    fingerprint   = models.CharField(max_length=32)
+    status_code   = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at    = models.DateTimeField(auto_now_add=True)
+    expires_at    = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "scope", "key"], name="unique_idempotency_key"),
+        ]
+        indexes = [
+            models.Index(fields=["expires_at"], name="idempotencykey_expires_at_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} ({self.status_code or 'pending'})"
+
+
+class BaristaDailyStatsQuerySet(models.QuerySet):
+    def bump(self, barista_id, codes=0, stamps=0, day=None):
+        """Прибавить к счётчикам баристы за день; вызывать в транзакции начисления."""
+        if barista_id is None or not (codes or stamps):
+            return
+        day = day or timezone.localdate()
+        increments = {"codes_activated": models.F("codes_activated") + codes,
+                      "stamps_given": models.F("stamps_given") + stamps}
+        while not self.filter(barista_id=barista_id, day=day).update(**increments):
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(barista_id=barista_id, day=day, codes_activated=codes, stamps_given=stamps)
+                return
+            except IntegrityError:
+                continue  # строку за день создал параллельный запрос
+
+    def summary(self, barista_id, today=None):
+        """Статистика баристы одним запросом по его дневным строкам."""
+        today = today or timezone.localdate()
+        totals = self.filter(barista_id=barista_id).aggregate(
+            codes_activated=models.Sum("codes_activated"),
+            stamps_today=models.Sum("stamps_given", filter=models.Q(day=today)),
+            stamps_week=models.Sum("stamps_given", filter=models.Q(day__gt=today - timedelta(days=7))),
+        )
+        return {name: value or 0 for name, value in totals.items()}
+
+
+class BaristaDailyStats(models.Model):
+    """Сколько кодов активировал и штампов начислил бариста за день (локальная дата).
+
+    Обновляется в той же транзакции, что и погашение/начисление; пересобрать
+    из исходных таблиц — manage.py rebuild_barista_stats.
+    """
+    barista         = models.ForeignKey(User, on_delete=models.CASCADE, related_name="daily_stats")
+    day             = models.DateField()
+    codes_activated = models.PositiveIntegerField(default=0)
+    stamps_given    = models.PositiveIntegerField(default=0)
+
+    objects = BaristaDailyStatsQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["barista", "day"], name="unique_barista_day_stats"),
+        ]
+
     def __str__(self):
-        return f"Stamp for {self.user} at {self.created_at:%Y-%m-%d %H:%M}"    
\ No newline at end of file
+        return f"{self.barista_id} @ {self.day}: {self.codes_activated} codes, {self.stamps_given} stamps"
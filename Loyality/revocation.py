@@ -0,0 +1,140 @@
+# Loyality/revocation.py — отзыв refresh-токенов при ротации без таблиц token_blacklist
+#
+# При ротации (ROTATE_REFRESH_TOKENS + BLACKLIST_AFTER_ROTATION) старый refresh
+# отзывается: его jti пишется в журнал RevokedToken одним INSERT. Уникальный jti
+# делает повторное использование токена невозможным даже между процессами —
+# второй INSERT падает с IntegrityError.
+#
+# Проверка "не отозван ли" идёт через фильтр Блума в памяти: для неотозванного
+# токена (обычный случай) — микросекунды и ни одного запроса; положительный
+# ответ фильтра подтверждается SELECT'ом, так что ложные срабатывания ни на что
+# не влияют. Фильтры разбиты на корзины по сроку истечения токена (exp), и
+# корзина выбрасывается целиком, когда все её токены истекли сами. Строки
+# журнала после expires_at удаляет очистка (Loyality/sweeper.py).
+#
+# Новые строки журнала процесс догружает по id не чаще раза в
+# LOYALTY_REVOCATION_SYNC_SECONDS. Пропущенная строка (например, транзакция с
+# меньшим id закоммитилась позже) лишь лишает быстрого отказа — отзыв всё равно
+# не даст повторно использовать токен.
+
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import RevokedToken
+
+
+class BloomFilter:
+    """Фильтр Блума на bytearray; k позиций — двойное хеширование blake2b."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class RevocationFilter:
+    """Фильтры Блума по корзинам срока истечения и догрузка журнала из БД."""
+
+    def __init__(self, bucket_seconds=None, capacity=None, error_rate=None, sync_interval=None):
+        self.bucket_seconds = bucket_seconds or getattr(settings, "LOYALTY_REVOCATION_BUCKET_SECONDS", 24 * 60 * 60)
+        self.capacity = capacity or getattr(settings, "LOYALTY_REVOCATION_FILTER_CAPACITY", 50_000)
+        self.error_rate = error_rate or getattr(settings, "LOYALTY_REVOCATION_FILTER_ERROR_RATE", 0.001)
+        self.sync_interval = sync_interval if sync_interval is not None else getattr(
+            settings, "LOYALTY_REVOCATION_SYNC_SECONDS", 5
+        )
+        self._buckets = {}  # номер корзины -> BloomFilter
+        self._watermark = 0  # последний загруженный RevokedToken.id
+        self._synced_at = None
+        self._lock = threading.Lock()
+
+    def _bucket(self, exp):
+        return int(exp) // self.bucket_seconds
+
+    def _add(self, jti, exp):
+        bucket = self._bucket(exp)
+        if bucket < self._bucket(time.time()):
+            return
+        bloom = self._buckets.get(bucket)
+        if bloom is None:
+            bloom = self._buckets[bucket] = BloomFilter(self.capacity, self.error_rate)
+        bloom.add(jti)
+
+    def _drop_expired(self):
+        current = self._bucket(time.time())
+        for bucket in [b for b in self._buckets if b < current]:
+            del self._buckets[bucket]
+
+    def add(self, jti, exp):
+        with self._lock:
+            self._add(jti, exp)
+
+    def sync(self, force=False):
+        """Догрузить строки журнала с id больше watermark (не чаще sync_interval)."""
+        if not force and self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        with self._lock:
+            if not force and self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            rows = (
+                RevokedToken.objects.filter(id__gt=self._watermark, expires_at__gt=timezone.now())
+                .order_by("id")
+                .values_list("id", "jti", "expires_at")
+            )
+            for pk, jti, expires_at in rows.iterator():
+                self._add(jti, expires_at.timestamp())
+                self._watermark = pk
+            self._drop_expired()
+            self._synced_at = time.monotonic()
+
+    def might_contain(self, jti, exp):
+        self.sync()
+        bloom = self._buckets.get(self._bucket(exp))
+        return bloom is not None and jti in bloom
+
+
+_filter = None
+_filter_lock = threading.Lock()
+
+
+def get_filter():
+    global _filter
+    if _filter is None:
+        with _filter_lock:
+            if _filter is None:
+                _filter = RevocationFilter()
+    return _filter
+
+
+def is_revoked(jti, exp):
+    """Отозван ли токен. Запрос к БД — только если фильтр ответил "возможно"."""
+    return get_filter().might_contain(jti, exp) and RevokedToken.objects.filter(jti=jti).exists()
+
+
+def revoke(jti, exp):
+    """Отозвать токен. False — он уже был отозван раньше (повторное использование)."""
+    try:
+        with transaction.atomic():
+            RevokedToken.objects.create(jti=jti, expires_at=datetime.fromtimestamp(exp, tz=dt_timezone.utc))
+    except IntegrityError:
+        return False
+    get_filter().add(jti, exp)
+    return True
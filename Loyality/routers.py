@@ -0,0 +1,203 @@
+# Loyality/routers.py — чтение с реплик, запись в основную БД
+#
+# Реплики перечислены в LOYALTY_REPLICA_DATABASES (алиасы DATABASES; без них
+# всё идёт в "default", как раньше). На реплику уходят только чтения внутри
+# вьюх с @replica_reads (me, статус, профиль, статистика баристы); запись,
+# select_for_update и чтения внутри транзакции — всегда в основную БД.
+#
+# Реплика отстаёт, поэтому после записи пользователь "закрепляется" за
+# основной БД на LOYALTY_REPLICA_STICKY_SECONDS: метка в общем кэше ставится,
+# когда запрос этого пользователя что-то записал (middleware) и когда
+# изменились его штампы (сигнал profile_changed — штампы клиенту начисляет
+# бариста). Пока метка жива, его чтения не уходят на реплику и число
+# штампов не может "откатиться" назад. Состояние запроса — в contextvar,
+# поэтому работает и в потоках WSGI, и в async-вьюхах.
+
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.dispatch import receiver
+from django.http import HttpRequest
+from django.utils.decorators import sync_and_async_middleware
+from rest_framework.request import Request
+
+from .signals import profile_changed
+
+PIN_KEY_PREFIX = "loyalty:db-pin"
+
+
+class _RequestState:
+    """Что известно о текущем запросе: можно ли читать с реплики и была ли запись."""
+
+    __slots__ = ("replica", "wrote", "primary")
+
+    def __init__(self):
+        self.replica = False
+        self.wrote = False
+        self.primary = 0  # вложенность primary()
+
+
+_state = ContextVar("loyalty_db_state", default=None)
+
+
+def replicas():
+    return list(getattr(settings, "LOYALTY_REPLICA_DATABASES", ()))
+
+
+def _cache():
+    return caches[getattr(settings, "LOYALTY_REPLICA_PIN_CACHE_ALIAS", "default")]
+
+
+def _pin_key(user_id):
+    return f"{PIN_KEY_PREFIX}:{user_id}"
+
+
+def pin(user_id):
+    """Читать данные пользователя из основной БД ближайшие LOYALTY_REPLICA_STICKY_SECONDS."""
+    if user_id is None or not replicas():
+        return
+    _cache().set(_pin_key(user_id), 1, getattr(settings, "LOYALTY_REPLICA_STICKY_SECONDS", 10))
+
+
+def is_pinned(user_id):
+    return _cache().get(_pin_key(user_id)) is not None
+
+
+def reading_replica():
+    """Уйдёт ли следующее чтение на реплику."""
+    state = _state.get()
+    return (
+        state is not None and state.replica and not state.wrote and not state.primary
+        and bool(replicas()) and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+    )
+
+
+def pinned_among(user_ids):
+    """Какие из user_ids закреплены — только если сейчас читаем с реплики (иначе пусто)."""
+    if not reading_replica():
+        return set()
+    pins = _cache().get_many([_pin_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if _pin_key(user_id) in pins}
+
+
+async def apinned_among(user_ids):
+    if not reading_replica():
+        return set()
+    pins = await _cache().aget_many([_pin_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if _pin_key(user_id) in pins}
+
+
+@contextmanager
+def primary():
+    """Чтения внутри блока — из основной БД (перечитать строку закреплённого пользователя)."""
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    state.primary += 1
+    try:
+        yield
+    finally:
+        state.primary -= 1
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if reading_replica():
+            return random.choice(replicas())
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики — копии основной БД, связи между ними допустимы
+        return True
+
+
+@contextmanager
+def _replica_scope(request):
+    state = _state.get()
+    token = None
+    if state is None:  # без middleware (тесты, вызов вьюхи напрямую)
+        state = _RequestState()
+        token = _state.set(state)
+    previous = state.replica
+    user = getattr(request, "user", None)
+    user_id = user.id if user is not None and user.is_authenticated else None
+    state.replica = bool(replicas()) and not (user_id is not None and is_pinned(user_id))
+    try:
+        yield
+    finally:
+        state.replica = previous
+        if token is not None:
+            _state.reset(token)
+
+
+def _request_from(args):
+    return next(arg for arg in args if isinstance(arg, (HttpRequest, Request)))
+
+
+def replica_reads(view):
+    """Чтения внутри вьюхи — с реплики, если пользователь не закреплён за основной БД.
+    Ставится ближе всего к функции, после декораторов аутентификации."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            with _replica_scope(_request_from(args)):
+                return await view(*args, **kwargs)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with _replica_scope(_request_from(args)):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def _pin_writer(request, state):
+    if not state.wrote or not replicas():
+        return
+    user = getattr(request, "user", None)  # DRF кладёт сюда и JWT-пользователя
+    if user is not None and user.is_authenticated:
+        pin(user.id)
+
+
+@sync_and_async_middleware
+def replica_stickiness_middleware(get_response):
+    """Новое состояние маршрутизации на каждый запрос; после записи — закрепить автора."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            state = _RequestState()
+            token = _state.set(state)
+            try:
+                response = await get_response(request)
+                _pin_writer(request, state)
+            finally:
+                _state.reset(token)
+            return response
+    else:
+        def middleware(request):
+            state = _RequestState()
+            token = _state.set(state)
+            try:
+                response = get_response(request)
+                _pin_writer(request, state)
+            finally:
+                _state.reset(token)
+            return response
+    return middleware
+
+
+@receiver(profile_changed)
+def _on_profile_changed(sender, user_id, **kwargs):
+    pin(user_id)
@@ -0,0 +1,73 @@
+# Loyality/search.py — поиск клиента по мере набора (экран баристы)
+#
+# Ищем по префиксу нормализованных индексированных колонок User: username_key,
+# name_key, phone_key и phone_key_reversed (последние цифры телефона — это
+# префикс перевёрнутой строки). Префикс превращается в диапазон
+# key >= q AND key < q' (q' — q с увеличенным последним символом): такое
+# условие B-tree индекс отдаёт поиском по диапазону, в отличие от
+# __istartswith (UPPER(...) LIKE) и __icontains, которые читают всю таблицу.
+# По каждому ключу — отдельный запрос с LIMIT, поэтому стоимость зависит от N,
+# а не от числа клиентов. Замеры — manage.py benchmark_customer_search.
+
+import re
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import F, Q
+
+from .models import normalize_name, normalize_phone, normalize_username
+
+RESULT_FIELDS = ("id", "username", "name", "phone")
+PHONE_QUERY_RE = re.compile(r"^[\d\s()+-]+$")
+
+
+def _upper_bound(prefix):
+    """Наименьшая строка больше всех строк с префиксом prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def prefix_filter(field, prefix):
+    """Q "field начинается с prefix" в виде диапазона, который читается по индексу field."""
+    return Q(**{f"{field}__gte": prefix, f"{field}__lt": _upper_bound(prefix)})
+
+
+def _prefix_query(field, prefix, limit):
+    return (
+        get_user_model().objects
+        .filter(prefix_filter(field, prefix))
+        .order_by(field, "id")
+        .values(*RESULT_FIELDS, stamps=F("loyalty_profile__stamps"), match_key=F(field))[:limit]
+    )
+
+
+def _lookups(query):
+    """[(поле, префикс)]: цифры — телефон с начала и с конца, иначе логин и имя."""
+    if PHONE_QUERY_RE.match(query):
+        # Для префикса 8 → 7 не делаем: "89..." может быть и хвостом номера
+        digits = re.sub(r"\D", "", query)
+        if len(digits) < getattr(settings, "LOYALTY_SEARCH_MIN_PHONE_DIGITS", 3):
+            return []
+        head = normalize_phone(digits) if len(digits) == 11 else digits
+        return [("phone_key", head), ("phone_key_reversed", digits[::-1])]
+
+    min_length = getattr(settings, "LOYALTY_SEARCH_MIN_LENGTH", 2)
+    lookups = [("username_key", normalize_username(query)), ("name_key", normalize_name(query))]
+    return [(field, prefix) for field, prefix in lookups if len(prefix) >= min_length]
+
+
+def search_customers(query, limit=None):
+    """Первые limit пользователей, у которых логин, имя или телефон начинается
+    с query (телефон — ещё и заканчивается). Список dict: RESULT_FIELDS и stamps;
+    точные совпадения первыми. Слишком короткий запрос — пустой список."""
+    if limit is None:
+        limit = getattr(settings, "LOYALTY_SEARCH_LIMIT", 10)
+    found = {}
+    for field, prefix in _lookups((query or "").strip()):
+        for row in _prefix_query(field, prefix, limit):
+            exact = row.pop("match_key") == prefix
+            row["stamps"] = row["stamps"] or 0
+            if row["id"] in found:
+                exact = exact or found[row["id"]][0]
+            found[row["id"]] = (exact, row)
+    ranked = sorted(found.values(), key=lambda item: (not item[0], item[1]["username"].lower(), item[1]["id"]))
+    return [row for _, row in ranked[:limit]]
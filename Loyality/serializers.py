@@ -2,11 +2,17 @@
 import re
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from rest_framework import serializers
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
 
 # Правильные импорты моделей из текущего приложения
-from .models import LoyaltyProfile, LoyaltyCode, LoyaltyStamp  # ← добавил LoyaltyStamp
+from .models import BaristaDailyStats, LoyaltyProfile, normalize_username
+from . import revocation, status_cache
+from .authentication import LoyaltyRefreshToken
 
 User = get_user_model()
 
@@ -35,12 +41,21 @@ class RegisterSerializer(serializers.ModelSerializer):
         fields = ("username", "password", "employee_code")
         extra_kwargs = {"password": {"write_only": True}}
 
+    def validate_username(self, value):
+        # Поиск по логину идёт без учёта регистра — "Alice" и "alice" были бы одним клиентом
+        if User.objects.filter(username_key=normalize_username(value)).exists():
+            raise serializers.ValidationError("Логин уже занят.")
+        return value
+
     def create(self, validated_data):
         validated_data.pop("employee_code", None)
-        user = User.objects.create_user(
-            username=validated_data["username"],
-            password=validated_data["password"],
-        )
+        with transaction.atomic():
+            user = User.objects.create_user(
+                username=validated_data["username"],
+                password=validated_data["password"],
+            )
+            # Профиль создаём сразу, чтобы GET-запросы ничего не писали
+            LoyaltyProfile.objects.create(user=user)
         return user
 
 
@@ -50,8 +65,44 @@ class ChangePasswordSerializer(serializers.Serializer):
     new_password = serializers.CharField(write_only=True, min_length=4)
 
 
+# --- JWT: id, username, is_staff и is_barista кладём в токен (ClaimsJWTAuthentication) ---
+class LoyaltyTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = LoyaltyRefreshToken
+
+
+# --- Обновление JWT: старый refresh при ротации отзывается (Loyality/revocation.py),
+# claims пользователя берутся заново из БД — иначе ротация копировала бы в новые
+# токены права, которые у пользователя уже отняли ---
+class LoyaltyTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = LoyaltyRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        jti, exp = refresh[api_settings.JTI_CLAIM], refresh["exp"]
+        if revocation.is_revoked(jti, exp):
+            raise InvalidToken("Токен отозван")
+
+        # Та же проверка пользователя, что в TokenRefreshSerializer, — и тот же SELECT
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: refresh.payload.get(api_settings.USER_ID_CLAIM)}).first()
+        if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages["no_active_account"], "no_active_account")
+        refresh.set_user_claims(user)
+
+        data = {"access": str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                # Уникальный jti: из двух одновременных обновлений одним токеном пройдёт одно
+                if not revocation.revoke(jti, exp):
+                    raise InvalidToken("Токен отозван")
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data["refresh"] = str(refresh)
+        return data
+
+
 # --- JWT для бариста ---
-class BaristaTokenObtainPairSerializer(TokenObtainPairSerializer):
+class BaristaTokenObtainPairSerializer(LoyaltyTokenObtainPairSerializer):
     def validate(self, attrs):
         data = super().validate(attrs)
         user = self.user
@@ -79,8 +130,8 @@ class UserProfileSerializer(serializers.ModelSerializer):
         extra_kwargs = {"username": {"read_only": True}}
 
     def get_stamps(self, obj):
-        profile, _ = LoyaltyProfile.objects.get_or_create(user=obj)
-        return int(profile.stamps or 0)
+        status = status_cache.get_status(obj.id)
+        return int(status["stamps"]) if status else 0
 
     def get_max_stamps(self, obj):
         return int(getattr(settings, "LOYALTY_MAX_STAMPS", 6))
@@ -96,7 +147,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
         for field in ("name", "phone"):
             if field in validated_data:
                 setattr(instance, field, validated_data[field])
-        instance.save()
+        instance.save()  # User.save() сам сбрасывает кэш статуса
         return instance
 
 
@@ -117,29 +168,27 @@ class MeSerializer(serializers.ModelSerializer):
         )
 
     def get_stamps(self, obj):
-        profile, _ = LoyaltyProfile.objects.get_or_create(user=obj)
-        return int(profile.stamps or 0)
+        status = status_cache.get_status(obj.id)
+        return int(status["stamps"]) if status else 0
 
     def get_max_stamps(self, obj):
         return int(getattr(settings, "LOYALTY_MAX_STAMPS", 6))
 
+    def _barista_summary(self, obj):
+        # Одна агрегация по дневным итогам на объект, а не COUNT по всей таблице на поле
+        cache = self.__dict__.setdefault("_summaries", {})
+        if obj.pk not in cache:
+            cache[obj.pk] = BaristaDailyStats.objects.summary(obj.pk)
+        return cache[obj.pk]
+
     def get_codes_activated(self, obj):
-        # Если у тебя есть поле redeemed_by в LoyaltyCode — используй его:
-        # return LoyaltyCode.objects.filter(redeemed=True, redeemed_by=obj).count()
-        # Пока считаем все активированные коды (или по логике твоего проекта)
-        return LoyaltyCode.objects.filter(redeemed=True).count()
+        return self._barista_summary(obj)["codes_activated"]
 
     def get_stamps_today(self, obj):
-        from django.utils import timezone
-        today = timezone.now().date()
-        # Если штампы привязаны к баристе — добавь фильтр redeemed_by=obj или created_by=obj
-        return LoyaltyStamp.objects.filter(created_at__date=today).count()
+        return self._barista_summary(obj)["stamps_today"]
 
     def get_stamps_week(self, obj):
-        from django.utils import timezone
-        from datetime import timedelta
-        week_ago = timezone.now() - timedelta(days=7)
-        return LoyaltyStamp.objects.filter(created_at__gte=week_ago).count()
+        return self._barista_summary(obj)["stamps_week"]
 
 
 # --- BACKWARD COMPATIBILITY ---
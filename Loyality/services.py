@@ -1,23 +1,40 @@
 # backend/loyalty/services.py
-import secrets
-import string
+import base64
+import binascii
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 from django.db import transaction
-from django.db.models import F
+from django.db.models import F, Q
+from .codes import issue_code
 from .models import LoyaltyProfile, LoyaltyCode, LoyaltyStamp
 
-def _generate_unique_code(length=6, alphabet=string.digits):
-    """Генерация уникального кода"""
-    while True:
-        code = "".join(secrets.choice(alphabet) for _ in range(length))
-        exists = LoyaltyCode.objects.filter(
-            code=code, 
-            redeemed=False, 
-            expires_at__gt=timezone.now()
-        ).exists()
-        if not exists:
-            return code
+HISTORY_FIELDS = ("id", "quantity", "source", "created_at")
+
+
+class InvalidHistoryCursor(Exception):
+    """Курсор истории штампов повреждён или подделан."""
+
+
+def _encode_history_cursor(row):
+    raw = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_history_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split("|")
+        created_at, pk = parse_datetime(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidHistoryCursor(cursor)
+    if created_at is None:
+        raise InvalidHistoryCursor(cursor)
+    return created_at, pk
+
 
 class LoyaltyService:
     """Сервис для работы с лояльностью"""
@@ -31,23 +48,14 @@ class LoyaltyService:
     @staticmethod
     def generate_loyalty_code(user, expires_minutes=15):
         """Сгенерировать код лояльности"""
-        code = _generate_unique_code()
-        expires_at = timezone.now() + timedelta(minutes=expires_minutes)
-        
-        loyalty_code = LoyaltyCode.objects.create(
-            user=user,
-            code=code,
-            expires_at=expires_at
-        )
-        
-        return loyalty_code
+        return issue_code(user.id, ttl=timedelta(minutes=expires_minutes))
     
     @staticmethod
     @transaction.atomic
     def redeem_loyalty_code(code_value):
         """Активировать код лояльности"""
         try:
-            loyalty_code = LoyaltyCode.objects.select_for_update().get(
+            loyalty_code = LoyaltyCode.objects.select_related("user").select_for_update(of=("self",)).get(
                 code=code_value
             )
         except LoyaltyCode.DoesNotExist:
@@ -59,21 +67,22 @@ class LoyaltyService:
         if not loyalty_code.is_valid():
             return False, "Срок действия кода истёк"
         
-        # Активируем код
-        loyalty_code.redeem()
-        
         # Начисляем штамп
-        profile = LoyaltyService.get_or_create_profile(loyalty_code.user)
-        success, message = profile.add_stamp(1, "code_redeem")
+        stamps, added = LoyaltyProfile.objects.add_stamps(loyalty_code.user_id, 1)
+        if not added:
+            return False, "Лимит штампов достигнут"
+        
+        # Активируем код
+        loyalty_code.redeemed = True
+        loyalty_code.redeemed_at = timezone.now()
+        loyalty_code.save(update_fields=["redeemed", "redeemed_at"])
+        LoyaltyStamp.objects.create(user_id=loyalty_code.user_id, source="code_redeem")
         
-        if success:
-            return True, {
-                "detail": "Код успешно активирован",
-                "stamps_after": profile.stamps,
-                "username": loyalty_code.user.username
-            }
-        else:
-            return False, message
+        return True, {
+            "detail": "Код успешно активирован",
+            "stamps_after": stamps,
+            "username": loyalty_code.user.username
+        }
     
     @staticmethod
     @transaction.atomic
@@ -85,17 +94,17 @@ class LoyaltyService:
         except User.DoesNotExist:
             return False, "Пользователь не найден"
         
-        profile = LoyaltyService.get_or_create_profile(user)
-        success, message = profile.add_stamp(count, source)
+        stamps, added = LoyaltyProfile.objects.add_stamps(user.id, count)
+        if not added:
+            return False, "Лимит штампов достигнут"
         
-        if success:
-            return True, {
-                "username": user.username,
-                "stamps": profile.stamps,
-                "stamps_added": count
-            }
-        else:
-            return False, message
+        LoyaltyStamp.objects.create(user=user, source=source, quantity=added)
+        
+        return True, {
+            "username": user.username,
+            "stamps": stamps,
+            "stamps_added": added
+        }
     
     @staticmethod
     @transaction.atomic
@@ -107,13 +116,12 @@ class LoyaltyService:
         except User.DoesNotExist:
             return False, "Пользователь не найден"
         
-        profile = LoyaltyService.get_or_create_profile(user)
-        stamps_before = profile.reset_stamps()
+        stamps_before = LoyaltyProfile.objects.reset_stamps(user.id)
         
         return True, {
             "username": user.username,
             "stamps_before": stamps_before,
-            "stamps_after": profile.stamps,
+            "stamps_after": 0,
             "detail": f"Счётчик сброшен. Выдано вознаграждение за {stamps_before} штампов"
         }
     
@@ -121,21 +129,37 @@ class LoyaltyService:
     def get_user_loyalty_status(username):
         """Получить статус лояльности пользователя"""
         User = get_user_model()
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
+        user = (
+            User.objects.filter(username=username)
+            .values_list("username", "loyalty_profile__stamps")
+            .first()
+        )
+        if user is None:
             return None
         
-        profile, created = LoyaltyProfile.objects.get_or_create(user=user)
-        
         return {
-            "username": user.username,
-            "stamps": profile.stamps,
+            "username": user[0],
+            "stamps": user[1] or 0,
             "max_stamps": getattr(settings, "LOYALTY_MAX_STAMPS", 6),
-            "profile_exists": not created
+            "profile_exists": user[1] is not None
         }
     
     @staticmethod
-    def get_user_stamp_history(user, limit=10):
-        """Получить историю штампов пользователя"""
-        return LoyaltyStamp.objects.filter(user=user).order_by('-created_at')[:limit]
\ No newline at end of file
+    def get_user_stamp_history(user_id, limit=10, cursor=None):
+        """Страница истории штампов, новые первыми: (строки-dict, курсор следующей страницы или None).
+
+        Keyset-пагинация по (created_at, id) на индексе loyaltystamp_user_history_idx:
+        страница — один SELECT ... LIMIT limit + 1 без OFFSET и COUNT(*), её цена
+        не зависит от длины истории. cursor — непрозрачная строка из прошлого ответа;
+        испорченный — InvalidHistoryCursor."""
+        stamps = LoyaltyStamp.objects.filter(user_id=user_id)
+        if cursor:
+            created_at, pk = _decode_history_cursor(cursor)
+            # created_at <= X задаёт границу диапазона по индексу, OR добирает равные по id
+            stamps = stamps.filter(Q(created_at__lt=created_at) | Q(pk__lt=pk), created_at__lte=created_at)
+        rows = list(
+            stamps.order_by("-created_at", "-id")
+            .values(*HISTORY_FIELDS, created_by_username=F("created_by__username"))[:limit + 1]
+        )
+        next_cursor = _encode_history_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return rows[:limit], next_cursor
\ No newline at end of file
@@ -0,0 +1,12 @@
+# Loyality/signals.py
+from django.db import transaction
+from django.dispatch import Signal
+
+# Изменились штампы или данные профиля пользователя. Аргументы: user_id.
+# Подписчики (кэш статуса и т.п.) подключаются в LoyalityConfig.ready().
+profile_changed = Signal()
+
+
+def notify_profile_changed(sender, user_id, using=None):
+    """Разослать profile_changed после коммита текущей транзакции."""
+    transaction.on_commit(lambda: profile_changed.send(sender=sender, user_id=user_id), using=using)
@@ -0,0 +1,90 @@
+# Loyality/signed_codes.py — подписанные коды лояльности без записи в БД при выдаче
+#
+# Код имеет вид "<user_id>-<window>-<mac>" (числа в base36), где window — номер
+# временного окна выдачи, а mac — усечённый HMAC от SECRET_KEY. Проверка подписи
+# и срока действия идёт только на CPU; в БД пишется лишь факт погашения
+# (RedeemedSignedCode), чтобы код нельзя было использовать дважды.
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+from .codes import offline_sync_window
+from .models import RedeemedSignedCode
+
+KEY_SALT = "Loyality.signed_codes"
+MAC_LENGTH = 10
+
+
+class SignedCodeError(Exception):
+    """Код не прошёл проверку; текст исключения — сообщение для клиента."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _step():
+    return getattr(settings, "LOYALTY_SIGNED_CODE_STEP_SECONDS", 60)
+
+
+def _ttl():
+    return timedelta(minutes=getattr(settings, "LOYALTY_CODE_TTL_MINUTES", 15))
+
+
+def max_lifetime():
+    """Сколько после погашения код ещё может пройти проверку срока: TTL, допуск
+    часов и окно офлайн-синхронизации (пакетное погашение задним числом)."""
+    return _ttl() + timedelta(seconds=_step()) + offline_sync_window()
+
+
+def _mac(user_id, window):
+    return salted_hmac(KEY_SALT, f"{user_id}:{window}", algorithm="sha256").hexdigest()[:MAC_LENGTH]
+
+
+def window_start(window):
+    return datetime.fromtimestamp(window * _step(), tz=dt_timezone.utc)
+
+
+def is_signed_code(code):
+    return code.count("-") == 2
+
+
+def sign_code(user_id, now=None):
+    """Выдать код пользователю. Возвращает (code, expires_at)."""
+    now = now or timezone.now()
+    window = int(now.timestamp()) // _step()
+    code = f"{int_to_base36(user_id)}-{int_to_base36(window)}-{_mac(user_id, window)}"
+    return code, window_start(window) + _ttl()
+
+
+def verify_code(code, now=None):
+    """Проверить подпись и срок. Возвращает (user_id, window) или бросает SignedCodeError."""
+    now = now or timezone.now()
+    try:
+        raw_user, raw_window, mac = code.split("-")
+        user_id, window = base36_to_int(raw_user), base36_to_int(raw_window)
+    except ValueError:
+        raise SignedCodeError("Код не найден", status=404)
+
+    if not constant_time_compare(mac, _mac(user_id, window)):
+        raise SignedCodeError("Код не найден", status=404)
+
+    issued_at = window_start(window)
+    if issued_at > now + timedelta(seconds=_step()) or now > issued_at + _ttl():
+        raise SignedCodeError("Код истёк")
+    return user_id, window
+
+
+def mark_redeemed(user_id, window, redeemed_by_id=None):
+    """Записать погашение. False — код уже был погашен раньше."""
+    try:
+        with transaction.atomic():
+            RedeemedSignedCode.objects.create(user_id=user_id, window=window, redeemed_by_id=redeemed_by_id)
+    except IntegrityError:
+        return False
+    return True
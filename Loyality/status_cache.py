@@ -0,0 +1,225 @@
+# Loyality/status_cache.py — read-through кэш статуса лояльности по user_id
+#
+# Запись содержит всё, что отдают /api/me/, /api/loyalty/status/ и
+# /api/user/profile/: поля пользователя, число штампов и версию профиля
+# (updated_at, из неё считается ETag — см. Loyality/conditional.py). Бэкенд — любой кэш
+# Django (LOYALTY_STATUS_CACHE_ALIAS, по умолчанию locmem). По сигналу
+# profile_changed после каждого изменения запись заменяется меткой INVALIDATED
+# на LOYALTY_STATUS_CACHE_TOMBSTONE_SECONDS, а промах кладёт прочитанное через
+# cache.add: читатель, который выбрал строку до коммита, не перезапишет метку
+# старым числом штампов на весь TTL. Пока метка жива, чтения идут в БД. TTL —
+# страховка на случай правок в обход сигнала (админка, ручной SQL). Промах
+# может читаться с реплики (Loyality/routers.py); строку пользователя,
+# закреплённого за основной БД, перечитываем оттуда, чтобы не положить в кэш
+# отставшее число штампов. В записи есть is_active: по ней аутентификация по
+# claims (Loyality/authentication.py) отклоняет удалённых и отключённых
+# пользователей; User.save() и удаление пользователя запись сбрасывают.
+
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import routers
+from .models import normalize_username
+from .signals import profile_changed
+
+KEY_PREFIX = "loyalty:status"
+INVALIDATED = "invalidated"
+USER_FIELDS = ("id", "username", "name", "phone", "is_staff", "is_barista", "is_active")
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _cache():
+    return caches[getattr(settings, "LOYALTY_STATUS_CACHE_ALIAS", "default")]
+
+
+def _ttl():
+    return getattr(settings, "LOYALTY_STATUS_CACHE_TTL", 300)
+
+
+def _tombstone_ttl():
+    return getattr(settings, "LOYALTY_STATUS_CACHE_TOMBSTONE_SECONDS", 5)
+
+
+def _key(user_id):
+    return f"{KEY_PREFIX}:{user_id}"
+
+
+def _username_key(username):
+    return f"{KEY_PREFIX}:username:{normalize_username(username)}"
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    """Счётчики попаданий/промахов этого процесса."""
+    with _stats_lock:
+        return {"hits": _stats["hits"], "misses": _stats["misses"]}
+
+
+def _status_query(**lookup):
+    return get_user_model().objects.filter(**lookup).values(
+        *USER_FIELDS,
+        stamps=F("loyalty_profile__stamps"),
+        updated_at=F("loyalty_profile__updated_at"),
+    )
+
+
+def _normalize(status):
+    if status is not None:
+        status["stamps"] = status["stamps"] or 0
+    return status
+
+
+def _load(**lookup):
+    status = _normalize(_status_query(**lookup).first())
+    if status is not None and routers.pinned_among([status["id"]]):
+        with routers.primary():
+            status = _normalize(_status_query(**lookup).first())
+    return status
+
+
+async def _aload(**lookup):
+    status = _normalize(await _status_query(**lookup).afirst())
+    if status is not None and await routers.apinned_among([status["id"]]):
+        with routers.primary():
+            status = _normalize(await _status_query(**lookup).afirst())
+    return status
+
+
+def get_status(user_id):
+    """Статус пользователя (dict) или None, если пользователя нет."""
+    cache = _cache()
+    cached = cache.get(_key(user_id))
+    if isinstance(cached, dict):
+        _count("hits")
+        return cached
+
+    _count("misses")
+    status = _load(pk=user_id)
+    if status is not None and cached is None:
+        cache.add(_key(user_id), status, _ttl())
+    return status
+
+
+def get_status_by_username(username):
+    """То же, но по логину без учёта регистра (логин → id тоже кэшируется)."""
+    cache = _cache()
+    user_id = cache.get(_username_key(username))
+    if user_id is not None:
+        return get_status(user_id)
+
+    _count("misses")
+    status = _load(username_key=normalize_username(username))
+    if status is not None:
+        cache.add(_key(status["id"]), status, _ttl())
+        cache.set(_username_key(username), status["id"], _ttl())
+    return status
+
+
+def get_statuses(user_ids):
+    """Статусы нескольких пользователей {user_id: status}: get_many из кэша,
+    промахи — одним SELECT ... IN. Ненайденных id в ответе нет."""
+    cache = _cache()
+    user_ids = list(dict.fromkeys(user_ids))
+    cached = cache.get_many([_key(user_id) for user_id in user_ids])
+    statuses = {user_id: cached[_key(user_id)] for user_id in user_ids
+                if isinstance(cached.get(_key(user_id)), dict)}
+    missing = [user_id for user_id in user_ids if user_id not in statuses]
+    with _stats_lock:
+        _stats["hits"] += len(statuses)
+        _stats["misses"] += len(missing)
+
+    if missing:
+        loaded = {status["id"]: _normalize(status) for status in _status_query(pk__in=missing)}
+        stale = routers.pinned_among(loaded)
+        if stale:
+            with routers.primary():
+                loaded.update({status["id"]: _normalize(status) for status in _status_query(pk__in=stale)})
+        for user_id, status in loaded.items():
+            if _key(user_id) not in cached:  # помеченные INVALIDATED не трогаем
+                cache.add(_key(user_id), status, _ttl())
+        statuses.update(loaded)
+    return statuses
+
+
+def get_statuses_by_username(usernames):
+    """То же по логинам без учёта регистра: {логин в нижнем регистре: status}."""
+    cache = _cache()
+    names = list(dict.fromkeys(normalize_username(username) for username in usernames))
+    known = cache.get_many([_username_key(name) for name in names])
+    ids = {name: known[_username_key(name)] for name in names if _username_key(name) in known}
+    by_id = get_statuses(ids.values())
+    statuses = {name: by_id[user_id] for name, user_id in ids.items() if user_id in by_id}
+
+    missing = [name for name in names if name not in statuses]
+    if missing:
+        _count("misses")
+        loaded = {}
+        for status in _status_query(username_key__in=missing).order_by("id"):
+            loaded.setdefault(normalize_username(status["username"]), _normalize(status))
+        stale = routers.pinned_among([status["id"] for status in loaded.values()])
+        if stale:
+            with routers.primary():
+                for status in _status_query(pk__in=stale):
+                    loaded[normalize_username(status["username"])] = _normalize(status)
+        for status in loaded.values():
+            cache.add(_key(status["id"]), status, _ttl())
+        cache.set_many({_username_key(name): status["id"] for name, status in loaded.items()}, _ttl())
+        statuses.update(loaded)
+    return statuses
+
+
+async def aget_status(user_id):
+    """Асинхронный get_status: async-кэш и async ORM, без потоков."""
+    cache = _cache()
+    cached = await cache.aget(_key(user_id))
+    if isinstance(cached, dict):
+        _count("hits")
+        return cached
+
+    _count("misses")
+    status = await _aload(pk=user_id)
+    if status is not None and cached is None:
+        await cache.aadd(_key(user_id), status, _ttl())
+    return status
+
+
+async def aget_status_by_username(username):
+    cache = _cache()
+    user_id = await cache.aget(_username_key(username))
+    if user_id is not None:
+        return await aget_status(user_id)
+
+    _count("misses")
+    status = await _aload(username_key=normalize_username(username))
+    if status is not None:
+        await cache.aadd(_key(status["id"]), status, _ttl())
+        await cache.aset(_username_key(username), status["id"], _ttl())
+    return status
+
+
+def invalidate(user_id):
+    """Заменить запись меткой: запоздавший cache.add старого значения не пройдёт."""
+    _cache().set(_key(user_id), INVALIDATED, _tombstone_ttl())
+
+
+@receiver(profile_changed)
+def _on_profile_changed(sender, user_id, **kwargs):
+    invalidate(user_id)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _on_user_deleted(sender, instance, **kwargs):
+    invalidate(instance.pk)
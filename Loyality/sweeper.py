@@ -0,0 +1,131 @@
+# Loyality/sweeper.py — очистка истёкших и погашенных кодов небольшими пачками
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import serializers
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import signed_codes
+from .codes import offline_sync_window
+from .models import IdempotencyKey, LoyaltyCode, RedeemedSignedCode, RevokedToken
+
+logger = logging.getLogger(__name__)
+
+
+def delete_in_batches(queryset, batch_size=1000, pause=0, archive=None):
+    """Удалить строки queryset пачками по batch_size, каждая в своей транзакции.
+
+    Блокировка БД держится только на время одной пачки; между пачками — пауза
+    `pause` секунд, чтобы не мешать рабочему трафику. Если передан `archive`
+    (файл), удаляемые строки предварительно пишутся в него в формате JSON Lines
+    сериализатора Django — с меткой модели в каждой строке, так что архив
+    восстанавливается через manage.py loaddata.
+    """
+    model = queryset.model
+    total = 0
+    while True:
+        with transaction.atomic():
+            if archive is not None:
+                rows = list(queryset[:batch_size])
+                pks = [row.pk for row in rows]
+            else:
+                pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            deleted = model.objects.filter(pk__in=pks).delete()[0]
+            if archive is not None:
+                serializers.serialize("jsonl", rows, stream=archive, ensure_ascii=False)
+        total += deleted
+        if len(pks) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+def sweep_codes(batch_size=1000, pause=0, redeemed_retention_days=None, archive=None, now=None):
+    """Удалить истёкшие непогашенные коды, старые погашенные, отметки подписанных кодов,
+    записи об отозванных токенах, которые истекли сами, и истёкшие ключи идемпотентности.
+
+    Истёкший код удаляется только после окна офлайн-синхронизации: до тех пор
+    планшет может прислать его сканирование задним числом. Погашенные
+    LoyaltyCode нужны статистике баристы, поэтому удаляются только
+    при заданном сроке хранения (`redeemed_retention_days` или
+    LOYALTY_REDEEMED_CODE_RETENTION_DAYS). Возвращает {вид: удалено строк}.
+    """
+    now = now or timezone.now()
+    if redeemed_retention_days is None:
+        redeemed_retention_days = getattr(settings, "LOYALTY_REDEEMED_CODE_RETENTION_DAYS", None)
+    options = {"batch_size": batch_size, "pause": pause, "archive": archive}
+
+    removed = {
+        "expired": delete_in_batches(
+            LoyaltyCode.objects.filter(redeemed=False, expires_at__lte=now - offline_sync_window()), **options
+        ),
+        # Код, погашенный раньше max_lifetime(), не пройдёт проверку срока даже
+        # задним числом — отметка о погашении больше не нужна
+        "signed": delete_in_batches(
+            RedeemedSignedCode.objects.filter(
+                redeemed_at__lt=now - signed_codes.max_lifetime()
+            ),
+            **options,
+        ),
+        "revoked": delete_in_batches(RevokedToken.objects.filter(expires_at__lte=now), **options),
+        "idempotency": delete_in_batches(IdempotencyKey.objects.filter(expires_at__lte=now), **options),
+    }
+    if redeemed_retention_days is not None:
+        removed["redeemed"] = delete_in_batches(
+            LoyaltyCode.objects.filter(redeemed=True, redeemed_at__lt=now - timedelta(days=redeemed_retention_days)),
+            **options,
+        )
+    return removed
+
+
+class CodeSweeper(threading.Thread):
+    """Фоновая очистка внутри процесса раз в `interval` секунд."""
+
+    daemon = True
+
+    def __init__(self, interval, batch_size=1000, pause=0.05):
+        super().__init__(name="loyalty-code-sweeper")
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                removed = sweep_codes(batch_size=self.batch_size, pause=self.pause)
+                logger.info("Очистка кодов: %s", removed)
+            except Exception:
+                logger.exception("Очистка кодов не удалась")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self.stopped.set()
+
+
+_sweeper = None
+
+
+def start_sweeper():
+    """Запустить фоновую очистку, если задан LOYALTY_SWEEPER_INTERVAL_SECONDS.
+
+    Вызывается из точек входа сервера (sixcoffee/wsgi.py, sixcoffee/asgi.py),
+    а не из AppConfig.ready(): иначе поток стартовал бы и в migrate, shell
+    и родительском процессе автоперезагрузки runserver.
+    """
+    global _sweeper
+    interval = getattr(settings, "LOYALTY_SWEEPER_INTERVAL_SECONDS", None)
+    if not interval or _sweeper is not None:
+        return _sweeper
+    _sweeper = CodeSweeper(interval, batch_size=getattr(settings, "LOYALTY_SWEEPER_BATCH_SIZE", 1000))
+    _sweeper.start()
+    return _sweeper
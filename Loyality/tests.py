@@ -1,3 +1,848 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib import admin
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.cache import cache
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory
+
+from . import async_views, idempotency, revocation, routers, status_cache
+from .admin import LoyaltyCodeAdmin
+from .authentication import LoyaltyRefreshToken
+from .codes import CodeAllocator, issue_code, offline_sync_window
+from .events import CHANGED, get_broker
+from .models import (
+    BaristaDailyStats,
+    IdempotencyKey,
+    LoyaltyCode,
+    LoyaltyProfile,
+    LoyaltyStamp,
+    RedeemedSignedCode,
+)
+from .signals import profile_changed
+from .signed_codes import sign_code
+from .sweeper import sweep_codes
+from .throttling import CodeIPThrottle
+
+
+def api_client(user):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {LoyaltyRefreshToken.for_user(user).access_token}")
+    return client
+
+
+class IssueCodeTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="client", password="secret")
+        # Пространство из 10 кодов: оборот последовательности наступает сразу
+        self.allocator = CodeAllocator(length=1, block_size=4, key="tests")
+
+    def _occupy(self, index, **fields):
+        fields.setdefault("expires_at", timezone.now() - offline_sync_window() - timedelta(minutes=1))
+        return LoyaltyCode.objects.create(user=self.user, code=self.allocator.permutation(index), **fields)
+
+    def test_reclaims_expired_unredeemed_code(self):
+        stale = self._occupy(0)
+        lc = issue_code(self.user.id, allocator=self.allocator)
+        self.assertEqual(lc.code, stale.code)
+        self.assertFalse(LoyaltyCode.objects.filter(pk=stale.pk).exists())
+
+    def test_keeps_redeemed_and_live_codes(self):
+        redeemed = self._occupy(0, redeemed=True, redeemed_at=timezone.now())
+        live = self._occupy(1, expires_at=timezone.now() + timedelta(minutes=5))
+        lc = issue_code(self.user.id, allocator=self.allocator)
+        self.assertEqual(lc.code, self.allocator.permutation(2))
+        self.assertTrue(LoyaltyCode.objects.filter(pk=redeemed.pk, redeemed=True).exists())
+        self.assertTrue(LoyaltyCode.objects.filter(pk=live.pk).exists())
+
+    def test_releases_code_redeemed_before_sync_window(self):
+        redeemed = self._occupy(0, redeemed=True, redeemed_at=timezone.now() - offline_sync_window() - timedelta(hours=1))
+        lc = issue_code(self.user.id, allocator=self.allocator)
+        self.assertEqual(lc.code, redeemed.code)
+        # Строка погашения осталась для статистики, номер отдан новому коду
+        self.assertTrue(LoyaltyCode.objects.filter(pk=redeemed.pk, redeemed=True, code=None).exists())
+
+    def test_generate_code_answers_503_when_code_space_is_exhausted(self):
+        owner = get_user_model().objects.create_user(username="owner", password="secret")
+        for index in range(10):
+            LoyaltyCode.objects.create(user=owner, code=self.allocator.permutation(index),
+                                       expires_at=timezone.now() + timedelta(minutes=5))
+
+        with mock.patch("Loyality.codes.get_allocator", return_value=self.allocator):
+            response = api_client(self.user).post("/api/loyalty/generate-code/")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+
+
+@override_settings(LOYALTY_MAX_STAMPS=6)
+class ConditionalStampUpdateTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="client", password="secret")
+
+    def _stamps(self):
+        return LoyaltyProfile.objects.get(user=self.user).stamps
+
+    def test_creates_profile_on_first_grant(self):
+        self.assertEqual(LoyaltyProfile.objects.add_stamps(self.user.id, 2), (2, 2))
+        self.assertEqual(self._stamps(), 2)
+
+    def test_adds_whole_count_when_it_fits(self):
+        LoyaltyProfile.objects.create(user=self.user, stamps=3)
+        self.assertEqual(LoyaltyProfile.objects.add_stamps(self.user.id, 3), (6, 3))
+        self.assertEqual(self._stamps(), 6)
+
+    def test_adds_only_remainder_up_to_cap(self):
+        LoyaltyProfile.objects.create(user=self.user, stamps=5)
+        self.assertEqual(LoyaltyProfile.objects.add_stamps(self.user.id, 4), (6, 1))
+        self.assertEqual(self._stamps(), 6)
+
+    @override_settings(LOYALTY_MAX_STAMPS=4)
+    def test_clamp_command_cuts_stamps_above_limit(self):
+        LoyaltyProfile.objects.create(user=self.user, stamps=6)
+        other = LoyaltyProfile.objects.create(user=get_user_model().objects.create_user(username="other"), stamps=3)
+
+        call_command("clamp_loyalty_stamps", stdout=StringIO())
+
+        self.assertEqual(self._stamps(), 4)
+        other.refresh_from_db()
+        self.assertEqual(other.stamps, 3)
+
+    def test_full_card_adds_nothing(self):
+        LoyaltyProfile.objects.create(user=self.user, stamps=6)
+        self.assertEqual(LoyaltyProfile.objects.add_stamps(self.user.id, 1), (6, 0))
+        self.assertEqual(self._stamps(), 6)
+
+    def test_reset_returns_previous_count(self):
+        LoyaltyProfile.objects.create(user=self.user, stamps=4)
+        self.assertEqual(LoyaltyProfile.objects.reset_stamps(self.user.id), 4)
+        self.assertEqual(self._stamps(), 0)
+        self.assertEqual(LoyaltyProfile.objects.reset_stamps(self.user.id), 0)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                       "LOCATION": "loyalty-tests"}})
+class StatusCacheTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="client", password="secret")
+        LoyaltyProfile.objects.create(user=self.user, stamps=1)
+
+    def test_reader_that_loaded_before_change_does_not_cache_stale_status(self):
+        load = status_cache._load
+
+        def load_then_change(**lookup):
+            loaded = load(**lookup)
+            # Начисление закоммитилось и сбросило кэш, пока читатель держал старую строку
+            LoyaltyProfile.objects.filter(user=self.user).update(stamps=5)
+            status_cache.invalidate(self.user.id)
+            return loaded
+
+        with mock.patch.object(status_cache, "_load", load_then_change):
+            self.assertEqual(status_cache.get_status(self.user.id)["stamps"], 1)
+        self.assertEqual(status_cache.get_status(self.user.id)["stamps"], 5)
+
+
+@override_settings(LOYALTY_MAX_STAMPS=6)
+class BatchRedeemTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.barista = api_client(User.objects.create_user(username="barista", password="secret", is_barista=True))
+        self.alice = User.objects.create_user(username="alice", password="secret")
+        self.bob = User.objects.create_user(username="bob", password="secret")
+        LoyaltyProfile.objects.create(user=self.alice, stamps=5)
+        LoyaltyProfile.objects.create(user=self.bob, stamps=0)
+
+    def _code(self, user, code, expires_in=timedelta(minutes=10), **fields):
+        return LoyaltyCode.objects.create(user=user, code=code, expires_at=timezone.now() + expires_in, **fields)
+
+    def _redeem(self, *entries):
+        return self.barista.post("/api/loyalty/redeem-codes/", {"codes": list(entries)}, format="json")
+
+    def _stamps(self, user):
+        return LoyaltyProfile.objects.get(user=user).stamps
+
+    def test_mixed_batch_reports_each_code(self):
+        self._code(self.bob, "100001")
+        self._code(self.alice, "100002")
+        self._code(self.alice, "100003")
+        self._code(self.bob, "100004", expires_in=-timedelta(minutes=1))
+        self._code(self.bob, "100005", redeemed=True, redeemed_at=timezone.now())
+        signed, _ = sign_code(self.bob.id)
+
+        codes = ["100001", "100002", "100003", "100004", "100005", "999999", "100001", signed]
+        response = self._redeem(*({"code": code} for code in codes))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["status"] for result in response.data["results"]],
+                         [200, 200, 400, 400, 400, 404, 400, 200])
+        self.assertEqual(response.data["redeemed"], 3)
+        self.assertEqual(self._stamps(self.alice), 6)
+        self.assertEqual(self._stamps(self.bob), 2)
+        # Код сверх лимита не гасится — его можно предъявить после сброса
+        self.assertFalse(LoyaltyCode.objects.get(code="100003").redeemed)
+
+    def test_code_scanned_while_valid_is_accepted_after_expiry(self):
+        lc = self._code(self.bob, "100001", expires_in=-timedelta(hours=1))
+        LoyaltyCode.objects.filter(pk=lc.pk).update(created_at=lc.expires_at - timedelta(minutes=15))
+        sweep_codes()
+
+        response = self._redeem({"code": "100001", "scanned_at": (lc.expires_at - timedelta(minutes=5)).isoformat()})
+        self.assertEqual(response.data["results"][0]["status"], 200)
+        self.assertEqual(self._stamps(self.bob), 1)
+
+    def test_signed_code_replay_after_sweep_is_rejected(self):
+        issued_at = timezone.now() - timedelta(hours=2)
+        signed, _ = sign_code(self.bob.id, now=issued_at)
+        entry = {"code": signed, "scanned_at": (issued_at + timedelta(minutes=1)).isoformat()}
+        self.assertEqual(self._redeem(entry).data["results"][0]["status"], 200)
+
+        sweep_codes(now=timezone.now() + timedelta(minutes=20))
+        self.assertTrue(RedeemedSignedCode.objects.filter(user=self.bob).exists())
+        self.assertEqual(self._redeem(entry).data["results"][0]["status"], 400)
+        self.assertEqual(self._stamps(self.bob), 1)
+
+    def test_scan_older_than_offline_window_is_rejected(self):
+        issued_at = timezone.now() - offline_sync_window() - timedelta(minutes=5)
+        signed, _ = sign_code(self.bob.id, now=issued_at)
+        response = self._redeem({"code": signed, "scanned_at": (issued_at + timedelta(minutes=1)).isoformat()})
+        self.assertEqual(response.data["results"][0]["status"], 400)
+        self.assertEqual(self._stamps(self.bob), 0)
+
+
+@override_settings(LOYALTY_MAX_STAMPS=6)
+class AddStampsManyTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.users = [User.objects.create_user(username=f"user{i}", password="secret") for i in range(4)]
+
+    def test_clamps_each_user_to_limit(self):
+        partial, full, fresh, untouched = (user.id for user in self.users)
+        LoyaltyProfile.objects.create(user_id=partial, stamps=4)
+        LoyaltyProfile.objects.create(user_id=full, stamps=6)
+
+        result = LoyaltyProfile.objects.add_stamps_many({partial: 5, full: 1, fresh: 10, untouched: 0})
+
+        self.assertEqual(result, {partial: (6, 2), full: (6, 0), fresh: (6, 6)})
+        self.assertEqual(dict(LoyaltyProfile.objects.values_list("user_id", "stamps")),
+                         {partial: 6, full: 6, fresh: 6})
+
+    def test_batch_endpoint_merges_case_variants_and_clamps(self):
+        barista = get_user_model().objects.create_user(username="barista", password="secret", is_staff=True)
+        LoyaltyProfile.objects.create(user=self.users[0], stamps=5)
+
+        response = api_client(barista).post("/api/loyalty/add-stamps/", {"items": [
+            {"username": "USER0", "amount": 1},
+            {"username": "user0", "amount": 1},
+            {"username": "user1", "amount": 2},
+            {"username": "ghost"},
+        ]}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row["username"], row["stamps_added"], row["stamps_total"])
+                          for row in response.data["results"]], [("user0", 1, 6), ("user1", 2, 2)])
+        self.assertEqual(response.data["not_found"], ["ghost"])
+
+
+class RegisterTests(TestCase):
+    def test_rejects_case_variant_of_existing_username(self):
+        get_user_model().objects.create_user(username="Alice", password="secret")
+
+        response = APIClient().post("/api/register/", {"username": " alice", "password": "secret123"}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("username", response.data)
+        self.assertEqual(get_user_model().objects.filter(username_key="alice").count(), 1)
+
+
+class AdminPrefixSearchTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        expires_at = timezone.now() + timedelta(minutes=10)
+        self.alice = User.objects.create_user(username="Alice", password="secret")
+        self.digits = User.objects.create_user(username="1234", password="secret")
+        LoyaltyCode.objects.create(user=self.alice, code="123456", expires_at=expires_at)
+        LoyaltyCode.objects.create(user=self.digits, code="654321", expires_at=expires_at)
+        self.model_admin = LoyaltyCodeAdmin(LoyaltyCode, admin.site)
+
+    def _search(self, term):
+        queryset, _ = self.model_admin.get_search_results(None, LoyaltyCode.objects.all(), term)
+        return queryset
+
+    def test_digits_search_code_only(self):
+        queryset = self._search("123")
+        self.assertEqual(list(queryset.values_list("code", flat=True)), ["123456"])
+        self.assertNotIn(" OR ", str(queryset.query))
+
+    def test_other_terms_search_username_via_subquery(self):
+        queryset = self._search(" ALI")
+        self.assertEqual(list(queryset.values_list("code", flat=True)), ["123456"])
+        self.assertNotIn("JOIN", str(queryset.query))
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.barista = User.objects.create_user(username="barista", password="secret", is_staff=True)
+        self.customer = User.objects.create_user(username="alice", password="secret")
+        LoyaltyProfile.objects.create(user=self.customer)
+        self.client = api_client(self.barista)
+
+    def _add_stamp(self, key, amount=1):
+        return self.client.post("/api/loyalty/add-stamp/", {"username": "alice", "amount": amount},
+                                format="json", headers={"Idempotency-Key": key})
+
+    def test_retry_replays_stored_response(self):
+        first = self._add_stamp("order-1")
+        second = self._add_stamp("order-1")
+
+        self.assertEqual(second.status_code, first.status_code)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(LoyaltyProfile.objects.stamps_for(self.customer.id), 1)
+        self.assertEqual(LoyaltyStamp.objects.count(), 1)
+
+    def test_same_key_with_other_body_is_rejected(self):
+        self._add_stamp("order-1")
+        response = self._add_stamp("order-1", amount=2)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(LoyaltyProfile.objects.stamps_for(self.customer.id), 1)
+
+    def test_result_is_rolled_back_when_key_was_taken_over(self):
+        def handler():
+            LoyaltyProfile.objects.add_stamps(self.customer.id)
+            # Пока handler работал, ключ признан зависшим и занят повтором
+            IdempotencyKey.objects.all().delete()
+            IdempotencyKey.objects.create(user_id=self.barista.id, scope="add-stamp", key="other", fingerprint="",
+                                          expires_at=timezone.now() + timedelta(hours=1))
+            return {}, 200
+
+        with self.assertRaises(idempotency.IdempotencyError) as raised:
+            idempotency.call(self.barista.id, "add-stamp", "order-1", {}, handler)
+
+        self.assertEqual(raised.exception.status, 409)
+        self.assertEqual(LoyaltyProfile.objects.stamps_for(self.customer.id), 0)
+
+
+class ExportTests(TestCase):
+    def test_only_superuser_can_export(self):
+        User = get_user_model()
+        admin_user = User.objects.create_superuser(username="admin", password="secret")
+        barista = User.objects.create_user(username="barista", password="secret", is_staff=True)
+
+        response = api_client(admin_user).get("/api/loyalty/export/", {"kind": "stamps"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"id,"))
+
+        self.assertEqual(api_client(barista).get("/api/loyalty/export/").status_code, 403)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ClaimsAuthenticationTests(TestCase):
+    def setUp(self):
+        status_cache._cache().clear()
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+        LoyaltyProfile.objects.create(user=self.user)
+        self.client = api_client(self.user)
+        self.assertEqual(self.client.get("/api/me/").status_code, 200)  # статус теперь в кэше
+
+    def test_deactivated_user_is_rejected(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save(update_fields=["is_active"])
+
+        self.assertEqual(self.client.get("/api/me/").status_code, 401)
+
+    def test_deleted_user_is_rejected(self):
+        self.user.delete()
+
+        self.assertEqual(self.client.get("/api/me/").status_code, 401)
+        self.assertEqual(self.client.get("/api/user/profile/").status_code, 401)
+
+
+class ProfileEventsTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+
+    def test_change_without_subscribers_costs_no_query(self):
+        with self.assertNumQueries(0):
+            profile_changed.send(sender=LoyaltyProfile, user_id=self.user.id)
+
+    def test_subscriber_is_notified(self):
+        async def listen():
+            broker = get_broker()
+            queue = broker.subscribe(self.user.id)
+            try:
+                # Публикация приходит из потока синхронной вьюхи
+                await sync_to_async(profile_changed.send, thread_sensitive=False)(
+                    sender=LoyaltyProfile, user_id=self.user.id,
+                )
+                return await asyncio.wait_for(queue.get(), timeout=1)
+            finally:
+                broker.unsubscribe(self.user.id, queue)
+
+        self.assertIs(async_to_sync(listen)(), CHANGED)
+
+
+def throttle_settings(**overrides):
+    return {**settings.REST_FRAMEWORK, **overrides,
+            "DEFAULT_THROTTLE_RATES": {**settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"], "code_ip": "3/min"}}
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                   REST_FRAMEWORK=throttle_settings())
+class ThrottleTests(TestCase):
+    def setUp(self):
+        status_cache._cache().clear()
+        self.factory = APIRequestFactory()
+
+    def _allowed(self, **headers):
+        throttle = CodeIPThrottle()
+        allowed = throttle.allow_request(self.factory.post("/", REMOTE_ADDR="10.0.0.1", **headers), None)
+        return allowed, throttle.wait()
+
+    def test_burst_limit(self):
+        results = [self._allowed() for _ in range(4)]
+        self.assertEqual([allowed for allowed, _ in results], [True, True, True, False])
+        self.assertGreater(results[-1][1], 0)
+
+    def test_concurrent_attempts_do_not_exceed_limit(self):
+        barrier, results = threading.Barrier(10), []
+
+        def attempt():
+            barrier.wait()
+            results.append(self._allowed()[0])
+
+        threads = [threading.Thread(target=attempt) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 3)
+
+    def test_forwarded_for_is_ignored_without_proxies(self):
+        for n in range(3):
+            self.assertTrue(self._allowed(HTTP_X_FORWARDED_FOR=f"1.1.1.{n}")[0])
+        self.assertFalse(self._allowed(HTTP_X_FORWARDED_FOR="1.1.1.9")[0])
+
+    @override_settings(REST_FRAMEWORK=throttle_settings(NUM_PROXIES=1))
+    def test_client_address_is_taken_from_last_proxy_hop(self):
+        # Подставленный клиентом левый адрес не меняет ключ — важен добавленный nginx
+        for n in range(3):
+            self.assertTrue(self._allowed(HTTP_X_FORWARDED_FOR=f"1.1.1.{n}, 203.0.113.5")[0])
+        self.assertFalse(self._allowed(HTTP_X_FORWARDED_FOR="1.1.1.9, 203.0.113.5")[0])
+        self.assertTrue(self._allowed(HTTP_X_FORWARDED_FOR="203.0.113.6")[0])
+
+
+class RebuildBaristaStatsTests(TestCase):
+    def setUp(self):
+        self.barista = get_user_model().objects.create_user(username="barista", password="secret", is_staff=True)
+        self.customer = get_user_model().objects.create_user(username="alice", password="secret")
+
+    def _rebuild(self):
+        call_command("rebuild_barista_stats", stdout=StringIO())
+        return {day: (codes, stamps) for day, codes, stamps in
+                BaristaDailyStats.objects.values_list("day", "codes_activated", "stamps_given")}
+
+    def test_keeps_codes_for_days_whose_signed_markers_are_swept(self):
+        today = timezone.localdate()
+        old_day = today - timedelta(days=3)
+        # db-режим по умолчанию, но подписанные коды принимаются и в нём
+        BaristaDailyStats.objects.create(barista=self.barista, day=old_day, codes_activated=2, stamps_given=2)
+        RedeemedSignedCode.objects.create(user=self.customer, window=1, redeemed_by=self.barista)
+        LoyaltyStamp.objects.create(user=self.customer, quantity=1, created_by=self.barista)
+
+        self.assertEqual(self._rebuild(), {old_day: (2, 0), today: (1, 1)})
+
+
+@override_settings(LOYALTY_CODE_MODE="signed")
+class SignedCodeTests(TestCase):
+    def setUp(self):
+        self.customer = get_user_model().objects.create_user(username="alice", password="secret")
+        LoyaltyProfile.objects.create(user=self.customer)
+        self.barista = api_client(get_user_model().objects.create_user(username="barista", password="secret",
+                                                                       is_staff=True))
+
+    def test_code_is_issued_without_a_row_and_redeemed_once(self):
+        code = api_client(self.customer).post("/api/loyalty/generate-code/").data["code"]
+        self.assertFalse(LoyaltyCode.objects.exists())
+
+        first = self.barista.post("/api/loyalty/redeem-code/", {"code": code}, format="json")
+        second = self.barista.post("/api/loyalty/redeem-code/", {"code": code}, format="json")
+
+        self.assertEqual((first.status_code, first.data["stamps"]), (200, 1))
+        self.assertEqual(second.status_code, 400)
+        self.assertEqual(RedeemedSignedCode.objects.count(), 1)
+
+    def test_forged_and_expired_codes_are_rejected(self):
+        code, _ = sign_code(self.customer.id)
+        forged = code[:-1] + ("0" if code[-1] != "0" else "1")
+        expired, _ = sign_code(self.customer.id, now=timezone.now() - timedelta(minutes=30))
+
+        self.assertEqual(self.barista.post("/api/loyalty/check-code/", {"code": forged}, format="json").status_code, 404)
+        self.assertEqual(self.barista.post("/api/loyalty/check-code/", {"code": expired}, format="json").status_code, 400)
+
+
+@override_settings(LOYALTY_CODE_TTL_MINUTES=15)
+class GenerateCodeTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+        self.client = api_client(self.user)
+
+    def _generate(self):
+        return self.client.post("/api/loyalty/generate-code/")
+
+    def test_repeated_tap_returns_the_same_code(self):
+        self.assertEqual(self._generate().data["code"], self._generate().data["code"])
+        self.assertEqual(LoyaltyCode.objects.count(), 1)
+
+    def test_code_is_extended_when_less_than_half_ttl_is_left(self):
+        code = self._generate().data["code"]
+        LoyaltyCode.objects.update(expires_at=timezone.now() + timedelta(minutes=5))
+
+        self.assertEqual(self._generate().data["code"], code)
+        self.assertGreater(LoyaltyCode.objects.get().expires_at, timezone.now() + timedelta(minutes=14))
+
+    @override_settings(LOYALTY_CODE_REUSE=False, LOYALTY_MAX_LIVE_CODES=2)
+    def test_live_code_limit(self):
+        self.assertEqual([self._generate().status_code for _ in range(3)], [200, 200, 429])
+        self.assertEqual(LoyaltyCode.objects.count(), 2)
+
+
+class SweepCodesTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+        now = timezone.now()
+        for n, expires_at in enumerate([
+            now - offline_sync_window() - timedelta(hours=1),
+            now - offline_sync_window() - timedelta(hours=2),
+            now - offline_sync_window() - timedelta(hours=3),
+            now - timedelta(minutes=1),  # ещё в окне офлайн-синхронизации
+            now + timedelta(minutes=10),
+        ]):
+            LoyaltyCode.objects.create(user=self.user, code=f"10000{n}", expires_at=expires_at)
+
+    def test_removes_only_codes_past_the_sync_window_in_batches(self):
+        removed = sweep_codes(batch_size=2)
+
+        self.assertEqual(removed["expired"], 3)
+        self.assertEqual(sorted(LoyaltyCode.objects.values_list("code", flat=True)), ["100003", "100004"])
+
+    def test_archive_restores_with_loaddata(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "codes.jsonl")
+            call_command("sweep_loyalty_codes", "--batch-size", "2", "--pause", "0", "--archive", path, stdout=StringIO())
+            self.assertEqual(LoyaltyCode.objects.count(), 2)
+
+            call_command("loaddata", path, verbosity=0)
+
+        self.assertEqual(LoyaltyCode.objects.count(), 5)
+
+
+class ReadOnlyStatusTests(TestCase):
+    def test_registration_creates_profile(self):
+        response = APIClient().post("/api/register/", {"username": "alice", "password": "secret123"}, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(LoyaltyProfile.objects.get(user__username="alice").stamps, 0)
+
+    def test_reads_do_not_create_missing_profile(self):
+        user = get_user_model().objects.create_user(username="legacy", password="secret")
+        client = api_client(user)
+
+        self.assertEqual(client.get("/api/me/").data["stamps"], 0)
+        self.assertEqual(client.get("/api/loyalty/status/", {"username": "legacy"}).data["stamps"], 0)
+        self.assertEqual(client.get("/api/user/profile/").status_code, 200)
+        self.assertFalse(LoyaltyProfile.objects.exists())
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+        LoyaltyProfile.objects.create(user=self.user)
+        self.client = api_client(self.user)
+
+    def test_matching_etag_answers_304_until_stamps_change(self):
+        for path, params in (("/api/me/", {}), ("/api/loyalty/status/", {"username": "alice"}), ("/api/user/profile/", {})):
+            first = self.client.get(path, params)
+            etag = first["ETag"]
+
+            repeat = self.client.get(path, params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(repeat.status_code, 304, path)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                LoyaltyProfile.objects.add_stamps(self.user.id)
+            changed = self.client.get(path, params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(changed.status_code, 200, path)
+            self.assertNotEqual(changed["ETag"], etag)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.customer = User.objects.create_user(username="alice", password="secret")
+        LoyaltyProfile.objects.create(user=self.customer)
+        barista = User.objects.create_user(username="barista", password="secret", is_staff=True)
+        self.as_customer = {"Authorization": f"Bearer {LoyaltyRefreshToken.for_user(self.customer).access_token}"}
+        self.as_barista = {"Authorization": f"Bearer {LoyaltyRefreshToken.for_user(barista).access_token}"}
+        self.factory = AsyncRequestFactory()
+
+    async def test_generate_redeem_and_read_status(self):
+        response = await async_views.generate_loyalty_code(self.factory.post("/", headers=self.as_customer))
+        code = json.loads(response.content)["code"]
+
+        response = await async_views.redeem_loyalty_code(self.factory.post(
+            "/", {"code": code}, content_type="application/json", headers=self.as_barista,
+        ))
+        self.assertEqual(response.status_code, 200)
+
+        response = await async_views.me(self.factory.get("/", headers=self.as_customer))
+        self.assertEqual(json.loads(response.content)["stamps"], 1)
+        response = await async_views.get_loyalty_status(self.factory.get("/", {"username": "ALICE"},
+                                                                         headers=self.as_barista))
+        self.assertEqual(json.loads(response.content)["stamps"], 1)
+
+    async def test_rejects_anonymous_requests_and_non_object_bodies(self):
+        self.assertEqual((await async_views.me(self.factory.get("/"))).status_code, 401)
+        response = await async_views.redeem_loyalty_code(self.factory.post(
+            "/", [1, 2], content_type="application/json", headers=self.as_barista,
+        ))
+        self.assertEqual(response.status_code, 400)
+
+
+class RevocationTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+        patcher = mock.patch.object(revocation, "_filter", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _refresh(self, token):
+        return APIClient().post("/api/token/refresh/", {"refresh": token}, format="json")
+
+    def test_rotated_refresh_token_is_rejected(self):
+        old = str(LoyaltyRefreshToken.for_user(self.user))
+        rotated = self._refresh(old)
+        self.assertEqual(rotated.status_code, 200)
+
+        self.assertEqual(self._refresh(old).status_code, 401)
+        # Другой процесс: фильтр в памяти пуст и догружается из журнала
+        revocation._filter = None
+        self.assertEqual(self._refresh(old).status_code, 401)
+        self.assertEqual(self._refresh(rotated.data["refresh"]).status_code, 200)
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = revocation.BloomFilter(capacity=1000, error_rate=0.01)
+        items = [f"jti-{n}" for n in range(1000)]
+        for item in items:
+            bloom.add(item)
+
+        self.assertTrue(all(item in bloom for item in items))
+        false_positives = sum(f"other-{n}" in bloom for n in range(10_000))
+        self.assertLess(false_positives, 300)
+
+
+class StampLedgerTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.barista = User.objects.create_user(username="barista", password="secret", is_staff=True)
+        self.customer = User.objects.create_user(username="alice", password="secret")
+
+    def test_grant_of_several_stamps_is_one_row(self):
+        response = api_client(self.barista).post("/api/loyalty/add-stamp/", {"username": "alice", "amount": 3},
+                                                 format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(LoyaltyStamp.objects.values_list("user_id", "quantity", "created_by_id")),
+                         [(self.customer.id, 3, self.barista.id)])
+
+    def test_compact_command_merges_one_stamp_rows_and_keeps_totals(self):
+        for _ in range(4):
+            LoyaltyStamp.objects.create(user=self.customer, created_by=self.barista, source="manual")
+        LoyaltyStamp.objects.create(user=self.customer, created_by=self.barista, source="code")
+        for _ in range(2):
+            LoyaltyStamp.objects.create(user=self.customer, created_by=None, source="manual")
+
+        call_command("compact_loyalty_stamps", "--batch-size", "3", stdout=StringIO())
+
+        self.assertEqual(list(LoyaltyStamp.objects.order_by("id").values_list("source", "created_by_id", "quantity")),
+                         [("manual", self.barista.id, 4), ("code", self.barista.id, 1), ("manual", None, 2)])
+
+
+class CustomerSearchTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.barista = User.objects.create_user(username="barista", password="secret", is_staff=True)
+        self.alice = User.objects.create_user(username="Alice", password="secret", phone="8 (912) 345-67-89")
+        self.bob = User.objects.create_user(username="bob", password="secret", name="Алёна Петрова")
+        LoyaltyProfile.objects.create(user=self.alice, stamps=2)
+
+    def _search(self, q, user=None):
+        return api_client(user or self.barista).get("/api/loyalty/search/", {"q": q})
+
+    def _usernames(self, q):
+        response = self._search(q)
+        self.assertEqual(response.status_code, 200)
+        return [row["username"] for row in response.data["results"]]
+
+    def test_matches_username_name_and_both_ends_of_phone(self):
+        self.assertEqual(self._usernames("ALI"), ["Alice"])
+        self.assertEqual(self._usernames("алена"), ["bob"])
+        self.assertEqual(self._usernames("+7 912"), ["Alice"])
+        self.assertEqual(self._usernames("67-89"), ["Alice"])
+        self.assertEqual(self._usernames("lice"), [])
+
+    def test_rows_carry_stamps_and_short_queries_return_nothing(self):
+        row = self._search("alice").data["results"][0]
+        self.assertEqual((row["id"], row["stamps"], row["max_stamps"]), (self.alice.id, 2, 6))
+        self.assertEqual(self._usernames("a"), [])
+        self.assertEqual(self._usernames("12"), [])
+
+    def test_only_staff_can_search(self):
+        self.assertEqual(self._search("ali", user=self.bob).status_code, 403)
+
+
+class StampHistoryTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", password="secret")
+        self.client = api_client(self.user)
+        now = timezone.now()
+        # Три начисления в одну и ту же микросекунду — граница страницы проходит внутри них
+        self.stamps = []
+        for created_at in (now - timedelta(hours=1), now, now, now, now + timedelta(hours=1)):
+            stamp = LoyaltyStamp.objects.create(user=self.user)
+            LoyaltyStamp.objects.filter(pk=stamp.pk).update(created_at=created_at)
+            self.stamps.append(stamp.pk)
+
+    def _page(self, **params):
+        response = self.client.get("/api/loyalty/history/", params)
+        self.assertEqual(response.status_code, 200)
+        return [row["id"] for row in response.data["results"]], response.data["next_cursor"]
+
+    def test_pages_cover_equal_timestamps_without_gaps_or_repeats(self):
+        seen, cursor = [], None
+        while True:
+            ids, cursor = self._page(limit=2, **({"cursor": cursor} if cursor else {}))
+            seen.extend(ids)
+            if cursor is None:
+                break
+            # Новое начисление между страницами не сдвигает уже выданные
+            LoyaltyStamp.objects.create(user=self.user)
+
+        oldest, *same_time, newest = self.stamps
+        self.assertEqual(seen, [newest, *reversed(same_time), oldest])
+
+    def test_rejects_broken_cursor(self):
+        response = self.client.get("/api/loyalty/history/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_only_staff_can_read_other_users_history(self):
+        barista = get_user_model().objects.create_user(username="barista", password="secret", is_staff=True)
+
+        response = api_client(barista).get("/api/loyalty/history/", {"user_id": self.user.id})
+        self.assertEqual(len(response.data["results"]), 5)
+        response = api_client(self.user).get("/api/loyalty/history/", {"user_id": barista.id})
+        self.assertEqual(response.status_code, 403)
+
+
+class ImportCustomersTests(TestCase):
+    def _import(self, content, suffix):
+        with tempfile.NamedTemporaryFile("w", suffix=suffix, encoding="utf-8", delete=False) as file:
+            file.write(content)
+        self.addCleanup(os.unlink, file.name)
+        out, err = StringIO(), StringIO()
+        call_command("import_customers", file.name, "--workers", "1", "--batch-size", "2", stdout=out, stderr=err)
+        return err.getvalue()
+
+    def test_csv_skips_duplicates_and_bad_rows(self):
+        get_user_model().objects.create_user(username="Alice", password="secret")
+
+        errors = self._import(
+            "username,password,name,phone,stamps\n"
+            "alice,,,,1\n"
+            "bob,secret123,Боб,8 900 000-12-34,3\n"
+            "BOB,,,,0\n"
+            ",,,,0\n"
+            "carol,,,,99\n"
+            "dave,,,,x\n"
+            "erin,,,,\n",
+            ".csv",
+        )
+
+        users = get_user_model().objects.exclude(username="Alice")
+        self.assertEqual(sorted(users.values_list("username", flat=True)), ["bob", "erin"])
+        bob = users.get(username="bob")
+        self.assertTrue(bob.check_password("secret123"))
+        self.assertEqual((bob.phone_key, bob.loyalty_profile.stamps), ("79000001234", 3))
+        self.assertFalse(users.get(username="erin").has_usable_password())
+        self.assertEqual([line.split(":")[0] for line in errors.splitlines()],
+                         ["запись 2", "запись 4", "запись 5", "запись 6", "запись 7"])
+
+    def test_json_lines_report_non_objects(self):
+        errors = self._import('{"username": "frank", "stamps": 2}\n[1, 2]\n{"username": "grace"}\n', ".jsonl")
+
+        self.assertEqual(dict(LoyaltyProfile.objects.values_list("user__username", "stamps")),
+                         {"frank": 2, "grace": 0})
+        self.assertEqual(errors.splitlines(), ["запись 2: ожидался объект"])
+
+
+@override_settings(
+    LOYALTY_REPLICA_DATABASES=["replica1"],
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "routers-tests"}},
+)
+class ReplicaRouterTests(SimpleTestCase):
+    # Без TestCase: его транзакция вокруг теста сама отправляет все чтения в основную БД
+    def setUp(self):
+        cache.clear()
+        self.router = routers.PrimaryReplicaRouter()
+
+    def _request(self, user_id=7):
+        request = RequestFactory().get("/")
+        request.user = mock.Mock(id=user_id, is_authenticated=True)
+        return request
+
+    def _read_db(self, request):
+        @routers.replica_reads
+        def view(request):
+            return self.router.db_for_read(LoyaltyProfile)
+
+        return routers.replica_stickiness_middleware(view)(request)
+
+    def test_reads_go_to_replica_except_inside_primary(self):
+        @routers.replica_reads
+        def view(request):
+            with routers.primary():
+                forced = self.router.db_for_read(LoyaltyProfile)
+            return self.router.db_for_read(LoyaltyProfile), forced
+
+        self.assertEqual(routers.replica_stickiness_middleware(view)(self._request()), ("replica1", "default"))
+        self.assertEqual(self.router.db_for_read(LoyaltyProfile), "default")  # вне @replica_reads
+
+    def test_writer_reads_primary_until_pin_expires(self):
+        def write(request):
+            self.router.db_for_write(LoyaltyProfile)
+            return self.router.db_for_read(LoyaltyProfile)
+
+        self.assertEqual(routers.replica_stickiness_middleware(write)(self._request()), "default")
+
+        self.assertEqual(self._read_db(self._request()), "default")
+        self.assertEqual(self._read_db(self._request(user_id=8)), "replica1")
+        cache.clear()
+        self.assertEqual(self._read_db(self._request()), "replica1")
+
+    def test_stamp_change_pins_customer(self):
+        profile_changed.send(sender=LoyaltyProfile, user_id=8)
+
+        self.assertEqual(self._read_db(self._request(user_id=8)), "default")
+        self.assertEqual(routers.pinned_among([7, 8]), set())  # вне вьюхи чтения и так из основной
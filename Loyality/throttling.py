@@ -0,0 +1,182 @@
+# Loyality/throttling.py — ограничение частоты входа и перебора кодов
+#
+# Вход и смена пароля гоняют PBKDF2 (сотни миллисекунд CPU на попытку), а
+# погашение/проверка кода позволяют перебирать 6-значное пространство. Троттлы
+# DRF срабатывают в APIView.initial() — до check_password и до select_for_update.
+#
+# Алгоритм — скользящее окно по двум счётчикам: на ключ в кэше лежит счётчик
+# текущего окна длиной в период ставки и счётчик предыдущего; число запросов
+# за последний период оценивается как текущий + доля предыдущего, которая ещё
+# попадает в период. "10/min" — не больше 10 запросов за любую минуту.
+# Счётчик меняется только атомарными cache.add/cache.incr, поэтому
+# параллельные попытки не читают одно и то же значение и лимит не пробивается
+# пачкой одновременных запросов; отклонённый запрос возвращает жетоны decr'ом.
+# Пакетный запрос может стоить несколько жетонов — см. throttle_cost у вьюхи.
+# Кэш — LOYALTY_THROTTLE_CACHE_ALIAS; при нескольких воркерах он должен быть
+# общим (Redis/memcached), иначе лимит действует на каждый процесс отдельно.
+# В бэкенде кэша incr должен быть атомарным (у DatabaseCache он не атомарен).
+
+import hashlib
+from contextlib import suppress
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class BucketRateThrottle(SimpleRateThrottle):
+    """Скользящее окно на атомарных счётчиках кэша Django; ключ — get_ident_value()."""
+
+    cache_format = "throttle:%(scope)s:%(ident)s"
+
+    def get_rate(self):
+        # Ставки читаем при каждом создании троттла, а не при импорте
+        # (SimpleRateThrottle.THROTTLE_RATES) — так работает override_settings
+        return api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, "LOYALTY_THROTTLE_CACHE_ALIAS", "default")]
+
+    def get_ident_value(self, request, view):
+        """Строка, по которой считается лимит; None — запрос не ограничивается."""
+        raise NotImplementedError(".get_ident_value() must be overridden")
+
+    def get_cache_key(self, request, view):
+        ident = self.get_ident_value(request, view)
+        if not ident:
+            return None
+        digest = hashlib.blake2b(str(ident).encode(), digest_size=12).hexdigest()
+        return self.cache_format % {"scope": self.scope, "ident": digest}
+
+    def get_cost(self, request, view):
+        """Сколько жетонов стоит запрос: view.throttle_cost(request), если задан, иначе 1."""
+        throttle_cost = getattr(view, "throttle_cost", None)
+        return throttle_cost(request) if throttle_cost else 1
+
+    def _windows(self):
+        """Ключи счётчиков текущего и предыдущего окна и доля текущего, что уже прошла."""
+        self.now = self.timer()
+        window, elapsed = divmod(self.now, self.duration)
+        self.elapsed = elapsed / self.duration
+        return f"{self.key}:{int(window)}", f"{self.key}:{int(window) - 1}"
+
+    def _decide(self, count, previous):
+        """count — текущее окно с учётом этого запроса. True — пропустить."""
+        previous, self.wait_seconds = previous or 0, 0
+        if count + previous * (1 - self.elapsed) <= self.num_requests:
+            return True
+        if previous and count <= self.num_requests:
+            # Ждать, пока доля предыдущего окна не уменьшится до остатка лимита
+            self.wait_seconds = ((1 - (self.num_requests - count) / previous) - self.elapsed) * self.duration
+        else:
+            self.wait_seconds = (1 - self.elapsed) * self.duration
+        return False
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        cost = self.get_cost(request, view)
+        current, previous = self._windows()
+        self.cache.add(current, 0, int(2 * self.duration) + 1)
+        try:
+            count = self.cache.incr(current, cost)
+        except ValueError:
+            return True  # счётчик вытеснен между add и incr (или кэш-заглушка)
+        if self._decide(count, self.cache.get(previous)):
+            return True
+        with suppress(ValueError):
+            self.cache.decr(current, cost)
+        return False
+
+    async def aallow_request(self, request, view=None):
+        """allow_request для async-вьюх (Loyality/async_views.py)."""
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        cost = self.get_cost(request, view)
+        current, previous = self._windows()
+        await self.cache.aadd(current, 0, int(2 * self.duration) + 1)
+        try:
+            count = await self.cache.aincr(current, cost)
+        except ValueError:
+            return True
+        if self._decide(count, await self.cache.aget(previous)):
+            return True
+        with suppress(ValueError):
+            await self.cache.adecr(current, cost)
+        return False
+
+    def wait(self):
+        return max(self.wait_seconds, 0)
+
+
+def _username(request):
+    data = getattr(request, "data", None)
+    if data is None:
+        data = request.POST
+    return (data.get("username") or "").strip().lower()
+
+
+class LoginIPThrottle(BucketRateThrottle):
+    scope = "login_ip"
+
+    def get_ident_value(self, request, view):
+        return self.get_ident(request)
+
+
+class LoginUsernameThrottle(BucketRateThrottle):
+    scope = "login_username"
+
+    def get_ident_value(self, request, view):
+        return _username(request)
+
+
+class PasswordChangeThrottle(BucketRateThrottle):
+    scope = "password_change"
+
+    def get_ident_value(self, request, view):
+        return request.user.id if request.user and request.user.is_authenticated else None
+
+
+class CodeIPThrottle(BucketRateThrottle):
+    scope = "code_ip"
+
+    def get_ident_value(self, request, view):
+        return self.get_ident(request)
+
+
+class CodeBaristaThrottle(BucketRateThrottle):
+    scope = "code_barista"
+
+    def get_ident_value(self, request, view):
+        return request.user.id if request.user and request.user.is_authenticated else None
+
+
+class CodeBatchIPThrottle(CodeIPThrottle):
+    scope = "code_batch_ip"
+
+
+class CodeBatchBaristaThrottle(CodeBaristaThrottle):
+    scope = "code_batch_barista"
+
+
+LOGIN_THROTTLES = [LoginIPThrottle, LoginUsernameThrottle]
+CODE_THROTTLES = [CodeIPThrottle, CodeBaristaThrottle]
+CODE_BATCH_THROTTLES = [CodeBatchIPThrottle, CodeBatchBaristaThrottle]
+
+
+async def athrottle(request, throttle_classes):
+    """Проверить троттлы в async-вьюхе. Возвращает секунды ожидания или None."""
+    waits = []
+    for throttle_class in throttle_classes:
+        throttle = throttle_class()
+        if not await throttle.aallow_request(request):
+            waits.append(throttle.wait())
+    return max(waits) if waits else None
@@ -1,5 +1,6 @@
 # Loyality/urls.py — полностью исправленная версия
 
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
@@ -18,16 +19,31 @@ from .views import (
     # Лояльность
     GenerateLoyaltyCodeView,
     RedeemLoyaltyCodeView,
+    RedeemLoyaltyCodesView,
     AddStampToUserView,
+    AddStampsBatchView,
 
     # ViewSet
     LoyaltyProfileViewSet,
     ResetLoyaltyView,
     CheckLoyaltyCodeView,
     get_loyalty_status,
+    get_loyalty_statuses,
+    search_loyalty_customers,
+    loyalty_stamp_history,
+    export_loyalty,
     barista_login_with_code,
     barista_stats,    
 )
+from . import async_views
+from .throttling import LOGIN_THROTTLES
+from .async_views import loyalty_events
+
+
+def _pick(name, sync_view, async_view):
+    """Async-вьюха, если имя маршрута перечислено в LOYALTY_ASYNC_ROUTES."""
+    return async_view if name in getattr(settings, "LOYALTY_ASYNC_ROUTES", ()) else sync_view
+
 
 # Роутер для ViewSet (если используешь)
 router = DefaultRouter()
@@ -35,12 +51,12 @@ router.register(r'loyalty-profile', LoyaltyProfileViewSet, basename='loyalty-pro
 
 urlpatterns = [
     # JWT
-    path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('token/', TokenObtainPairView.as_view(throttle_classes=LOGIN_THROTTLES), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 
     # Аутентификация
     path('register/', RegisterView.as_view(), name='register'),
-    path('me/', me, name='me'),  # наш простой me
+    path('me/', _pick('me', me, async_views.me), name='me'),  # наш простой me
     path('change_password/', ChangePasswordView.as_view(), name='change_password'),
 
     # Бариста
@@ -54,10 +70,17 @@ urlpatterns = [
     path('user/profile/', UserProfileView.as_view(), name='user-profile'),
 
     # Лояльность
-    path('loyalty/generate-code/', GenerateLoyaltyCodeView.as_view(), name='generate-loyalty-code'),
-    path('loyalty/redeem-code/', RedeemLoyaltyCodeView.as_view(), name='redeem-loyalty-code'),
+    path('loyalty/generate-code/', _pick('generate-loyalty-code', GenerateLoyaltyCodeView.as_view(), async_views.generate_loyalty_code), name='generate-loyalty-code'),
+    path('loyalty/redeem-code/', _pick('redeem-loyalty-code', RedeemLoyaltyCodeView.as_view(), async_views.redeem_loyalty_code), name='redeem-loyalty-code'),
+    path('loyalty/redeem-codes/', RedeemLoyaltyCodesView.as_view(), name='redeem-loyalty-codes'),  # офлайн-синхронизация
     path('loyalty/add-stamp/', AddStampToUserView.as_view(), name='add-stamp-to-user'),
+    path('loyalty/add-stamps/', AddStampsBatchView.as_view(), name='add-stamps-batch'),  # групповой заказ
     path('loyalty/reset/', ResetLoyaltyView.as_view(), name='loyalty-reset'),
     path('loyalty/check-code/', CheckLoyaltyCodeView.as_view(), name='check-loyalty-code'),
-    path('loyalty/status/', get_loyalty_status, name='loyalty-status'),
+    path('loyalty/status/', _pick('loyalty-status', get_loyalty_status, async_views.get_loyalty_status), name='loyalty-status'),
+    path('loyalty/statuses/', get_loyalty_statuses, name='loyalty-statuses'),
+    path('loyalty/search/', search_loyalty_customers, name='loyalty-search'),  # поиск по мере набора
+    path('loyalty/history/', loyalty_stamp_history, name='loyalty-history'),  # ?cursor= из next_cursor
+    path('loyalty/export/', export_loyalty, name='loyalty-export'),  # бухгалтерия, потоком
+    path('loyalty/events/', loyalty_events, name='loyalty-events'),  # SSE, только под ASGI
 ] + router.urls
\ No newline at end of file
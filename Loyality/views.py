@@ -1,30 +1,47 @@
 # Loyality/views.py — финальная исправленная версия
 
-import secrets
-import string
-from datetime import timedelta
+from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
 from django.utils import timezone
-from django.db.models import F
+from django.utils.dateparse import parse_date, parse_datetime
 
 from rest_framework import permissions, status, viewsets
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 
-from .models import LoyaltyProfile, LoyaltyCode, LoyaltyStamp
+from . import status_cache
+from .authentication import LoyaltyRefreshToken, resolve_user
+from .codes import CodeSpaceExhausted, LiveCodeLimitReached, get_or_issue_code, offline_sync_window
+from .idempotency import idempotent
+from .routers import replica_reads
+from .export import EXPORTS, FORMATS, date_range, export_rows, stream_export
+from .conditional import not_modified, status_etag, with_etag
+from .models import (
+    BaristaDailyStats,
+    LoyaltyCode,
+    LoyaltyProfile,
+    LoyaltyStamp,
+    RedeemedSignedCode,
+    normalize_username,
+)
+from .search import search_customers
+from .services import InvalidHistoryCursor, LoyaltyService
+from .signed_codes import SignedCodeError, is_signed_code, mark_redeemed, sign_code, verify_code
 from .serializers import (
     RegisterSerializer,
     ChangePasswordSerializer,
     BaristaTokenObtainPairSerializer,
     UserProfileSerializer,
 )
+from .throttling import CODE_BATCH_THROTTLES, CODE_THROTTLES, LOGIN_THROTTLES, LoginIPThrottle, PasswordChangeThrottle
 
 User = get_user_model()
 
@@ -36,7 +53,15 @@ class LoyaltyProfileViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return LoyaltyProfile.objects.filter(user=self.request.user)
+        return LoyaltyProfile.objects.filter(user_id=self.request.user.id)
+
+    @replica_reads
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @replica_reads
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
 
 # ==================== АУТЕНТИФИКАЦИЯ ====================
@@ -57,29 +82,46 @@ class RegisterView(APIView):
         return Response({"detail": "Пользователь успешно зарегистрирован"}, status=201)
 
 
+def _own_status(user):
+    """Статус текущего пользователя; удалён между аутентификацией и чтением — 401."""
+    loyalty = status_cache.get_status(user.id)
+    if loyalty is None:
+        raise AuthenticationFailed("Пользователь не найден", code="user_not_found")
+    return loyalty
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
+@replica_reads
 def me(request):
     u = request.user
-    profile, _ = LoyaltyProfile.objects.get_or_create(user=u)
-    return Response({
+    loyalty = _own_status(u)
+    is_staff, is_barista = bool(u.is_staff), bool(getattr(u, "is_barista", False))
+
+    etag = status_etag("me", loyalty, is_staff, is_barista)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+
+    return with_etag(Response({
         "id": u.id,
         "username": u.username,
-        "is_staff": bool(u.is_staff),
-        "is_barista": bool(getattr(u, "is_barista", False)),
-        "stamps": profile.stamps,
+        "is_staff": is_staff,
+        "is_barista": is_barista,
+        "stamps": loyalty["stamps"],
         "max_stamps": getattr(settings, "LOYALTY_MAX_STAMPS", 6),
-    })
+    }), etag)
 
 
 class ChangePasswordView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_classes = [PasswordChangeThrottle]
 
     def post(self, request):
         serializer = ChangePasswordSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        user = request.user
+        user = resolve_user(request.user)
         if not user.check_password(serializer.validated_data["old_password"]):
             return Response({"detail": "Старый пароль неверен"}, status=400)
 
@@ -90,6 +132,7 @@ class ChangePasswordView(APIView):
 
 class BaristaTokenObtainPairView(TokenObtainPairView):
     serializer_class = BaristaTokenObtainPairSerializer
+    throttle_classes = LOGIN_THROTTLES
 
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -102,7 +145,7 @@ class BaristaTokenObtainPairView(TokenObtainPairView):
                 "error": "Вас нет в списке барист. Обратитесь к администратору."
             }, status=403)
 
-        refresh = RefreshToken.for_user(user)
+        refresh = LoyaltyRefreshToken.for_user(user)
         return Response({
             "access": str(refresh.access_token),
             "refresh": str(refresh),
@@ -114,13 +157,20 @@ class BaristaTokenObtainPairView(TokenObtainPairView):
 class UserProfileView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @replica_reads
     def get(self, request):
-        serializer = UserProfileSerializer(request.user, context={"request": request})
-        return Response(serializer.data)
+        profile = _own_status(request.user)
+        etag = status_etag("profile", profile, profile["name"], profile["phone"])
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+
+        serializer = UserProfileSerializer(resolve_user(request.user), context={"request": request})
+        return with_etag(Response(serializer.data), etag)
 
     def patch(self, request):
         serializer = UserProfileSerializer(
-            request.user, data=request.data, partial=True, context={"request": request}
+            resolve_user(request.user), data=request.data, partial=True, context={"request": request}
         )
         serializer.is_valid(raise_exception=True)
         serializer.save()
@@ -131,6 +181,7 @@ class UserProfileView(APIView):
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
+@throttle_classes([LoginIPThrottle])
 def register_barista(request):
     username = (request.data.get("username") or "").strip()
     password = request.data.get("password")
@@ -146,7 +197,7 @@ def register_barista(request):
     if invite_code not in valid_codes:
         return Response({"error": "Неверный мастер-код"}, status=400)
 
-    if User.objects.filter(username__iexact=username).exists():
+    if User.objects.filter(username_key=normalize_username(username)).exists():
         return Response({"error": "Логин уже занят"}, status=409)
 
     try:
@@ -156,8 +207,9 @@ def register_barista(request):
             if hasattr(user, "is_barista"):
                 user.is_barista = True
             user.save()
+            LoyaltyProfile.objects.create(user=user)
 
-            refresh = RefreshToken.for_user(user)
+            refresh = LoyaltyRefreshToken.for_user(user)
             return Response({
                 "access": str(refresh.access_token),
                 "refresh": str(refresh),
@@ -169,6 +221,7 @@ def register_barista(request):
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
+@throttle_classes([LoginIPThrottle])
 def verify_barista_code(request):
     code = (request.data.get("employee_code") or "").strip()
     if not code:
@@ -182,6 +235,7 @@ def verify_barista_code(request):
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
+@throttle_classes(LOGIN_THROTTLES)
 def barista_login_with_code(request):
     username = (request.data.get("username") or "").strip()
     password = request.data.get("password")
@@ -205,7 +259,7 @@ def barista_login_with_code(request):
     if not (user.is_staff or getattr(user, "is_barista", False)):
         return Response({"error": "Вас нет в списке барист."}, status=403)
     
-    refresh = RefreshToken.for_user(user)
+    refresh = LoyaltyRefreshToken.for_user(user)
     return Response({
         "access": str(refresh.access_token),
         "refresh": str(refresh),
@@ -214,74 +268,301 @@ def barista_login_with_code(request):
 
 # ==================== ЛОЯЛЬНОСТЬ ====================
 
-def _unique_code(length=6):
-    while True:
-        code = "".join(secrets.choice(string.digits) for _ in range(length))
-        if not LoyaltyCode.objects.filter(code=code, redeemed=False, expires_at__gt=timezone.now()).exists():
-            return code
-
-
 class GenerateLoyaltyCodeView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        code = _unique_code()
-        expires_at = timezone.now() + timedelta(minutes=15)
-        LoyaltyCode.objects.create(user=request.user, code=code, expires_at=expires_at)
-        return Response({"code": code, "expires_at": expires_at.isoformat()})
+        if getattr(settings, "LOYALTY_CODE_MODE", "db") == "signed":
+            # Подписанный код: ничего не пишем в БД
+            code, expires_at = sign_code(request.user.id)
+            return Response({"code": code, "expires_at": expires_at.isoformat()})
+
+        try:
+            lc = get_or_issue_code(request.user.id)
+        except LiveCodeLimitReached as e:
+            return Response({"detail": str(e)}, status=429)
+        except CodeSpaceExhausted:
+            return Response({"detail": "Не удалось выдать код, повторите позже"}, status=503,
+                            headers={"Retry-After": "1"})
+        return Response({"code": lc.code, "expires_at": lc.expires_at.isoformat()})
+
+
+# АКТИВАЦИЯ КОДА С НАЧИСЛЕНИЕМ ШТАМПА — общая часть для sync- и async-вьюх
+def redeem_code(code, barista):
+    """Погасить код и начислить штамп. Возвращает (тело ответа, HTTP-статус)."""
+    if is_signed_code(code):
+        return _redeem_signed_code(code, barista)
+
+    try:
+        with transaction.atomic():
+            lc = LoyaltyCode.objects.select_related("user").select_for_update(of=("self",)).get(code=code)
+
+            if lc.redeemed:
+                return {"detail": "Код уже использован"}, 400
+            if timezone.now() > lc.expires_at:
+                return {"detail": "Код истёк"}, 400
+
+            # Начисляем штамп клиенту (код не гасим, если лимит уже достигнут)
+            stamps, added = LoyaltyProfile.objects.add_stamps(lc.user_id, 1)
+            if not added:
+                return {"detail": f"Лимит достигнут ({stamps})"}, 400
+
+            # Активируем код
+            lc.redeemed = True
+            lc.redeemed_at = timezone.now()
+            lc.redeemed_by_id = barista.id
+            lc.save(update_fields=["redeemed", "redeemed_at", "redeemed_by"])
+
+            # Записываем в статистику штампов
+            LoyaltyStamp.objects.create(
+                user_id=lc.user_id,
+                source="code",
+                created_by_id=barista.id
+            )
+            BaristaDailyStats.objects.bump(barista.id, codes=1, stamps=1)
+
+            return {
+                "detail": "Штамп успешно начислен",
+                "stamps": stamps,
+                "client": lc.user.username
+            }, 200
+
+    except LoyaltyCode.DoesNotExist:
+        return {"detail": "Код не найден"}, 404
+
+
+def _redeem_signed_code(code, barista):
+    # Подпись и срок проверяются без БД, пишем только факт погашения
+    try:
+        user_id, window = verify_code(code)
+    except SignedCodeError as e:
+        return {"detail": str(e)}, e.status
+
+    client = User.objects.filter(pk=user_id).values_list("username", flat=True).first()
+    if client is None:
+        return {"detail": "Код не найден"}, 404
+
+    with transaction.atomic():
+        if not mark_redeemed(user_id, window, redeemed_by_id=barista.id):
+            return {"detail": "Код уже использован"}, 400
+
+        stamps, added = LoyaltyProfile.objects.add_stamps(user_id, 1)
+        if not added:
+            # Откатываем отметку о погашении — код можно будет использовать после сброса
+            transaction.set_rollback(True)
+            return {"detail": f"Лимит достигнут ({stamps})"}, 400
+
+        LoyaltyStamp.objects.create(
+            user_id=user_id,
+            source="code",
+            created_by_id=barista.id
+        )
+        BaristaDailyStats.objects.bump(barista.id, codes=1, stamps=1)
+
+    return {
+        "detail": "Штамп успешно начислен",
+        "stamps": stamps,
+        "client": client
+    }, 200
 
 
-# АКТИВАЦИЯ КОДА С НАЧИСЛЕНИЕМ ШТАМПА — рабочий Redeem
 class RedeemLoyaltyCodeView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_classes = CODE_THROTTLES
 
+    @idempotent("redeem-code")
     def post(self, request):
         code = request.data.get("code", "").strip()
         if not code:
             return Response({"detail": "Код обязателен"}, status=400)
 
-        try:
-            with transaction.atomic():
-                lc = LoyaltyCode.objects.select_for_update().get(code=code)
+        body, status_code = redeem_code(code, request.user)
+        return Response(body, status=status_code)
 
-                if lc.redeemed:
-                    return Response({"detail": "Код уже использован"}, status=400)
-                if timezone.now() > lc.expires_at:
-                    return Response({"detail": "Код истёк"}, status=400)
 
-                # Начисляем штамп клиенту
-                profile, _ = LoyaltyProfile.objects.get_or_create(user=lc.user)
-                profile.stamps = F("stamps") + 1
-                profile.save()
-                profile.refresh_from_db()
+# ПАКЕТНЫЕ ЗАПРОСЫ
+def _list_param(request, name):
+    """?name=a,b&name=c → ["a", "b", "c"]."""
+    values = []
+    for raw in request.query_params.getlist(name):
+        values.extend(part.strip() for part in raw.split(",") if part.strip())
+    return values
 
-                # Активируем код
-                lc.redeemed = True
-                lc.redeemed_at = timezone.now()
-                lc.redeemed_by = request.user
-                lc.save(update_fields=["redeemed", "redeemed_at", "redeemed_by"])
 
-                # Записываем в статистику штампов
-                LoyaltyStamp.objects.create(
-                    user=lc.user,
-                    source="code",
-                    created_by=request.user
-                )
+def _batch_too_large(size):
+    max_size = getattr(settings, "LOYALTY_BATCH_MAX_SIZE", 500)
+    if size > max_size:
+        return Response({"detail": f"Не больше {max_size} элементов за запрос"}, status=400)
+    return None
 
-                return Response({
+
+# ПАКЕТНОЕ ПОГАШЕНИЕ — офлайн-синхронизация планшета баристы
+def _scan_time(raw, now):
+    """Время сканирования из запроса (ISO 8601); будущее обрезается до now."""
+    if not raw:
+        return now
+    try:
+        scanned_at = parse_datetime(str(raw))
+    except ValueError:
+        scanned_at = None
+    if scanned_at is None:
+        return None
+    if timezone.is_naive(scanned_at):
+        scanned_at = timezone.make_aware(scanned_at)
+    return min(scanned_at, now)
+
+
+def redeem_codes(entries, barista):
+    """Погасить пачку кодов [{"code", "scanned_at"}]; результат по каждому — в порядке entries.
+
+    Срок действия проверяется на момент сканирования; сканирование старше окна
+    офлайн-синхронизации отклоняется — к этому времени очистка могла удалить
+    строку кода или отметку о погашении. Коды из БД блокируются
+    одним SELECT ... FOR UPDATE с IN (...), штампы начисляются одним UPDATE на
+    клиента, записи LoyaltyStamp пишутся одним bulk_create. Ошибка по одному
+    коду не прерывает пачку; код сверх лимита штампов не гасится.
+    """
+    now = timezone.now()
+    oldest_scan = now - offline_sync_window()
+    results = [None] * len(entries)
+    pending = []  # (индекс, код, время сканирования)
+    seen = set()
+
+    def fail(index, code, status_code, detail):
+        results[index] = {"code": code, "status": status_code, "detail": detail}
+
+    for index, entry in enumerate(entries):
+        code = str(entry.get("code") or "").strip() if isinstance(entry, dict) else ""
+        if not code:
+            fail(index, code, 400, "Код обязателен")
+            continue
+        scanned_at = _scan_time(entry.get("scanned_at"), now)
+        if scanned_at is None:
+            fail(index, code, 400, "Некорректное время сканирования")
+        elif scanned_at < oldest_scan:
+            fail(index, code, 400, "Сканирование старше окна офлайн-синхронизации")
+        elif code in seen:
+            fail(index, code, 400, "Код уже использован")
+        else:
+            seen.add(code)
+            pending.append((index, code, scanned_at))
+
+    with transaction.atomic():
+        locked = {
+            lc.code: lc
+            for lc in LoyaltyCode.objects.select_for_update()
+            .filter(code__in=[code for _, code, _ in pending if not is_signed_code(code)])
+            .only("id", "code", "user_id", "created_at", "expires_at", "redeemed")
+        }
+
+        accepted = []  # (индекс, код, user_id, LoyaltyCode или окно подписанного кода)
+        signed = []
+        for index, code, scanned_at in pending:
+            if is_signed_code(code):
+                try:
+                    user_id, window = verify_code(code, now=scanned_at)
+                except SignedCodeError as e:
+                    fail(index, code, e.status, str(e))
+                    continue
+                signed.append((index, code, user_id, window))
+                continue
+
+            lc = locked.get(code)
+            if lc is None:
+                fail(index, code, 404, "Код не найден")
+            elif lc.redeemed:
+                fail(index, code, 400, "Код уже использован")
+            elif not lc.created_at <= scanned_at <= lc.expires_at:
+                fail(index, code, 400, "Код истёк")
+            else:
+                accepted.append((index, code, lc.user_id, lc))
+
+        user_ids = {item[2] for item in accepted + signed}
+        clients = dict(User.objects.filter(pk__in=user_ids).values_list("id", "username"))
+
+        if signed:
+            used = set(RedeemedSignedCode.objects.filter(
+                user_id__in={user_id for _, _, user_id, _ in signed},
+                window__in={window for _, _, _, window in signed},
+            ).values_list("user_id", "window"))
+            for index, code, user_id, window in signed:
+                if user_id not in clients:
+                    fail(index, code, 404, "Код не найден")
+                elif (user_id, window) in used or not mark_redeemed(user_id, window, redeemed_by_id=barista.id):
+                    fail(index, code, 400, "Код уже использован")
+                else:
+                    accepted.append((index, code, user_id, window))
+
+        by_user = defaultdict(list)
+        for item in sorted(accepted):
+            by_user[item[2]].append(item)
+
+        redeemed, unmarked = [], []
+        for user_id, items in by_user.items():
+            stamps, added = LoyaltyProfile.objects.add_stamps(user_id, len(items))
+            for index, code, _, ref in items[added:]:
+                fail(index, code, 400, f"Лимит достигнут ({stamps})")
+                if not isinstance(ref, LoyaltyCode):
+                    unmarked.append((user_id, ref))
+            for index, code, _, ref in items[:added]:
+                redeemed.append((user_id, ref))
+                results[index] = {
+                    "code": code,
+                    "status": 200,
                     "detail": "Штамп успешно начислен",
-                    "stamps": profile.stamps,
-                    "client": lc.user.username
-                })
+                    "stamps": stamps,
+                    "client": clients[user_id],
+                }
 
-        except LoyaltyCode.DoesNotExist:
-            return Response({"detail": "Код не найден"}, status=404)
+        # Подписанный код сверх лимита можно будет погасить после сброса
+        for user_id, window in unmarked:
+            RedeemedSignedCode.objects.filter(user_id=user_id, window=window).delete()
+
+        LoyaltyCode.objects.filter(
+            pk__in=[ref.pk for _, ref in redeemed if isinstance(ref, LoyaltyCode)]
+        ).update(redeemed=True, redeemed_at=now, redeemed_by_id=barista.id)
+        LoyaltyStamp.objects.bulk_create([
+            LoyaltyStamp(user_id=user_id, source="code", created_by_id=barista.id)
+            for user_id, _ in redeemed
+        ])
+        BaristaDailyStats.objects.bump(barista.id, codes=len(redeemed), stamps=len(redeemed))
+
+    return results
+
+
+class RedeemLoyaltyCodesView(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_classes = CODE_BATCH_THROTTLES
+
+    @staticmethod
+    def throttle_cost(request):
+        # Каждый код в пачке — отдельная попытка для лимита перебора
+        codes = request.data.get("codes")
+        return len(codes) if isinstance(codes, list) else 1
+
+    def post(self, request):
+        if not (request.user.is_staff or getattr(request.user, "is_barista", False)):
+            return Response({"detail": "Только бариста"}, status=403)
+
+        codes = request.data.get("codes")
+        if not isinstance(codes, list) or not codes:
+            return Response({"detail": "codes — непустой список"}, status=400)
+        too_large = _batch_too_large(len(codes))
+        if too_large is not None:
+            return too_large
+
+        results = redeem_codes(codes, request.user)
+        return Response({
+            "redeemed": sum(result["status"] == 200 for result in results),
+            "results": results,
+        })
 
 
 # РУЧНОЕ НАЧИСЛЕНИЕ ШТАМПОВ
 class AddStampToUserView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent("add-stamp")
     def post(self, request):
         if not request.user.is_staff:
             return Response({"error": "Только бариста"}, status=403)
@@ -292,35 +573,30 @@ class AddStampToUserView(APIView):
         if not username:
             return Response({"error": "username обязателен"}, status=400)
 
-        try:
-            target = User.objects.get(username__iexact=username)
-        except User.DoesNotExist:
+        target = User.objects.filter(username_key=normalize_username(username)).order_by("id").first()
+        if target is None:
             return Response({"error": "Пользователь не найден"}, status=404)
 
-        profile, _ = LoyaltyProfile.objects.get_or_create(user=target)
         max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
 
-        if profile.stamps + amount > max_stamps:
-            amount = max_stamps - profile.stamps
-
-        if amount <= 0:
-            return Response({"detail": f"Лимит достигнут ({max_stamps})"}, status=400)
-
-        profile.stamps = F("stamps") + amount
-        profile.save()
-        profile.refresh_from_db()
+        with transaction.atomic():
+            # Лимит соблюдается внутри UPDATE — лишнее просто не начислится
+            stamps, amount = LoyaltyProfile.objects.add_stamps(target.id, amount, max_stamps)
+            if amount <= 0:
+                return Response({"detail": f"Лимит достигнут ({max_stamps})"}, status=400)
 
-        for _ in range(amount):
             LoyaltyStamp.objects.create(
-                user=target,
+                user_id=target.id,
                 source="manual",
-                created_by=request.user
+                quantity=amount,
+                created_by_id=request.user.id
             )
+            BaristaDailyStats.objects.bump(request.user.id, stamps=amount)
 
         return Response({
             "username": target.username,
             "stamps_added": amount,
-            "stamps_total": profile.stamps,
+            "stamps_total": stamps,
             "max_stamps": max_stamps
         })
 
@@ -328,23 +604,20 @@ class AddStampToUserView(APIView):
 class ResetLoyaltyView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent("reset")
     def post(self, request):
         username = request.data.get("username")
 
         if username:
             if not request.user.is_staff:
                 return Response({"detail": "Только бариста"}, status=403)
-            try:
-                target_user = User.objects.get(username=username)
-            except User.DoesNotExist:
+            target_user = User.objects.filter(username_key=normalize_username(username)).order_by("id").first()
+            if target_user is None:
                 return Response({"detail": "Пользователь не найден"}, status=404)
         else:
             target_user = request.user
 
-        profile, _ = LoyaltyProfile.objects.get_or_create(user=target_user)
-        old = profile.stamps
-        profile.stamps = 0
-        profile.save(update_fields=["stamps"])
+        old = LoyaltyProfile.objects.reset_stamps(target_user.id)
 
         return Response({
             "detail": f"Счётчик сброшен (было {old})",
@@ -356,11 +629,14 @@ class ResetLoyaltyView(APIView):
 # ПРОВЕРКА КОДА — только проверка + активация кода (для статистики "активировано кодов")
 class CheckLoyaltyCodeView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_classes = CODE_THROTTLES
 
     def post(self, request):
         code = request.data.get("code", "").strip()
         if not code:
             return Response({"detail": "Код обязателен"}, status=400)
+        if is_signed_code(code):
+            return self.check_signed(request, code)
 
         try:
             with transaction.atomic():
@@ -374,8 +650,9 @@ class CheckLoyaltyCodeView(APIView):
                 # Только активируем код — для статистики "активировано кодов"
                 lc.redeemed = True
                 lc.redeemed_at = timezone.now()
-                lc.redeemed_by = request.user
+                lc.redeemed_by_id = request.user.id
                 lc.save(update_fields=["redeemed", "redeemed_at", "redeemed_by"])
+                BaristaDailyStats.objects.bump(request.user.id, codes=1)
 
                 # ШТАМП НЕ НАЧИСЛЯЕТСЯ!
                 return Response({"detail": "Код валидный и активирован"}, status=200)
@@ -383,9 +660,24 @@ class CheckLoyaltyCodeView(APIView):
         except LoyaltyCode.DoesNotExist:
             return Response({"detail": "Такого кода не существует"}, status=404)
 
+    def check_signed(self, request, code):
+        try:
+            user_id, window = verify_code(code)
+        except SignedCodeError as e:
+            return Response({"detail": str(e)}, status=e.status)
+
+        if not User.objects.filter(pk=user_id).exists():
+            return Response({"detail": "Такого кода не существует"}, status=404)
+        with transaction.atomic():
+            if not mark_redeemed(user_id, window, redeemed_by_id=request.user.id):
+                return Response({"detail": "Код уже был использован"}, status=400)
+            BaristaDailyStats.objects.bump(request.user.id, codes=1)
+        return Response({"detail": "Код валидный и активирован"}, status=200)
+
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
+@replica_reads
 def get_loyalty_status(request):
     username = request.query_params.get("username")
     if not username:
@@ -395,42 +687,219 @@ def get_loyalty_status(request):
         if request.user.username.lower() != username.lower():
             return Response({"detail": "Доступ только к своему профилю"}, status=403)
 
-    try:
-        target = User.objects.get(username__iexact=username)
-    except User.DoesNotExist:
+    # Из кэша; при промахе — пользователь и штампы одним SELECT с LEFT JOIN
+    target = status_cache.get_status_by_username(username)
+    if target is None:
         return Response({"detail": "Пользователь не найден"}, status=404)
 
-    profile, _ = LoyaltyProfile.objects.get_or_create(user=target)
-    return Response({
-        "username": target.username,
-        "stamps": profile.stamps,
+    etag = status_etag("status", target)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+
+    return with_etag(Response({
+        "username": target["username"],
+        "stamps": target["stamps"],
         "max_stamps": getattr(settings, "LOYALTY_MAX_STAMPS", 6),
-    })
+    }), etag)
+
+
+# СТАТУС НЕСКОЛЬКИХ КЛИЕНТОВ — очередь на экране баристы
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def get_loyalty_statuses(request):
+    if not request.user.is_staff:
+        return Response({"detail": "Только бариста"}, status=403)
+
+    usernames = _list_param(request, "usernames")
+    try:
+        ids = [int(value) for value in _list_param(request, "ids")]
+    except ValueError:
+        return Response({"detail": "ids — целые числа"}, status=400)
+    if not usernames and not ids:
+        return Response({"detail": "usernames или ids обязательны"}, status=400)
+    too_large = _batch_too_large(len(usernames) + len(ids))
+    if too_large is not None:
+        return too_large
+
+    # Из кэша get_many; промахи — один SELECT ... IN на логины и один на id
+    by_username = status_cache.get_statuses_by_username(usernames) if usernames else {}
+    by_id = status_cache.get_statuses(ids) if ids else {}
+    max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+
+    results, not_found = [], []
+    for key, target in [(name, by_username.get(normalize_username(name))) for name in usernames] + [(i, by_id.get(i)) for i in ids]:
+        if target is None:
+            not_found.append(key)
+            continue
+        results.append({
+            "id": target["id"],
+            "username": target["username"],
+            "stamps": target["stamps"],
+            "max_stamps": max_stamps,
+        })
+    return Response({"results": results, "not_found": not_found})
+
+
+# ИСТОРИЯ ШТАМПОВ — своя; бариста может указать user_id клиента
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def loyalty_stamp_history(request):
+    user_id = request.user.id
+    if "user_id" in request.query_params:
+        if not request.user.is_staff:
+            return Response({"detail": "Только бариста"}, status=403)
+        try:
+            user_id = int(request.query_params["user_id"])
+        except ValueError:
+            return Response({"detail": "user_id — целое число"}, status=400)
 
+    page_size = getattr(settings, "LOYALTY_HISTORY_PAGE_SIZE", 20)
+    try:
+        limit = int(request.query_params.get("limit", page_size))
+    except ValueError:
+        return Response({"detail": "limit — целое число"}, status=400)
+    limit = max(1, min(limit, getattr(settings, "LOYALTY_HISTORY_MAX_PAGE_SIZE", 100)))
+
+    try:
+        rows, next_cursor = LoyaltyService.get_user_stamp_history(
+            user_id, limit=limit, cursor=request.query_params.get("cursor")
+        )
+    except InvalidHistoryCursor:
+        return Response({"detail": "Неверный cursor"}, status=400)
+    return Response({"results": rows, "next_cursor": next_cursor})
 
-# СТАТИСТИКА БАРИСТЫ
+
+def _date_param(params, name):
+    """?name=ГГГГ-ММ-ДД → date; нет параметра — None, мусор — ValueError."""
+    if not params.get(name):
+        return None
+    value = parse_date(params[name])
+    if value is None:
+        raise ValueError(name)
+    return value
+
+
+# ВЫГРУЗКА ДЛЯ БУХГАЛТЕРИИ — штампы и погашенные коды потоком (CSV/NDJSON, gzip)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_loyalty(request):
+    # is_superuser нет в claims токена — проверяем по строке User (вьюха редкая)
+    if not resolve_user(request.user).is_superuser:
+        return Response({"detail": "Только администратор"}, status=403)
+
+    params = request.query_params
+    kind, fmt = params.get("kind", "stamps"), params.get("output", "csv")  # ?format= занят DRF
+    if kind not in EXPORTS:
+        return Response({"detail": f"kind: {', '.join(EXPORTS)}"}, status=400)
+    if fmt not in FORMATS:
+        return Response({"detail": f"output: {', '.join(FORMATS)}"}, status=400)
+    try:
+        date_from, date_to = _date_param(params, "from"), _date_param(params, "to")
+        barista_id = int(params["barista"]) if params.get("barista") else None
+    except ValueError:
+        return Response({"detail": "from/to — даты ГГГГ-ММ-ДД, barista — id"}, status=400)
+    since, until = date_range(date_from, date_to)
+    gzip = params.get("gzip") in ("1", "true")
+
+    rows = export_rows(kind, since=since, until=until, barista_id=barista_id)
+    response = StreamingHttpResponse(
+        stream_export(kind, fmt, rows, gzip=gzip),
+        content_type="application/gzip" if gzip else f"{FORMATS[fmt]}; charset=utf-8",
+    )
+    filename = f"{kind}.{fmt}" + (".gz" if gzip else "")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+# ПОИСК КЛИЕНТА ПО МЕРЕ НАБОРА — логин, имя или телефон (начало или последние цифры)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def search_loyalty_customers(request):
+    if not request.user.is_staff:
+        return Response({"detail": "Только бариста"}, status=403)
+
+    max_limit = getattr(settings, "LOYALTY_SEARCH_LIMIT", 10)
+    try:
+        limit = min(int(request.query_params.get("limit", max_limit)), max_limit)
+    except ValueError:
+        return Response({"detail": "limit — целое число"}, status=400)
+    if limit < 1:
+        return Response({"detail": "limit должен быть больше 0"}, status=400)
+
+    max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+    results = search_customers(request.query_params.get("q", ""), limit)
+    for row in results:
+        row["max_stamps"] = max_stamps
+    return Response({"results": results})
+
+
+# НАЧИСЛЕНИЕ ШТАМПОВ НЕСКОЛЬКИМ КЛИЕНТАМ — групповой заказ
+class AddStampsBatchView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if not request.user.is_staff:
+            return Response({"error": "Только бариста"}, status=403)
+
+        items = request.data.get("items")
+        if not isinstance(items, list) or not items:
+            return Response({"error": "items — непустой список"}, status=400)
+        too_large = _batch_too_large(len(items))
+        if too_large is not None:
+            return too_large
+
+        requested = defaultdict(int)  # username_key -> штампов
+        for item in items:
+            username = str(item.get("username") or "").strip() if isinstance(item, dict) else ""
+            if not username:
+                return Response({"error": "username обязателен"}, status=400)
+            try:
+                amount = max(1, int(item.get("amount", 1)))
+            except (TypeError, ValueError):
+                return Response({"error": f"Некорректное количество для {username}"}, status=400)
+            requested[normalize_username(username)] += amount
+
+        users = {}
+        for user_id, username in (
+            User.objects.filter(username_key__in=list(requested))
+            .order_by("id").values_list("id", "username")
+        ):
+            users.setdefault(normalize_username(username), (user_id, username))
+
+        max_stamps = getattr(settings, "LOYALTY_MAX_STAMPS", 6)
+        with transaction.atomic():
+            applied = LoyaltyProfile.objects.add_stamps_many(
+                {users[name][0]: amount for name, amount in requested.items() if name in users}, max_stamps
+            )
+            LoyaltyStamp.objects.bulk_create([
+                LoyaltyStamp(user_id=user_id, source="manual", quantity=added, created_by_id=request.user.id)
+                for user_id, (_, added) in applied.items() if added
+            ])
+            BaristaDailyStats.objects.bump(request.user.id, stamps=sum(added for _, added in applied.values()))
+
+        results, not_found = [], []
+        for name in requested:
+            if name not in users:
+                not_found.append(name)
+                continue
+            user_id, username = users[name]
+            stamps, added = applied[user_id]
+            results.append({
+                "username": username,
+                "stamps_added": added,
+                "stamps_total": stamps,
+                "max_stamps": max_stamps,
+            })
+        return Response({"results": results, "not_found": not_found})
+
+
+# СТАТИСТИКА БАРИСТЫ — из дневных итогов BaristaDailyStats, без COUNT по штампам и кодам
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@replica_reads
 def barista_stats(request):
     if not (request.user.is_staff or getattr(request.user, 'is_barista', False)):
         return Response({"detail": "Доступ запрещён"}, status=403)
 
-    today = timezone.now().date()
-    week_ago = timezone.now() - timedelta(days=7)
-
-    stats = {
-        "codes_activated": LoyaltyCode.objects.filter(
-            redeemed=True,
-            redeemed_by=request.user
-        ).count(),
-        "stamps_today": LoyaltyStamp.objects.filter(
-            created_at__date=today,
-            created_by=request.user
-        ).count(),
-        "stamps_week": LoyaltyStamp.objects.filter(
-            created_at__gte=week_ago,
-            created_by=request.user
-        ).count(),
-    }
-
-    return Response(stats)
+    return Response(BaristaDailyStats.objects.summary(request.user.id))
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sixcoffee.settings')
 
 application = get_asgi_application()
+
+# Фоновая очистка кодов — только в процессах сервера, не в manage.py
+from Loyality.sweeper import start_sweeper  # noqa: E402
+
+start_sweeper()
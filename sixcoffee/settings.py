@@ -3,6 +3,8 @@ from pathlib import Path
 from datetime import timedelta
 import os
 
+from corsheaders.defaults import default_headers
+
 # ------------------------------------------------------------------------------
 # BASE
 # ------------------------------------------------------------------------------
@@ -51,6 +53,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     # "django.middleware.csrf.CsrfViewMiddleware",     # ← для чистого JWT API обычно выключают
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "Loyality.routers.replica_stickiness_middleware",  # чтение с реплик, см. DATABASES
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -65,12 +68,37 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения (Loyality/routers.py): пути через запятую в
+# DJANGO_DB_REPLICAS. Локально это SQLite-копии основной БД, их обновляет
+# manage.py sync_sqlite_replicas. В тестах реплики смотрят в тестовую основную БД.
+_replica_paths = [path.strip() for path in os.getenv("DJANGO_DB_REPLICAS", "").split(",") if path.strip()]
+LOYALTY_REPLICA_DATABASES = [f"replica{number}" for number in range(1, len(_replica_paths) + 1)]
+for _alias, _path in zip(LOYALTY_REPLICA_DATABASES, _replica_paths):
+    DATABASES[_alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": _path,
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["Loyality.routers.PrimaryReplicaRouter"]
+
+# ------------------------------------------------------------------------------
+# CACHE — по умолчанию в памяти процесса; для нескольких воркеров подключите
+# общий бэкенд (Redis/Memcached) через CACHES
+# ------------------------------------------------------------------------------
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "sixcoffee",
+    }
+}
+
 # ------------------------------------------------------------------------------
 # REST FRAMEWORK + JWT
 # ------------------------------------------------------------------------------
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "Loyality.authentication.ClaimsJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": (
         "rest_framework.permissions.IsAuthenticated",
@@ -82,6 +110,21 @@ REST_FRAMEWORK = {
         "rest_framework.renderers.JSONRenderer",
         "rest_framework.renderers.BrowsableAPIRenderer" if DEBUG else (),
     ),
+    # Сколько доверенных прокси перед приложением: IP клиента для троттлов берётся
+    # из X-Forwarded-For только на столько шагов. 0 — только REMOTE_ADDR (иначе
+    # клиент подставит свой X-Forwarded-For и обойдёт лимит по IP); за nginx — 1
+    "NUM_PROXIES": int(os.getenv("DJANGO_NUM_PROXIES", "0")),
+    # Loyality/throttling.py: вход/смена пароля (PBKDF2) и перебор кодов
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": "20/min",
+        "login_username": "10/min",
+        "password_change": "5/min",
+        "code_ip": "60/min",
+        "code_barista": "120/min",
+        # Пакетное погашение: жетон за каждый код, ёмкость — на офлайн-очередь планшета
+        "code_batch_ip": "2000/hour",
+        "code_batch_barista": "2000/hour",
+    },
 }
 
 SIMPLE_JWT = {
@@ -90,6 +133,8 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
     "AUTH_HEADER_TYPES": ("Bearer",),
+    "TOKEN_OBTAIN_SERIALIZER": "Loyality.serializers.LoyaltyTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "Loyality.serializers.LoyaltyTokenRefreshSerializer",
 }
 
 # ------------------------------------------------------------------------------
@@ -106,6 +151,7 @@ CORS_ALLOWED_ORIGINS = [
 ]
 
 CORS_ALLOW_CREDENTIALS = True   # ← если используете cookies/auth через фронт
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key")  # повторы POST с кассы
 
 CSRF_TRUSTED_ORIGINS = CORS_ALLOWED_ORIGINS.copy()  # для fetch/axios с credentials
 
@@ -123,6 +169,106 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Проектные константы
+# LOYALTY_MAX_STAMPS попадает и в ограничение БД loyaltyprofile_stamps_max
+# (LoyaltyProfile.Meta) при импорте моделей: после изменения нужен
+# makemigrations, а при уменьшении — сначала manage.py clamp_loyalty_stamps
 LOYALTY_MAX_STAMPS = 6
+
+# Коды лояльности: длина, время жизни и размер блока номеров, который процесс
+# резервирует в LoyaltyCodeSequence за один UPDATE (см. Loyality/codes.py)
+LOYALTY_CODE_LENGTH = 6
+LOYALTY_CODE_TTL_MINUTES = 15
+LOYALTY_CODE_BLOCK_SIZE = 64
+
+# Повторное "показать код" отдаёт уже выданный живой код (и продлевает его,
+# когда осталось меньше половины TTL); новых живых кодов — не больше лимита
+LOYALTY_CODE_REUSE = True
+LOYALTY_CODE_REUSE_EXTEND = True
+LOYALTY_MAX_LIVE_CODES = 3
+
+# "db" — код хранится в LoyaltyCode; "signed" — HMAC-код без записи при выдаче
+# (Loyality/signed_codes.py). Погашение понимает оба формата независимо от режима.
+LOYALTY_CODE_MODE = os.getenv("LOYALTY_CODE_MODE", "db")
+LOYALTY_SIGNED_CODE_STEP_SECONDS = 60
+
+# Офлайн-синхронизация (/api/loyalty/redeem-codes/): сканирования старше этого
+# числа часов отклоняются, а истёкшие коды и отметки погашения подписанных кодов
+# очистка хранит не меньше этого срока — иначе повтор старого кода прошёл бы снова
+LOYALTY_OFFLINE_SYNC_HOURS = 24
+
+# Очистка кодов: погашенные LoyaltyCode храним столько дней (None — бессрочно,
+# они нужны статистике баристы; сам номер кода освобождается для новой выдачи
+# уже после окна офлайн-синхронизации). Интервал фоновой очистки внутри процесса
+# сервера (sixcoffee/wsgi.py и asgi.py; runserver их не загружает) в секундах;
+# None — только через manage.py sweep_loyalty_codes
+LOYALTY_REDEEMED_CODE_RETENTION_DAYS = None
+LOYALTY_SWEEPER_INTERVAL_SECONDS = None
+LOYALTY_SWEEPER_BATCH_SIZE = 1000
+
+# Кэш статуса лояльности (Loyality/status_cache.py): алиас из CACHES и TTL, сек;
+# после изменения запись на TOMBSTONE секунд заменяется меткой, чтобы
+# запоздавший читатель не вернул в кэш старое значение (больше времени одного чтения).
+# По этой же записи JWT-аутентификация отклоняет удалённых и отключённых
+# пользователей: User.save() и удаление сбрасывают её сразу, правка is_active
+# в обход save() (QuerySet.update, SQL) действует не позже чем через TTL
+LOYALTY_STATUS_CACHE_ALIAS = "default"
+LOYALTY_STATUS_CACHE_TTL = 300
+LOYALTY_STATUS_CACHE_TOMBSTONE_SECONDS = 5
+
+# Поток изменений /api/loyalty/events/ (SSE): бэкенд доставки между процессами
+# (см. Loyality/events.py) и интервал keep-alive комментариев, сек
+LOYALTY_EVENTS_BACKEND = "Loyality.events.LocalBackend"
+LOYALTY_EVENTS_HEARTBEAT_SECONDS = 25
+
+# Маршруты, которые обслуживают async-вьюхи (Loyality/async_views.py), по имени:
+# me, loyalty-status, generate-loyalty-code, redeem-loyalty-code. Имеет смысл
+# только под ASGI (uvicorn sixcoffee.asgi:application)
+LOYALTY_ASYNC_ROUTES = [name for name in os.getenv("LOYALTY_ASYNC_ROUTES", "").split(",") if name]
+
+# Отзыв refresh-токенов при ротации (Loyality/revocation.py): фильтр Блума в
+# памяти по корзинам срока истечения, ёмкость и доля ложных срабатываний на
+# корзину; интервал догрузки журнала RevokedToken из БД, сек
+LOYALTY_REVOCATION_BUCKET_SECONDS = 24 * 60 * 60
+LOYALTY_REVOCATION_FILTER_CAPACITY = 50_000
+LOYALTY_REVOCATION_FILTER_ERROR_RATE = 0.001
+LOYALTY_REVOCATION_SYNC_SECONDS = 5
+
+# Кэш для троттлинга входа и кодов (Loyality/throttling.py); при нескольких
+# воркерах — общий (Redis/memcached), ставки — REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]
+LOYALTY_THROTTLE_CACHE_ALIAS = "default"
+
+# Максимум элементов в одном пакетном запросе: /api/loyalty/redeem-codes/,
+# /api/loyalty/statuses/, /api/loyalty/add-stamps/
+LOYALTY_BATCH_MAX_SIZE = 500
+
+# Поиск клиента по мере набора (/api/loyalty/search/, Loyality/search.py):
+# максимум результатов и минимальная длина запроса (текст / цифры телефона)
+LOYALTY_SEARCH_LIMIT = 10
+LOYALTY_SEARCH_MIN_LENGTH = 2
+LOYALTY_SEARCH_MIN_PHONE_DIGITS = 3
+
+# История штампов (/api/loyalty/history/): размер страницы по умолчанию и максимум ?limit=
+LOYALTY_HISTORY_PAGE_SIZE = 20
+LOYALTY_HISTORY_MAX_PAGE_SIZE = 100
+
+# Выгрузка для бухгалтерии (Loyality/export.py): строк в одной пачке чтения
+LOYALTY_EXPORT_CHUNK_SIZE = 2000
+
+# Админка кодов/штампов/профилей (Loyality/admin.py): дальше этого числа строк
+# списки не считают COUNT (на PostgreSQL без фильтров — оценка планировщика)
+LOYALTY_ADMIN_COUNT_LIMIT = 10_000
+
+# Idempotency-Key для погашения кода, начисления и сброса (Loyality/idempotency.py):
+# сколько хранится ответ; сколько повтор ждёт выполняющийся первый запрос;
+# через сколько незавершённый первый запрос считается умершим, сек
+LOYALTY_IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+LOYALTY_IDEMPOTENCY_WAIT_SECONDS = 10
+LOYALTY_IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = 60
+
+# Чтение с реплик (Loyality/routers.py): сколько секунд после записи чтения
+# пользователя идут в основную БД; кэш для этих меток — общий для воркеров
+LOYALTY_REPLICA_STICKY_SECONDS = 10
+LOYALTY_REPLICA_PIN_CACHE_ALIAS = "default"
+
 BARISTA_MASTER_CODE = "coffetogo555"
 BARISTA_MASTER_CODES = ["coffetogo555", "coffetogo1956", "coffetogo777"]  # можно расширять